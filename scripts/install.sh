@@ -34,7 +34,8 @@ info "プロジェクトルート: $PROJECT_ROOT"
 # 依存パッケージのチェック
 info "依存パッケージを確認中..."
 
-REQUIRED_PKGS="mpd sox python3 alsa-utils ecasound bs2b-ladspa"
+# python3-numpy / python3-scipy: 内蔵 DSP エンジン (OUTPUT_METHOD=engine) と aplay 出力のクロスフィードで使う
+REQUIRED_PKGS="mpd sox python3 alsa-utils python3-numpy python3-scipy"
 MISSING_PKGS=""
 
 for pkg in $REQUIRED_PKGS; do
@@ -63,6 +64,16 @@ fi
 
 info "✓ Python Tkinter が利用可能です"
 
+# NumPy/SciPy が実際に import できるか (パッケージはあっても壊れている場合がある)
+if ! python3 -c "import numpy, scipy" 2>/dev/null; then
+    error "NumPy/SciPy を読み込めません (OUTPUT_METHOD=engine とクロスフィードで必要)"
+    echo "以下のコマンドでインストールしてください:"
+    echo "  sudo apt install -y python3-numpy python3-scipy"
+    exit 1
+fi
+
+info "✓ NumPy/SciPy が利用可能です"
+
 # インストール先ディレクトリの作成
 BIN_DIR="$HOME/bin"
 info "インストール先: $BIN_DIR"
@@ -73,12 +84,11 @@ mkdir -p "$BIN_DIR"
 info "ソースファイルをコピー中..."
 cp -v "$PROJECT_ROOT/src/sox_gui.py" "$BIN_DIR/"
 cp -v "$PROJECT_ROOT/src/run_sox_fifo.sh" "$BIN_DIR/"
-cp -v "$PROJECT_ROOT/src/mpd_watcher.sh" "$BIN_DIR/"
+cp -v "$PROJECT_ROOT/src"/sox_*.py "$BIN_DIR/"
 
 # 実行権限の付与
 chmod +x "$BIN_DIR/sox_gui.py"
 chmod +x "$BIN_DIR/run_sox_fifo.sh"
-chmod +x "$BIN_DIR/mpd_watcher.sh"
 
 info "✓ ソースファイルのコピー完了"
 
@@ -88,6 +98,11 @@ cp -v "$PROJECT_ROOT/firs"/*.txt "$BIN_DIR/"
 
 info "✓ FIRフィルターのコピー完了"
 
+# 内蔵エンジン用: ノイズ×倍音 FIR の合成カーネルを事前計算 (~/.cache/sox_engine/fir)
+# (テキスト係数はバイナリ形式 .bin に変換し、エンジン起動時は mmap で読み込む)
+python3 "$BIN_DIR/sox_fir.py" convert "$BIN_DIR"/noise_fir_*.txt "$BIN_DIR"/harmonic_*.txt
+python3 "$BIN_DIR/sox_fircache.py" --firs "$BIN_DIR" && info "✓ FIR キャッシュを作成しました"
+
 # run_sox_fifo.sh 内のパスを更新
 info "FIR_BASE_PATH を更新中..."
 sed -i "s|FIR_BASE_PATH=\"/home/tysbox/bin/\"|FIR_BASE_PATH=\"$BIN_DIR/\"|g" "$BIN_DIR/run_sox_fifo.sh"
@@ -125,15 +140,16 @@ case $service_choice in
         
         # サービスファイル内のユーザー名を更新
         sudo sed -i "s|/home/tysbox/|$HOME/|g" /etc/systemd/system/run_sox_fifo.service
-        sudo sed -i "s|/home/tysbox/|$HOME/|g" /etc/systemd/system/mpd_watcher.service
+        # 旧 mpd_watcher (曲ごとに MPD とサービスを再起動) は sox_supervisor.py に置き換えられた
+        sudo systemctl disable --now mpd_watcher.service 2>/dev/null || true
         
         sudo systemctl daemon-reload
         
         echo "サービスを有効化して起動しますか? [y/N]"
         read -r response
         if [[ "$response" =~ ^[Yy] ]]; then
-            sudo systemctl enable run_sox_fifo.service mpd_watcher.service
-            sudo systemctl start run_sox_fifo.service mpd_watcher.service
+            sudo systemctl enable run_sox_fifo.service
+            sudo systemctl start run_sox_fifo.service
             info "✓ サービスを有効化・起動しました"
         fi
         ;;
@@ -144,15 +160,15 @@ case $service_choice in
         
         # サービスファイル内のパスを更新
         sed -i "s|/home/tysbox/|$HOME/|g" "$HOME/.config/systemd/user/run_sox_fifo.service"
-        sed -i "s|/home/tysbox/|$HOME/|g" "$HOME/.config/systemd/user/mpd_watcher.service"
+        systemctl --user disable --now mpd_watcher.service 2>/dev/null || true
         
         systemctl --user daemon-reload
         
         echo "サービスを有効化して起動しますか? [y/N]"
         read -r response
         if [[ "$response" =~ ^[Yy] ]]; then
-            systemctl --user enable run_sox_fifo.service mpd_watcher.service
-            systemctl --user start run_sox_fifo.service mpd_watcher.service
+            systemctl --user enable run_sox_fifo.service
+            systemctl --user start run_sox_fifo.service
             info "✓ サービスを有効化・起動しました"
         fi
         ;;
@@ -189,9 +205,7 @@ echo
 echo "サービス状態の確認:"
 if [ "$service_choice" = "1" ]; then
     echo "  sudo systemctl status run_sox_fifo.service"
-    echo "  sudo systemctl status mpd_watcher.service"
 elif [ "$service_choice" = "2" ]; then
     echo "  systemctl --user status run_sox_fifo.service"
-    echo "  systemctl --user status mpd_watcher.service"
 fi
 echo
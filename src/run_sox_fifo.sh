@@ -10,9 +10,10 @@ CTL_PATH="/tmp/sox.ctl"
 # パスの最後に "/" を付けてください。
 FIR_BASE_PATH="/home/tysbox/bin/"
 
-# --- 設定値 (GUIから書き換えられる部分) ---
+# --- 設定値 (GUI の設定ファイル sox_settings.json が無いときの既定値) ---
+# GUI の「設定を適用」はこのスクリプトを書き換えず、同じディレクトリの sox_settings.json に保存する (下で読み込む)
 MUSIC_TYPE="none"
-EFFECTS_TYPE="vinyl"
+EFFECTS_TYPE="none"
 EQ_OUTPUT_TYPE="Crystal-Clarity"
 GAIN="-5"
 NOISE_FIR_TYPE="default"
@@ -21,45 +22,77 @@ OUTPUT_METHOD="aplay"
 OUTPUT_DEVICE="bluealsa"
 CROSSFEED_ENABLED="true"
 CROSSFEED_PRESET="cmoy"
-
-# SAMPLE_RATE="192000" # 現在は192k固定でリサンプル。将来的に可変にする場合のため (GUIから設定可能にする必要あり)
+RESAMPLE_QUALITY="very-high"
+
+# 内蔵エンジン (OUTPUT_METHOD=engine) の処理ブロック長 = FIR パーティション長 (フレーム)
+# auto: BlueALSA は 8192 (低 CPU)、USB-DAC/HDMI 等 192kHz は 2048 (低レイテンシ)
+ENGINE_BLOCK_SIZE="auto"
+# 内蔵エンジンの実行方式
+# single: 全ステージを 1 スレッドで処理 (レイテンシ最小、既定)
+# staged: FIR / EQ / リサンプル / 後段 (ゲイン・クロスフィード・ディザー) をステージごとのスレッドで並列処理
+#         (CPU に余裕ができる代わりにステージ間のキュー 4 ブロック分レイテンシが増える)
+ENGINE_PIPELINE="single"
+# ステージ別の CPU 割り当て (例: "io:2 fir:3 eq:2 resample:3 post:2")。空なら CPU_AFFINITY の範囲で OS に任せる
+ENGINE_CPU_MAP=""
+
+# MPD FIFO の形式 (mpd.conf の fifo 出力の format と同じ値にする)
+# auto: engine が曲ごとに MPD の audio 状態からレート/ビット数を受け取り、曲のネイティブレートのまま処理して
+#       出力レートへ 1 回だけリサンプルする (mpd.conf の fifo 出力は format "*:*:2"。
+#       OUTPUT_METHOD=engine かつ TRACK_CHANGE_RESTART=1 のみ。sox/aplay では 192000:32:2 として扱う)
+FIFO_FORMAT="192000:32:2"
+
+# パイプライン全体を割り当てる CPU (taskset -c 形式)。空なら割り当てなし
+# run_sox_fifo.service の Environment=SOX_CPUS=... で上書きできる
+CPU_AFFINITY="${SOX_CPUS-2,3}"
+
+# 再生状態のメトリクス (xrun 数・ALSA バッファ充填率・ブロック処理時間・FIFO 滞留量)
+# METRICS_SOCKET: JSON を返す Unix ソケット (GUI の Engine Health 表示が参照)。空なら無効
+# METRICS_PROM: Prometheus テキスト形式の出力先 (node_exporter textfile collector 用)。空なら無効
+METRICS_SOCKET="/tmp/sox_metrics.sock"
+METRICS_PROM=""
+
+# ALSA バッファの自動調整 (aplay / engine)。1 にすると出力デバイスごとに低レイテンシの値から始め、
+# underrun で 1 段大きく、長時間安定したら 1 段小さくして、学習値を ~/.sox_gui_config.json に保存・再利用する
+# 0 なら従来の固定値 (BlueALSA: 500ms / その他: 65536 フレーム)
+BUFFER_AUTOTUNE="0"
+
+# 出力の語長 (ディザーするビット数)。出力形式は常に S32_LE で、これより下位のビットは 0 になる
+# auto: デバイスごとに決める (python3 sox_output.py bits PLAY_DEVICE 24 でデバイス別に設定。
+#       未設定なら USB-DAC が報告するビット数 / BlueALSA は 24 / その他は 32)
+OUTPUT_BITS="auto"
+
+# リサンプラーの品質 (RESAMPLE_QUALITY, GUI の Gain / Output タブで選択)
+# very-high: rate -v -s -M -b 95 (直線位相・高品質) / medium: rate -h / fast: rate -l (低負荷機・Bluetooth 向け)
+# MPD FIFO のレート (FIFO_RATE) と出力レートが同じ場合はリサンプルしない
 # --- 設定値ここまで ---
 
 # --- 出力デバイスの選択 ---
 
 # Buffer 最適化: underrun 防止のためバッファサイズを増大
 # Note: Linux の ulimit -p (pipe size) は通常変更できないため削除。
-# 必要に応じて /proc/sys/fs/pipe-max-size を参照してください。
-
-# 決定された出力先に基づき aplay 用のデバイス指定を行う
-PLAY_DEVICE="plug:default"
-# If the configuration stores a specific hw: or plug: device, use it directly
-# Use plughw: wrapper for hw: devices to ensure format support (e.g. S32_LE/192k)
-# and avoid "Unknown parameter 1" parsing errors with plug:hw: syntax.
-if echo "$OUTPUT_DEVICE" | grep -Eq '^hw:[0-9]+(,[0-9]+)?$'; then
-    PLAY_DEVICE=$(echo "$OUTPUT_DEVICE" | sed 's/^hw:/plughw:/')
-elif [ "$OUTPUT_DEVICE" = "PC Speakers" ] || [ "$OUTPUT_DEVICE" = "PC Speakers (hw:0,0)" ]; then
-    PLAY_DEVICE="plughw:0,0"
-elif echo "$OUTPUT_DEVICE" | grep -Eq '^plug:'; then
-    PLAY_DEVICE="$OUTPUT_DEVICE"
-elif [ "$OUTPUT_DEVICE" = "bluealsa" ] || [ "$OUTPUT_DEVICE" = "BlueALSA" ]; then
-    # Use ALSA plug wrapper for bluealsa so format conversion works for aplay
-    PLAY_DEVICE="plug:bluealsa"
-elif [ "$OUTPUT_DEVICE" = "USB-DAC" ]; then
-    # USB 接続カードを検出
-    CARDNUM=$(aplay -l 2>/dev/null | grep -m1 USB | sed -n 's/^card \([0-9]\+\):.*/\1/p')
-    if [ -n "$CARDNUM" ]; then
-        PLAY_DEVICE="plughw:$CARDNUM"
-    else
-        echo "警告: USB DAC が見つかりません。plug:default を使用します。" >&2
-        PLAY_DEVICE="plug:default"
-    fi
-else
-    PLAY_DEVICE="plug:default"
-fi
+# OUTPUT_METHOD="engine" では sox_engine.py が FIFO のパイプバッファを
+# F_SETPIPE_SZ で /proc/sys/fs/pipe-max-size まで拡大します (--pipe-size)。
+
+# このスクリプトの実体パス (sox_engine.py / sox_supervisor.py は同じディレクトリに置かれる)
+SCRIPT_PATH="$(readlink -f "$0")"
+
+# GUI の設定で上の既定値を上書きする (sox_settings.py が検証し、シェル用にクォートして出力する)
+SETTINGS_FILE="$(dirname "$SCRIPT_PATH")/sox_settings.json"
+eval "$(python3 "$(dirname "$SCRIPT_PATH")/sox_settings.py" shell "$SETTINGS_FILE")"
+
+# 決定された出力先に基づき aplay 用のデバイス指定を行う (規則は sox_output.py の resolve_play_device、内蔵エンジンと共有)
+# hw:N -> plughw:N (S32_LE/192k を変換させる) / bluealsa -> plug:bluealsa / USB-DAC -> 最初の USB カードの plughw:
+PLAY_DEVICE="$(python3 "$(dirname "$SCRIPT_PATH")/sox_output.py" device "$OUTPUT_DEVICE")"
+[ -n "$PLAY_DEVICE" ] || PLAY_DEVICE="plug:default"
 
 echo "Using PLAY_DEVICE=$PLAY_DEVICE (OUTPUT_DEVICE=$OUTPUT_DEVICE)"
 
+METRICS_ARGS="--metrics-socket=${METRICS_SOCKET}"
+[ -n "$METRICS_PROM" ] && METRICS_ARGS="${METRICS_ARGS} --metrics-prom=${METRICS_PROM}"
+
+TASKSET=""
+[ -n "$CPU_AFFINITY" ] && TASKSET="taskset -c ${CPU_AFFINITY}"
+
 # FIFOファイルが存在するか確認し、存在しない場合は作成
 if [ ! -p "$FIFO_PATH" ]; then
     mkfifo "$FIFO_PATH"
@@ -96,75 +129,21 @@ case $HARMONIC_FIR_TYPE in
     *)       HARMONIC_FIR_FILTER="" ;; # 未知のタイプはオフとする
 esac
 
-# --- 音楽タイプ別のイコライザー設定 ---
-# (元のスクリプトに含まれていたゲイン設定を維持)
-case $MUSIC_TYPE in
-    jazz)        EQ_INPUT="gain -5 equalizer 80 0.9q +2.5 equalizer 300 1.0q +1.0 equalizer 1500 1.1q +0.5 equalizer 3000 1.0q +1.0 equalizer 7000 0.8q +0.7" ;;
-    classical)   EQ_INPUT="gain -5 equalizer 60 0.7q +1.0 equalizer 400 0.9q -0.5 equalizer 1800 1.0q +0.3 equalizer 4000 1.1q +0.7 equalizer 8000 0.8q +1.0" ;;
-    electronic) EQ_INPUT="gain -5 equalizer 40 0.8q +3.0 equalizer 120 1.0q +2.0 equalizer 800 1.1q -0.5 equalizer 2500 1.0q +1.0 equalizer 8000 0.9q +1.5" ;;
-    vocal)       EQ_INPUT="gain -5 equalizer 70 1.0q -0.8 equalizer 250 1.5q +1.0 equalizer 2500 1.2q +2.0 equalizer 5000 0.8q +1.0 equalizer 12000 0.7q +0.5" ;;
-    none)        EQ_INPUT="gain -3" ;; # 元のスクリプトに合わせて gain -3 を維持
-    *)           EQ_INPUT="" ;;
-esac
+# --- 音楽タイプ別 / 再生デバイス別のイコライザー設定 ---
+# プリセットの定義は sox_eq.py のテーブル (GUI・内蔵エンジンと共有)。未知のタイプは EQ なし。
+EQ_INPUT=""
+EQ_OUTPUT=""
+{ read -r EQ_INPUT; read -r EQ_OUTPUT; } < <(python3 "$(dirname "$SCRIPT_PATH")/sox_eq.py" "$MUSIC_TYPE" "$EQ_OUTPUT_TYPE")
 
-# --- 再生デバイス別のイコライザー設定 ---
-# (元のスクリプトに含まれていたFIRやゲイン設定は、それぞれのフィルター選択や最終ゲインで扱うためここからは削除)
-case $EQ_OUTPUT_TYPE in
-    studio-monitors) EQ_OUTPUT="equalizer 80 0.8q +3 equalizer 2500 1.0q -0.8 equalizer 20000 1.0q +3" ;;
-    JBL-Speakers)    EQ_OUTPUT="equalizer 70 0.7q +3 equalizer 1200 1.0q -2 equalizer 13000 0.8q +5" ;;
-    planar-magnetic) EQ_OUTPUT="equalizer 30 0.7q 1 equalizer 180 0.9q -1 equalizer 15000 0.8q +1.0" ;;
-    bt-earphones)    EQ_OUTPUT="equalizer 60 1.0q +1 equalizer 3000 1.0q -0.5 equalizer 18000 1.0q 3" ;;
-    Tube-Warmth)
-        # Tube-Warmth: 真空管のような温かみと艶
-        # overdrive で倍音を付加し、低域にわずかな厚みを加える
-        EQ_OUTPUT="overdrive 1.5 5 bass +1.5 100 equalizer 50 1.8q +2 equalizer 200 1.1q +1 equalizer 17000 1.0q +2"
-        ;;
-    Crystal-Clarity)
-        # Crystal-Clarity: 超高域の透明感と解像度
-        # 15kHz以上のAir感を強調し、微細な信号をコンパンドで引き上げる
-        EQ_OUTPUT="treble +2 15k 0.5q compand 0.1,0.3 -60,-60,-30,-15,-5,-5"
-        ;;
-    Monitor-Sim)
-        # Monitor-Sim: ニアフィールド・モニタースピーカーのシミュレーション
-        # 150Hz付近の膨らみを抑え、3kHz付近をわずかに強調して明瞭度を上げる
-        EQ_OUTPUT="equalizer 150 1.0q -2 equalizer 3000 0.8q +1"
-        ;;
-    none)            EQ_OUTPUT="" ;;
-    *)               EQ_OUTPUT="" ;;
-esac
+# --- 環境エフェクト (EFFECTS_TYPE) ---
+# 部屋の定義は sox_rooms.py のテーブル (GUI・内蔵エンジンと共有)。sox のパイプラインでは近似の reverb を使い、
+# 内蔵エンジン (OUTPUT_METHOD=engine) は部屋のインパルス応答を畳み込む。none / 未知のタイプはエフェクトなし。
+EFFECTS="$(python3 "$(dirname "$SCRIPT_PATH")/sox_rooms.py" "$EFFECTS_TYPE")"
 
 # --- クロスフィード設定 (bs2b) ---
-# ヘッドホンリスニング時のクロスフィード
-CROSSFEED_CMD=""
-if [ "$CROSSFEED_ENABLED" = "true" ]; then
-    # LADSPA_PATHを設定（環境依存）
-    for ldir in /usr/lib/ladspa /usr/lib/x86_64-linux-gnu/ladspa /usr/local/lib/ladspa; do
-        [ -d "$ldir" ] && export LADSPA_PATH="${LADSPA_PATH:+$LADSPA_PATH:}$ldir"
-    done
-
-    case $CROSSFEED_PRESET in
-        default)
-            # bs2b標準: 700Hz cutoff, 4.5dB feed level
-            BS2B_FEED="4.5"
-            BS2B_CUTOFF="700"
-            ;;
-        cmoy)
-            BS2B_FEED="6.0"
-            BS2B_CUTOFF="650"
-            ;;
-        jmeier)
-            BS2B_FEED="9.5"
-            BS2B_CUTOFF="650"
-            ;;
-        off)
-            CROSSFEED_ENABLED="false"
-            ;;
-        *)
-            BS2B_FEED="4.5"
-            BS2B_CUTOFF="700"
-            ;;
-    esac
-fi
+# ヘッドホンリスニング時のクロスフィード。処理は sox_engine.py の bs2b ステージ (プリセットは sox_dsp.CROSSFEED_PRESETS:
+# default 700Hz/4.5dB, cmoy 650Hz/6.0dB, jmeier 650Hz/9.5dB) で行い、ecasound / LADSPA は使わない
+[ "$CROSSFEED_PRESET" = "off" ] && CROSSFEED_ENABLED="false"
 
 # --- ゲイン調整 (GUIからの値を独立して適用) ---
 FINAL_GAIN_CMD=""
@@ -192,68 +171,122 @@ fi
 # -s: Steep filter (bandwidth = 99%)
 # -M: Linear phase response (group delay minimized)
 # -b 95: Narrow bandwidth for precise phase response
+# MPD FIFO の入力レート / ビット数 (FIFO_FORMAT の "レート:ビット数:2")
+if [ "$FIFO_FORMAT" = "auto" ]; then
+    FIFO_RATE="192000"
+    FIFO_BITS="32"
+    [ "$OUTPUT_METHOD" != "engine" ] && echo "警告: FIFO_FORMAT=auto は engine 専用です。${FIFO_RATE}:32:2 として処理します"
+else
+    FIFO_RATE="${FIFO_FORMAT%%:*}"
+    FIFO_BITS="$(echo "$FIFO_FORMAT" | cut -d: -f2)"
+fi
 if echo "$PLAY_DEVICE" | grep -qi bluealsa; then
     # BlueALSA: resample to 96kHz for LDAC codec (lossless compression at 96kHz)
-    RESAMPLE_CMD="rate -v -s -M -b 95 96k"
+    OUT_RATE="96000"
+else
+    # PC audio/USB DAC: 192kHz
+    OUT_RATE="192000"
+fi
+case "$RESAMPLE_QUALITY" in
+    fast) RATE_OPTS="-l" ;;
+    medium) RATE_OPTS="-h" ;;
+    *) RATE_OPTS="-v -s -M -b 95" ;;
+esac
+if [ "$FIFO_RATE" = "$OUT_RATE" ]; then
+    RESAMPLE_CMD=""
 else
-    # PC audio/USB DAC: use highest quality at 192kHz
-    RESAMPLE_CMD="rate -v -s -M -b 95 192k"
+    RESAMPLE_CMD="rate ${RATE_OPTS} ${OUT_RATE}"
+fi
+
+# --- 出力の語長とディザー ---
+if [ "$OUTPUT_BITS" = "auto" ]; then
+    OUT_BITS="$(python3 "$(dirname "$SCRIPT_PATH")/sox_output.py" bits "$PLAY_DEVICE")"
+else
+    OUT_BITS="$OUTPUT_BITS"
+fi
+# dither -s: Shaped noise with Shibata filter (perceptually reduces audible noise floor)
+# -p: DAC が下位ビットを捨てる場合はその語長に合わせてディザーする
+if [ "${OUT_BITS:-32}" -lt 32 ]; then
+    DITHER_CMD="dither -s -p ${OUT_BITS}"
+else
+    OUT_BITS="32"
+    DITHER_CMD="dither -s"
 fi
 
 # --- SoX コマンドと再生コマンドの構築 ---
-# 入力設定 (MPD FIFOの標準的な形式に合わせる: S32_LE)
-INPUT_OPTS="-t raw -r 192000 -e signed -b 32 -c 2"
+# 入力設定 (FIFO_FORMAT のビット数に合わせる)
+case "$FIFO_BITS" in
+    16) FIFO_ENCODING="-e signed -b 16" ;;
+    # MPD の 24bit は 32bit コンテナの下位 24bit (S24_P32): 32bit として読んで 256 倍 (48dB) で元の振幅に戻す
+    24) FIFO_ENCODING="-e signed -b 32 -v 256" ;;
+    f) FIFO_ENCODING="-e floating-point -b 32" ;;
+    32) FIFO_ENCODING="-e signed -b 32" ;;
+    *)
+        echo "警告: FIFO_FORMAT のビット数 '${FIFO_BITS}' は未対応です。32bit として処理します"
+        FIFO_ENCODING="-e signed -b 32"
+        ;;
+esac
+INPUT_OPTS="-t raw -r ${FIFO_RATE} ${FIFO_ENCODING} -c 2"
 
 # エフェクトチェイン (変数が空の場合は展開されないように注意)
 # 順序: ノイズ除去FIR -> 入力EQ -> 倍音FIR -> 出力EQ -> 環境エフェクト -> リサンプル -> 最終ゲイン -> ディザー
 # 注意: エフェクトは sox [入力] [出力] [エフェクト] の順で指定する必要があるため、
 # エフェクトチェーンの文字列自体はエフェクト部分のみで構成します。
-# dither -s: Shaped noise with Shibata filter (perceptually reduces audible noise floor)
-EFFECT_CHAIN="${NOISE_FIR_FILTER}${NOISE_FIR_FILTER:+" "}${EQ_INPUT}${EQ_INPUT:+" "}${HARMONIC_FIR_FILTER}${HARMONIC_FIR_FILTER:+" "}${EQ_OUTPUT}${EQ_OUTPUT:+" "}${EFFECTS}${EFFECTS:+" "}${RESAMPLE_CMD}${RESAMPLE_CMD:+" "}${FINAL_GAIN_CMD}${FINAL_GAIN_CMD:+" "}dither -s"
+EFFECT_CHAIN="${NOISE_FIR_FILTER}${NOISE_FIR_FILTER:+" "}${EQ_INPUT}${EQ_INPUT:+" "}${HARMONIC_FIR_FILTER}${HARMONIC_FIR_FILTER:+" "}${EQ_OUTPUT}${EQ_OUTPUT:+" "}${EFFECTS}${EFFECTS:+" "}${RESAMPLE_CMD}${RESAMPLE_CMD:+" "}${FINAL_GAIN_CMD}${FINAL_GAIN_CMD:+" "}${DITHER_CMD}"
 
 
 # 出力方法に応じたコマンド構築
 if [ "$OUTPUT_METHOD" == "soxplay" ]; then
     # play コマンドとして実行
     # play [入力オプション] [入力ファイル] [エフェクト]
-    SOX_FULL_COMMAND="AUDIODEV=${PLAY_DEVICE} nice -n -15 taskset -c 2,3 play ${INPUT_OPTS} \"$FIFO_PATH\" ${EFFECT_CHAIN}"
+    SOX_FULL_COMMAND="AUDIODEV=${PLAY_DEVICE} nice -n -15 ${TASKSET} play ${INPUT_OPTS} \"$FIFO_PATH\" ${EFFECT_CHAIN}"
     PLAY_CMD="" # play コマンド自体が出力を行うためパイプ不要
 
 elif [ "$OUTPUT_METHOD" == "aplay" ]; then
+    OUTPUT_OPTS="-t raw -e signed -b 32 -"
     if echo "$PLAY_DEVICE" | grep -qi bluealsa; then
-        OUTPUT_OPTS="-t raw -e signed -b 32 -"
         # BlueALSA: Buffer増やしつつPeriodサイズを細かくして送信タイミングを安定させる (500ms buffer, 8 periods)
-        APLAY_CMD="aplay -D ${PLAY_DEVICE} -f S32_LE -r 96000 -c 2 --buffer-time=500000 --period-time=62500"
+        APLAY_BUFFER_OPTS="--buffer-time=500000 --period-time=62500"
     else
-        OUTPUT_OPTS="-t raw -e signed -b 32 -"
-        APLAY_CMD="aplay -D ${PLAY_DEVICE} -f S32_LE -r 192000 -c 2 --buffer-size=65536 --period-size=8192"
+        APLAY_BUFFER_OPTS="--buffer-size=65536 --period-size=8192"
     fi
+    if [ "$BUFFER_AUTOTUNE" = "1" ]; then
+        # 学習済みの値、未学習なら低レイテンシの初期値 (supervisor が underrun に応じて再起動ごとに更新する)
+        read -r TUNED_BUFFER TUNED_PERIOD < <(python3 "$(dirname "$SCRIPT_PATH")/sox_buftune.py" get "$PLAY_DEVICE" "$OUT_RATE")
+        APLAY_BUFFER_OPTS="--buffer-size=${TUNED_BUFFER} --period-size=${TUNED_PERIOD}"
+    fi
+    APLAY_CMD="aplay -D ${PLAY_DEVICE} -f S32_LE -r ${OUT_RATE} -c 2 ${APLAY_BUFFER_OPTS}"
 
-    # クロスフィードが有効な場合、ecasoundをSoXとaplayの間に挿入
+    # クロスフィードが有効な場合は aplay の代わりに sox_engine.py (--chain crossfeed) が標準入力を受けて
+    # bs2b だけを適用し、そのまま ALSA に出力する (ecasound のプロセス・パイプ 1 段と 4096 フレームのバッファが不要)
+    if [ "$CROSSFEED_ENABLED" = "true" ] && ! python3 -c "import numpy, scipy" 2>/dev/null; then
+        echo "警告: クロスフィードには python3-numpy / python3-scipy が必要です。クロスフィードなしで再生します"
+        CROSSFEED_ENABLED="false"
+    fi
     if [ "$CROSSFEED_ENABLED" = "true" ]; then
-        # SoXの出力サンプルレートを取得
-        if echo "$PLAY_DEVICE" | grep -qi bluealsa; then
-            CF_RATE="96000"
-        else
-            CF_RATE="192000"
-        fi
-
-        # ecasound を間に挿入：stdin → bs2b LADSPA → stdout
-        # -q: quiet, -B:realtime で低遅延バッファモード, -b:4096 で内部バッファを拡大
-        CROSSFEED_PIPE="| nice -n -8 ecasound -q -B:realtime -b:4096 \
-            -f:s32_le,2,${CF_RATE} \
-            -i:stdin \
-            -el:bs2b,${BS2B_FEED},${BS2B_CUTOFF} \
-            -f:s32_le,2,${CF_RATE} \
-            -o:stdout"
-
-        PLAY_CMD="${CROSSFEED_PIPE} | nice -n -10 taskset -c 2,3 ${APLAY_CMD}"
+        CROSSFEED_ARGS="--fifo - --chain crossfeed --script \"$SCRIPT_PATH\" --settings \"$SETTINGS_FILE\" --ctl '' --device ${PLAY_DEVICE}"
+        CROSSFEED_ARGS="${CROSSFEED_ARGS} --input-format ${OUT_RATE}:32:2 --output-bits ${OUT_BITS} --metrics-socket="
+        [ "$BUFFER_AUTOTUNE" = "1" ] && CROSSFEED_ARGS="${CROSSFEED_ARGS} --autotune"
+        PLAY_CMD="| nice -n -10 ${TASKSET} python3 -u \"$(dirname "$SCRIPT_PATH")/sox_engine.py\" ${CROSSFEED_ARGS}"
     else
-        PLAY_CMD="| nice -n -10 taskset -c 2,3 ${APLAY_CMD}"
+        PLAY_CMD="| nice -n -10 ${TASKSET} ${APLAY_CMD}"
     fi
 
     SOX_FULL_COMMAND="sox ${INPUT_OPTS} \"$FIFO_PATH\" ${OUTPUT_OPTS} ${EFFECT_CHAIN}"
 
+elif [ "$OUTPUT_METHOD" == "engine" ]; then
+    # 内蔵 Python DSP エンジン (sox_engine.py)
+    # FIFO 読み込み → FIR/EQ/リサンプル/ゲイン/クロスフィード/ディザー → ALSA 出力を1プロセスで実行する。
+    # 設定値は sox_settings.json (無ければこのスクリプトの "設定値" ブロック) を直接読み込むため、パイプ (PLAY_CMD) は不要。
+    # GUI の「設定を適用」は CTL_PATH 経由で再生中のエンジンに通知され、再起動なしでクロスフェード切替される。
+    ENGINE_PY="$(dirname "$SCRIPT_PATH")/sox_engine.py"
+    ENGINE_ARGS="--script \"$SCRIPT_PATH\" --settings \"$SETTINGS_FILE\" --ctl \"$CTL_PATH\" --device ${PLAY_DEVICE} --block ${ENGINE_BLOCK_SIZE}"
+    ENGINE_ARGS="${ENGINE_ARGS} --pipeline ${ENGINE_PIPELINE} --cpu-map \"${ENGINE_CPU_MAP}\""
+    ENGINE_ARGS="${ENGINE_ARGS} --input-format ${FIFO_FORMAT} --output-bits ${OUT_BITS}"
+    [ "$BUFFER_AUTOTUNE" = "1" ] && ENGINE_ARGS="${ENGINE_ARGS} --autotune"
+    SOX_FULL_COMMAND="nice -n -15 ${TASKSET} python3 -u \"$ENGINE_PY\" --fifo \"$FIFO_PATH\" ${ENGINE_ARGS} ${METRICS_ARGS}"
+    PLAY_CMD=""
+
 else
     echo "不明な OUTPUT_METHOD: $OUTPUT_METHOD"
     exit 1
@@ -267,161 +300,35 @@ if pgrep -f "${FIFO_PATH}" >/dev/null 2>&1; then
 fi
 
 # --- 曲切り替え時の自動リスタート機能 ---
-# MPD の player イベント（曲切り替え・停止・再生）を検出し、
-# SoX パイプラインを再起動して FIFO とエフェクト状態をリセットする。
+# MPD の player イベント（曲切り替え・停止・再生）を idle で受け取り、
+# パイプラインを停止 → FIFO フラッシュ → 再起動して FIFO とエフェクト状態をリセットする。
+# 監視とパイプライン管理は sox_supervisor.py (asyncio) が 1 プロセスで行う
+# (MPD の接続は sox_mpd.py の共有 idle クライアント。切断時はバックオフして再接続)
+# (シグナルファイルのポーリングは行わないので、反応はイベント到着から数 ms)。
 # TRACK_CHANGE_RESTART=1 で有効（デフォルト有効）、0 で従来の一発実行モード。
 TRACK_CHANGE_RESTART="${TRACK_CHANGE_RESTART:-1}"
 # MPD を曲切り替え時に再起動するか (1=yes, 0=no). デフォルト: 無効（連続再生での停止を避けるため）
 MPD_RESTART_ON_TRACK="${MPD_RESTART_ON_TRACK:-0}"
 
-start_sox_pipeline() {
-    echo "Executing Sox chain:"
-    echo "$SOX_FULL_COMMAND $PLAY_CMD"
-    # shellcheck disable=SC2086
-    # nice -n -5: SoX 処理の優先度を上げて underrun 防止
-    eval "nice -n -5 $SOX_FULL_COMMAND $PLAY_CMD" &
-    SOX_PID=$!
-    echo "Sox pipeline started (PID=$SOX_PID)"
-    # ionice: I/O 優先度を realtime に設定
-    ionice -c1 -p "$SOX_PID" 2>/dev/null || true
-}
-
-stop_sox_pipeline() {
-    if [ -n "$SOX_PID" ] && kill -0 "$SOX_PID" 2>/dev/null; then
-        echo "Stopping sox pipeline (PID=$SOX_PID)..."
-        kill "$SOX_PID" 2>/dev/null
-        wait "$SOX_PID" 2>/dev/null || true
-    fi
-    # aplay が残っている場合も停止
-    pkill -f "aplay.*${PLAY_DEVICE}" 2>/dev/null || true
-    SOX_PID=""
-}
-
-flush_fifo() {
-    # FIFO に残っているデータを捨てる（ノンブロッキング読み出し）
-    dd if="$FIFO_PATH" of=/dev/null bs=65536 iflag=nonblock 2>/dev/null || true
-}
-
-# クリーンアップ用トラップ
-cleanup() {
-    echo "Shutting down..."
-    stop_sox_pipeline
-    # Python 監視プロセスも停止
-    [ -n "$MONITOR_PID" ] && kill "$MONITOR_PID" 2>/dev/null || true
-    exit 0
-}
-trap cleanup SIGTERM SIGINT SIGHUP
-
 if [ "$TRACK_CHANGE_RESTART" = "1" ]; then
     echo "=== 曲切り替え自動リスタートモード (TRACK_CHANGE_RESTART=1) ==="
-
-    # MPD の player イベントを監視して曲切り替え時にシグナルファイルに書き込む Python スクリプト
-    SIGNAL_FILE="/tmp/sox_track_change.signal"
-    rm -f "$SIGNAL_FILE"
-
-    MPD_MONITOR_SCRIPT='
-import mpd, sys, time, os, subprocess
-signal_file = sys.argv[1]
-# restart flag is passed as second arg: "1" to enable restarting mpd on track changes
-restart_flag = len(sys.argv) > 2 and sys.argv[2] == "1"
-last_restart = 0.0
-THROTTLE_SECONDS = 1.0
-while True:
-    try:
-        c = mpd.MPDClient()
-        c.connect("localhost", 6600)
-        st = c.status()
-        last_songid = st.get("songid", "")
-        last_state = st.get("state", "stop")
-        print("MPD_MONITOR: INIT songid=" + last_songid + " state=" + last_state, flush=True)
-        while True:
-            c.idle("player")
-            st = c.status()
-            state = st.get("state", "stop")
-            songid = st.get("songid", "")
-            now = time.time()
-            if state == "stop":
-                print("MPD_MONITOR: STOPPED", flush=True)
-                with open(signal_file, "w") as f:
-                    f.write("STOPPED\n")
-            elif songid != last_songid:
-                print("MPD_MONITOR: TRACK:" + songid + " (prev_state=" + last_state + " state=" + state + ")", flush=True)
-                # Restart mpd only when a track change occurs during continuous playback (play -> play)
-                if restart_flag and last_state == "play" and state == "play":
-                    if now - last_restart > THROTTLE_SECONDS:
-                        print("MPD_MONITOR: Restarting mpd between consecutive tracks", flush=True)
-                        try:
-                            subprocess.run(["/bin/systemctl", "restart", "mpd"], check=False)
-                        except Exception as ex:
-                            print("MPD_MONITOR: Failed to restart mpd: " + str(ex), flush=True, file=sys.stderr)
-                        last_restart = now
-                with open(signal_file, "w") as f:
-                    f.write("TRACK:" + songid + ":" + state + "\n")
-                last_songid = songid
-            last_state = state
-    except Exception as e:
-        print("MPD_MONITOR: ERROR: " + str(e), flush=True, file=sys.stderr)
-        time.sleep(2)
-'
-
-    # MPD 監視をバックグラウンドで起動
-    python3 -u -c "$MPD_MONITOR_SCRIPT" "$SIGNAL_FILE" "$MPD_RESTART_ON_TRACK" &
-    MONITOR_PID=$!
-    echo "MPD monitor started (PID=$MONITOR_PID) (MPD_RESTART_ON_TRACK=$MPD_RESTART_ON_TRACK)"
-
-    # パイプラインを初回起動
-    start_sox_pipeline
-
-    # メインループ: シグナルファイルをポーリングして曲切り替えを検出
-    while true; do
-        # 監視プロセスが死んでいたら再起動
-        if ! kill -0 "$MONITOR_PID" 2>/dev/null; then
-            echo "警告: MPD monitor が停止しました。再起動します..."
-            python3 -u -c "$MPD_MONITOR_SCRIPT" "$SIGNAL_FILE" "$MPD_RESTART_ON_TRACK" &
-            MONITOR_PID=$!
-        fi
-
-        # シグナルファイルをチェック
-        if [ -f "$SIGNAL_FILE" ]; then
-            EVENT=$(cat "$SIGNAL_FILE" 2>/dev/null)
-            rm -f "$SIGNAL_FILE"
-            case "$EVENT" in
-                TRACK:*)
-                    # EVENT format: TRACK:<songid>:<state>
-                    TRACK_INFO=${EVENT#TRACK:}
-                    SONGID=${TRACK_INFO%%:*}
-                    STATE=${TRACK_INFO#*:}
-                    echo ">>> 曲が切り替わりました ($EVENT) — state=$STATE — SoX パイプライン処理を判断します"
-                    # 連続再生（play -> play）の場合は SoX 再起動をスキップして gapless を優先
-                    if [ "${LAST_TRACK_STATE}" = "play" ] && [ "$STATE" = "play" ]; then
-                        echo ">>> 連続再生の曲切替を検出 — SoX の再起動をスキップします"
-                    else
-                        echo ">>> SoX パイプラインを再起動します"
-                        stop_sox_pipeline
-                        flush_fifo
-                        sleep 0.05
-                        start_sox_pipeline
-                    fi
-                    LAST_TRACK_STATE="$STATE"
-                    ;;
-                STOPPED*)
-                    echo ">>> MPD 停止 — SoX パイプラインを停止します"
-                    stop_sox_pipeline
-                    LAST_TRACK_STATE="stop"
-                    ;;
-            esac
-        fi
-
-        # SoX パイプラインが予期せず死んでいたら再起動
-        if [ -n "$SOX_PID" ] && ! kill -0 "$SOX_PID" 2>/dev/null; then
-            echo "警告: SoX パイプラインが停止しました。再起動します..."
-            flush_fifo
-            sleep 0.1
-            start_sox_pipeline
-        fi
-
-        sleep 0.2
-    done
+    SUPERVISOR_PY="$(dirname "$SCRIPT_PATH")/sox_supervisor.py"
+    SUPERVISOR_OPTS="${METRICS_ARGS}"
+    [ "$MPD_RESTART_ON_TRACK" = "1" ] && SUPERVISOR_OPTS="${SUPERVISOR_OPTS} --restart-mpd"
+    # クロスフィード時はエンジン (--autotune) が自分でバッファを調整する
+    if [ "$BUFFER_AUTOTUNE" = "1" ] && [ "$OUTPUT_METHOD" == "aplay" ] && [ "$CROSSFEED_ENABLED" != "true" ]; then
+        SUPERVISOR_OPTS="${SUPERVISOR_OPTS} --autotune --device ${PLAY_DEVICE} --rate ${OUT_RATE}"
+    fi
+    if [ "$OUTPUT_METHOD" == "engine" ]; then
+        # エンジンは supervisor 内のスレッドで常駐し、曲切り替え/停止/一時停止ではプロセスを
+        # 作り直さずに出力バッファ破棄とフィルター状態のリセットだけを行う (1 ブロック以内)
+        eval "exec nice -n -15 ${TASKSET} python3 -u \"$SUPERVISOR_PY\" --fifo \"$FIFO_PATH\" $SUPERVISOR_OPTS --engine ${ENGINE_ARGS}"
+    fi
+    # nice -n -5: パイプラインの優先度を上げて underrun 防止
+    # exec: systemd の SIGTERM を supervisor が直接受け取り、パイプラインを停止する
+    # shellcheck disable=SC2086
+    exec python3 -u "$SUPERVISOR_PY" --fifo "$FIFO_PATH" $SUPERVISOR_OPTS \
+        --command "nice -n -5 $SOX_FULL_COMMAND $PLAY_CMD"
 
 else
     # --- 従来モード: 一発実行 ---
@@ -0,0 +1,634 @@
+"""Album art lookup for sox_gui.py: a background fetch queue over a persistent disk cache.
+
+``ArtFetcher.request(song)`` returns at once; one worker thread resolves the
+art and hands the image bytes (or None) to the callback.  Only the newest
+request matters: a song change while a lookup is running makes its result
+stale, and queued older requests are skipped.
+
+Lookup for a song:
+
+1. the disk cache (``ArtCache``), keyed by the normalized
+   ``extract_main_artist(artist)`` + album, or by the ``albumart`` tag or
+   the song URI when the song has no artist/album;
+2. otherwise all providers at once, the first image found wins: the local
+   ones (the ``albumart`` tag as URL or file, MPD's ``readpicture`` /
+   ``albumart`` for the song URI, ``cover.jpg`` & co. in the song's folder
+   under MPD_MUSIC_DIR) and the remote ones (the iTunes search API,
+   MusicBrainz + the Cover Art Archive).
+
+``MpdArtSource`` asks MPD on a connection of its own, so a large picture
+never holds up the shared idle connection of sox_mpd.MpdEvents.  The
+picture arrives in ``binarylimit``-sized chunks that are read straight into
+one buffer of the announced size.
+
+HTTP goes through one ``HttpClient``: a pooled keep-alive
+``requests.Session`` that also spaces requests per host
+(``HOST_MIN_INTERVAL``; MusicBrainz allows one request per second).  The
+service URLs can be pointed at a local stub server with the SOX_ITUNES_URL /
+SOX_MUSICBRAINZ_URL / SOX_COVERART_URL environment variables:
+
+    python3 sox_albumart.py --artist ARTIST --album ALBUM [--file URI] [-o cover.jpg]
+
+A found image is stored as the original bytes plus square JPEG variants
+(``VARIANT_SIZES``), so a repeat play loads a small file and makes no
+network call.  When every provider answered "not found" the miss is cached
+too, for MISS_TTL_S; network errors are not cached.  The cache keeps at
+most MAX_CACHE_BYTES, evicting the least recently shown albums.
+
+``ArtRenderer`` turns image bytes into a square Pillow image of the label
+size on a small worker pool, so the Tk thread only wraps the result in a
+``PhotoImage``.  Rendered images are kept in memory per (image hash, size)
+together with the decoded, centre-cropped source, within RENDER_CACHE_BYTES
+(LRU); a window resize therefore only redoes the final rescale.
+"""
+import argparse
+import collections
+import functools
+import hashlib
+import io
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import unicodedata
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from sox_mpd import MPD_HOST, MPD_PORT, MpdConnection, MpdError
+
+logger = logging.getLogger("sox_gui")
+
+CACHE_DIR = os.path.expanduser("~/.cache/sox_gui/albumart")
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+MISS_TTL_S = 3 * 24 * 3600
+VARIANT_SIZES = (250, 500)
+REQUEST_TIMEOUT = 5
+RENDER_CACHE_BYTES = 32 * 1024 * 1024
+RENDER_WORKERS = 2
+# デコードした元画像の上限 (これより大きい表示は拡大になる)
+SOURCE_MAX_PX = 1600
+MUSICBRAINZ_USER_AGENT = "sox-gui/1.0 (tysbox@example.com)"
+ITUNES_SEARCH_URL = os.environ.get("SOX_ITUNES_URL", "https://itunes.apple.com/search")
+MUSICBRAINZ_URL = os.environ.get("SOX_MUSICBRAINZ_URL", "https://musicbrainz.org/ws/2/release/")
+COVERART_URL = os.environ.get("SOX_COVERART_URL", "https://coverartarchive.org/release/{mbid}/front-500.jpg")
+# ホストごとのリクエスト間隔の下限 (秒)
+HOST_MIN_INTERVAL = {"musicbrainz.org": 1.0, "coverartarchive.org": 0.2}
+HTTP_POOL_SIZE = 4
+# 全プロバイダを同時に問い合わせる
+LOOKUP_WORKERS = 4
+# MPD の music_directory (未設定ならフォルダ画像は探さない)
+MUSIC_DIR = os.environ.get("MPD_MUSIC_DIR", "")
+FOLDER_ART_NAMES = ("cover.jpg", "cover.png", "folder.jpg", "folder.png", "front.jpg", "front.png")
+# 埋め込み画像 → フォルダの画像 (MPD 側の music_directory で探す)
+MPD_ART_COMMANDS = ("readpicture", "albumart")
+# 1 応答あたりのバイナリの上限 (MPD の既定は 8 KiB)
+MPD_BINARY_LIMIT = 512 * 1024
+
+
+def extract_main_artist(artist_field):
+    """
+    複数アーティストが混在するartistフィールドから、検索に適したメインアーティスト名を抽出
+    例:
+      'CHICK COREA; Christian McBride, CHICK COREA' → 'CHICK COREA'
+    """
+    if not artist_field:
+        return ""
+
+    # セミコロンで区切られていたら、最初のアーティストを使う
+    if ";" in artist_field:
+        return artist_field.split(";")[0].strip()
+
+    # カンマでも同様に分割
+    if "," in artist_field:
+        return artist_field.split(",")[0].strip()
+
+    return artist_field.strip()
+
+
+def _normalize(text):
+    # 全角/半角・大文字/小文字・空白の違いを吸収する
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def art_key(song):
+    """Cache key of a song (MPD ``currentsong`` dict); None if there is nothing to look up by."""
+    artist = extract_main_artist(song.get("artist", ""))
+    album = song.get("album", "")
+    if artist and album:
+        text = f"album\0{_normalize(artist)}\0{_normalize(album)}"
+    elif song.get("albumart"):
+        text = f"uri\0{song['albumart']}"
+    elif song.get("file"):
+        text = f"file\0{song['file']}"
+    else:
+        return None
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def square_variant(data, size):
+    """Centre-cropped ``size`` x ``size`` JPEG of an image (Pillow, imported on first use)."""
+    from PIL import Image
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    w, h = img.size
+    m = min(w, h)
+    img = img.crop(((w - m) // 2, (h - m) // 2, (w + m) // 2, (h + m) // 2))
+    img = img.resize((size, size), Image.Resampling.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+class ArtCache:
+    """Directory of ``<key>.orig`` / ``<key>@<size>.jpg`` / ``<key>.miss`` files, LRU by mtime."""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, miss_ttl=MISS_TTL_S):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.miss_ttl = miss_ttl
+
+    def _path(self, key, variant):
+        return os.path.join(self.cache_dir, key + variant)
+
+    def is_miss(self, key):
+        """True while a cached "not found" for ``key`` is younger than ``miss_ttl``."""
+        try:
+            return time.time() - os.stat(self._path(key, ".miss")).st_mtime < self.miss_ttl
+        except OSError:
+            return False
+
+    def get(self, key, size=None):
+        """Bytes of the smallest variant at least ``size`` px (else the original); None on a miss."""
+        candidates = [f"@{s}.jpg" for s in VARIANT_SIZES if size and s >= size] + [".orig"]
+        for variant in candidates:
+            path = self._path(key, variant)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                continue
+            self._touch(key)
+            return data
+        return None
+
+    def _touch(self, key):
+        # LRU: 表示したアルバムのファイルの mtime を更新する
+        for variant in [".orig"] + [f"@{s}.jpg" for s in VARIANT_SIZES]:
+            try:
+                os.utime(self._path(key, variant))
+            except OSError:
+                pass
+
+    def _write(self, key, variant, data):
+        path = self._path(key, variant)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def put(self, key, data):
+        """Store the original image and its variants (variants that fail to decode are skipped)."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._write(key, ".orig", data)
+        for size in VARIANT_SIZES:
+            try:
+                self._write(key, f"@{size}.jpg", square_variant(data, size))
+            except Exception as e:
+                logger.debug("Album art variant %d px failed: %s", size, e)
+                break
+        try:
+            os.remove(self._path(key, ".miss"))
+        except OSError:
+            pass
+        self.evict(keep=key)
+
+    def put_miss(self, key):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._write(key, ".miss", b"")
+
+    def evict(self, keep=None):
+        """Remove the least recently used albums (except ``keep``) until the directory fits in ``max_bytes``."""
+        albums = {}
+        for entry in os.scandir(self.cache_dir):
+            key = entry.name.split("@")[0].split(".")[0]
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            size, mtime = albums.get(key, (0, 0.0))
+            albums[key] = (size + st.st_size, max(mtime, st.st_mtime))
+        total = sum(size for size, _ in albums.values())
+        for key, (size, _) in sorted(albums.items(), key=lambda kv: kv[1][1]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.split("@")[0].split(".")[0] == key:
+                    os.remove(entry.path)
+            total -= size
+            logger.debug("Evicted album art %s (%d bytes)", key, size)
+
+
+class HttpClient:
+    """Shared keep-alive session spacing requests per host by ``min_interval`` seconds."""
+
+    def __init__(self, min_interval=None, pool_size=HTTP_POOL_SIZE):
+        self.min_interval = dict(HOST_MIN_INTERVAL if min_interval is None else min_interval)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def _wait_turn(self, host):
+        interval = self.min_interval.get(host)
+        if not interval:
+            return
+        # 送信時刻を予約してからロックの外で待つ (同じホストへの並行リクエストは順番に並ぶ)
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, 0.0))
+            self._next_slot[host] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def get(self, url, **kwargs):
+        self._wait_turn(urllib.parse.urlsplit(url).hostname)
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        return self.session.get(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def fetch_url(http, url, headers=None):
+    """Image bytes at ``url``; None for 404, raises requests.RequestException otherwise."""
+    logger.debug("Fetching album art URL: %s", url)
+    response = http.get(url, headers=headers)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    logger.debug("Fetched album art: status=%s size=%s", response.status_code, len(response.content))
+    return response.content
+
+
+def fetch_from_itunes(http, artist, album):
+    logger.debug("iTunes lookup: %s - %s", artist, album)
+    response = http.get(ITUNES_SEARCH_URL, params={"term": f"{artist} {album}", "entity": "album", "limit": 1})
+    response.raise_for_status()
+    results = response.json().get("results")
+    art_url = results[0].get("artworkUrl100") if results else None
+    if not art_url:
+        logger.debug("iTunes: no artwork for %s - %s", artist, album)
+        return None
+    return fetch_url(http, art_url.replace("100x100", "600x600"))
+
+
+def fetch_from_musicbrainz(http, artist, album):
+    logger.debug("MusicBrainz lookup: %s - %s", artist, album)
+    headers = {"User-Agent": MUSICBRAINZ_USER_AGENT}
+    response = http.get(MUSICBRAINZ_URL,
+                        params={"query": f'"{album}" AND artist:"{artist}"', "fmt": "json", "limit": 1},
+                        headers=headers)
+    response.raise_for_status()
+    releases = response.json().get("releases", [])
+    if not releases:
+        logger.debug("MusicBrainz: no releases for %s - %s", artist, album)
+        return None
+    mbid = releases[0].get("id")
+    logger.debug("MusicBrainz release id: %s", mbid)
+    return fetch_url(http, COVERART_URL.format(mbid=mbid), headers)
+
+
+def fetch_from_tag(http, uri):
+    """The ``albumart`` tag: an http(s) URL or a local file."""
+    if uri.startswith("http"):
+        return fetch_url(http, uri)
+    if os.path.exists(uri):
+        with open(uri, "rb") as f:
+            return f.read()
+    return None
+
+
+def fetch_from_folder(uri, music_dir=None):
+    """``cover.jpg`` & co. (any case) in the folder of the song file ``uri`` (MPD ``file``)."""
+    if os.path.isabs(uri):
+        folder = os.path.dirname(uri)
+    elif music_dir or MUSIC_DIR:
+        folder = os.path.join(music_dir or MUSIC_DIR, os.path.dirname(uri))
+    else:
+        return None
+    try:
+        names = {entry.name.lower(): entry.path for entry in os.scandir(folder) if entry.is_file()}
+    except OSError:
+        return None
+    for name in FOLDER_ART_NAMES:
+        if name in names:
+            with open(names[name], "rb") as f:
+                return f.read()
+    return None
+
+
+class MpdArtSource:
+    """Embedded (``readpicture``) and folder (``albumart``) art over a dedicated, lazily opened MPD connection."""
+
+    def __init__(self, host=MPD_HOST, port=MPD_PORT):
+        self.host = host
+        self.port = port
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def fetch(self, uri):
+        """Image bytes MPD has for the song ``uri``; None if it has none."""
+        with self._lock:
+            try:
+                return self._fetch(uri)
+            except (OSError, ValueError):
+                # MPD は放置された接続を切る (connection_timeout): 1 回だけ繋ぎ直す
+                self.close()
+            return self._fetch(uri)
+
+    def _fetch(self, uri):
+        if self._conn is None:
+            conn = MpdConnection(self.host, self.port)
+            try:
+                conn.command("binarylimit", MPD_BINARY_LIMIT)
+            except MpdError:
+                pass  # MPD 0.22.4 より前: 既定の 8 KiB のまま
+            self._conn = conn
+        for command in MPD_ART_COMMANDS:
+            try:
+                data = self._read_binary(command, uri)
+            except MpdError as e:
+                # 画像なし ("No file exists") や古い MPD の未対応コマンド
+                logger.debug("MPD %s %s: %s", command, uri, e)
+                continue
+            if data:
+                logger.debug("MPD %s: %d bytes for %s", command, len(data), uri)
+                return data
+        return None
+
+    def _read_binary(self, command, uri):
+        conn = self._conn
+        conn.send(command, uri, 0)
+        first = dict(conn.read_pairs())
+        chunk = first.get("binary", b"")
+        total = int(first.get("size", 0))
+        if not total or not chunk:
+            return None
+        # 全体の大きさは最初の応答で分かる: バッファは 1 回だけ確保し、以降のチャンクは直接読み込む
+        data = bytearray(total)
+        with memoryview(data) as view:
+            view[:len(chunk)] = chunk
+            offset = len(chunk)
+            while offset < total:
+                conn.send(command, uri, offset)
+                n = dict(conn.read_pairs(binary_into=view[offset:])).get("binary", 0)
+                if not n:
+                    raise ValueError(f"MPD {command} returned no data at offset {offset} of {total}")
+                offset += n
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def providers_for(song, http, mpd=None):
+    """Zero-argument provider calls for a song: local sources first, then the remote services."""
+    providers = []
+    if song.get("albumart"):
+        providers.append(functools.partial(fetch_from_tag, http, song["albumart"]))
+    if song.get("file") and "://" not in song["file"]:
+        if mpd is not None:
+            providers.append(functools.partial(mpd.fetch, song["file"]))
+        providers.append(functools.partial(fetch_from_folder, song["file"]))
+    artist = extract_main_artist(song.get("artist", ""))
+    album = song.get("album", "")
+    if artist and album:
+        providers += [functools.partial(fetch_from_itunes, http, artist, album),
+                      functools.partial(fetch_from_musicbrainz, http, artist, album)]
+    return providers
+
+
+def lookup(song, http, executor, mpd=None):
+    """Image bytes for a song from all providers at once (no cache); None if none has it.
+
+    The first provider returning an image wins; the others finish in the
+    background and their results are dropped.  Raises
+    ``requests.RequestException`` / ``OSError`` when no provider had it and
+    at least one of them failed, so that the miss is not cached.
+    """
+    error = None
+    futures = {executor.submit(provider): provider.func.__name__ for provider in providers_for(song, http, mpd)}
+    try:
+        for future in as_completed(futures):
+            try:
+                data = future.result()
+            except (requests.RequestException, OSError, ValueError) as e:
+                logger.debug("%s error: %s", futures[future], e)
+                error = e
+                continue
+            if data:
+                logger.debug("Album art from %s", futures[future])
+                return data
+    finally:
+        # まだ始まっていない問い合わせは取り消す
+        for future in futures:
+            future.cancel()
+    if error is not None:
+        raise error
+    return None
+
+
+class ArtFetcher:
+    """Worker thread resolving album art for the newest requested song."""
+
+    def __init__(self, callback, cache=None, http=None, mpd=None):
+        self.callback = callback
+        self.cache = cache or ArtCache()
+        self.http = http or HttpClient()
+        self.mpd = mpd or MpdArtSource()
+        self._lookups = ThreadPoolExecutor(LOOKUP_WORKERS, thread_name_prefix="albumart-lookup")
+        self._queue = queue.Queue()
+        self._generation = 0
+        # request() は Tk スレッド以外 (MPD イベント) からも呼ばれる
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._worker, name="albumart", daemon=True)
+        self._thread.start()
+
+    def request(self, song, size=None):
+        """Queue a lookup (``song`` = MPD ``currentsong`` dict, None = no song); returns at once."""
+        with self._lock:
+            self._generation += 1
+            self._queue.put((self._generation, song, size))
+
+    def _current(self, generation):
+        return generation == self._generation
+
+    def _worker(self):
+        while True:
+            generation, song, size = self._queue.get()
+            if not self._current(generation):
+                continue
+            try:
+                data = self._resolve(song, size)
+            except Exception as e:
+                logger.error("アルバムアート取得中に予期せぬエラー: %s", e, exc_info=True)
+                data = None
+            # 取得中に曲が変わっていたら結果は捨てる
+            if self._current(generation):
+                self.callback(data)
+
+    def _resolve(self, song, size):
+        key = art_key(song) if song else None
+        if key is None:
+            return None
+        data = self.cache.get(key, size)
+        if data is not None:
+            logger.debug("Album art cache hit: %s", key)
+            return data
+        if self.cache.is_miss(key):
+            logger.debug("Album art cached miss: %s", key)
+            return None
+        try:
+            data = lookup(song, self.http, self._lookups, self.mpd)
+        except (requests.RequestException, OSError, ValueError) as e:
+            logger.warning("アルバムアート取得に失敗しました (再試行します): %s", e)
+            return None
+        try:
+            if not data:
+                logger.warning("アルバムアートが見つかりませんでした: %s - %s",
+                               song.get("artist", ""), song.get("album", ""))
+                self.cache.put_miss(key)
+                return None
+            self.cache.put(key, data)
+        except OSError as e:
+            logger.warning("Could not write album art cache %s: %s", self.cache.cache_dir, e)
+            return data
+        return self.cache.get(key, size) or data
+
+
+def decode_square(data, max_px=SOURCE_MAX_PX):
+    """Decode image bytes to a centre-cropped RGBA square of at most ``max_px``."""
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    # JPEG は縮小デコードできる (2 のべき乗で max_px 以上を保つ)
+    img.draft("RGB", (max_px, max_px))
+    img = img.convert("RGBA")
+    w, h = img.size
+    m = min(w, h)
+    img = img.crop(((w - m) // 2, (h - m) // 2, (w + m) // 2, (h + m) // 2))
+    if m > max_px:
+        img = img.resize((max_px, max_px), Image.Resampling.LANCZOS)
+    return img
+
+
+class ArtRenderer:
+    """Decodes and resizes album art on a worker pool, caching results per (image hash, size)."""
+
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES, workers=RENDER_WORKERS):
+        self.max_bytes = max_bytes
+        self.latest = 0
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="albumart-render")
+        # (digest, size) -> image; size None = デコード・切り抜き済みの元画像
+        self._cache = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def render(self, data, size, callback):
+        """Queue ``data`` for display at ``size`` px; returns a token.
+
+        ``callback(image, token)`` runs on a worker thread with a Pillow
+        image (None if it could not be decoded), unless a newer render was
+        requested in the meantime (``token != self.latest``).
+        """
+        with self._lock:
+            self.latest += 1
+            token = self.latest
+        self._pool.submit(self._render, data, size, token, callback)
+        return token
+
+    def _get(self, key):
+        with self._lock:
+            img = self._cache.get(key)
+            if img is not None:
+                self._cache.move_to_end(key)
+            return img
+
+    def _put(self, key, img):
+        nbytes = img.width * img.height * len(img.getbands())
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = img
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and len(self._cache) > 1:
+                _, old = self._cache.popitem(last=False)
+                self._bytes -= old.width * old.height * len(old.getbands())
+
+    def _render(self, data, size, token, callback):
+        if token != self.latest:
+            return
+        try:
+            digest = hashlib.sha1(data).digest()
+            img = self._get((digest, size))
+            if img is None:
+                source = self._get((digest, None))
+                if source is None:
+                    source = decode_square(data)
+                    self._put((digest, None), source)
+                from PIL import Image
+                img = source if source.width == size else source.resize((size, size), Image.Resampling.LANCZOS)
+                self._put((digest, size), img)
+        except Exception as e:
+            logger.exception("画像データ処理エラー: %s", e)
+            img = None
+        if token == self.latest:
+            callback(img, token)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Look up album art like sox_gui.py (no cache)")
+    parser.add_argument("--artist", default="")
+    parser.add_argument("--album", default="")
+    parser.add_argument("--file", help="song URI (MPD readpicture/albumart, folder art under MPD_MUSIC_DIR)")
+    parser.add_argument("--host", default=MPD_HOST, help="MPD host for --file")
+    parser.add_argument("--port", type=int, default=MPD_PORT)
+    parser.add_argument("--no-mpd", action="store_true", help="do not ask MPD for the art of --file")
+    parser.add_argument("--albumart", help="albumart tag (URL or file)")
+    parser.add_argument("-o", "--output", help="write the image here")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s [%(levelname)s] %(threadName)s %(message)s")
+    song = {k: v for k, v in (("artist", args.artist), ("album", args.album), ("file", args.file),
+                              ("albumart", args.albumart)) if v}
+    http = HttpClient()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(LOOKUP_WORKERS) as executor:
+        try:
+            data = lookup(song, http, executor, None if args.no_mpd else MpdArtSource(args.host, args.port))
+        except (requests.RequestException, OSError, ValueError) as e:
+            print(f"error: {e}", file=sys.stderr)
+            return 2
+        elapsed = time.perf_counter() - t0
+    if not data:
+        print(f"not found ({elapsed * 1000:.0f} ms)", file=sys.stderr)
+        return 1
+    print(f"{len(data)} bytes in {elapsed * 1000:.0f} ms", file=sys.stderr)
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(data)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
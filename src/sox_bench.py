@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the engine's effect chains (no audio device, no MPD).
+
+Synthetic S32_LE / 192 kHz / stereo PCM is pushed block by block through
+each chain of the suite, with the same int32 <-> float conversion as
+sox_engine.py.  For every chain the report gives the realtime multiple
+(audio seconds per wall second), CPU time per stage, per-block processing
+time percentiles against the block deadline, and the process peak RSS so
+far, as JSON so results can be diffed across versions:
+
+    python3 sox_bench.py [--seconds 10] [--only 'eq-*'] [--script run_sox_fifo.sh [--settings FILE]] [-o bench.json]
+
+sox_gui.py runs ``--only 'resample-*'`` to show the CPU cost of each
+resampler quality tier (``resample_costs``).
+"""
+import argparse
+import fnmatch
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+from sox_dsp import CROSSFEED_PRESETS, RESAMPLE_QUALITY, build_chain
+from sox_engine import BASE_DIR, CHANNELS, INPUT_RATE, load_engine_settings, output_rate_for, to_int32
+from sox_eq import EQ_OUTPUT_EQ, MUSIC_TYPE_EQ
+from sox_fir import default_block_size
+from sox_fircache import FirCache
+from sox_ircache import IrCache
+from sox_rooms import ROOMS
+from sox_settings import SETTINGS_PATH
+
+logger = logging.getLogger("sox_engine")
+
+BASE_SETTINGS = {
+    "MUSIC_TYPE": "none",
+    "EQ_OUTPUT_TYPE": "none",
+    "GAIN": "0",
+    "NOISE_FIR_TYPE": "off",
+    "HARMONIC_FIR_TYPE": "off",
+    "CROSSFEED_ENABLED": "false",
+    "CROSSFEED_PRESET": "off",
+    "OUTPUT_DEVICE": "hw:0",
+    "RESAMPLE_QUALITY": "very-high",
+    "EFFECTS_TYPE": "none",
+    "OUTPUT_BITS": "32",
+}
+WARMUP_BLOCKS = 8
+
+
+def default_suite():
+    """``[(name, settings), ...]``: each option in isolation plus two worst-case chains."""
+    suite = [
+        ("passthrough", {}),
+        ("fir-noise", {"NOISE_FIR_TYPE": "default"}),
+        ("fir-harmonic", {"HARMONIC_FIR_TYPE": "dynamic"}),
+        ("fir-both", {"NOISE_FIR_TYPE": "default", "HARMONIC_FIR_TYPE": "dynamic"}),
+    ]
+    suite += [(f"music-{name}", {"MUSIC_TYPE": name}) for name in MUSIC_TYPE_EQ if name != "none"]
+    suite += [(f"eq-{name}", {"EQ_OUTPUT_TYPE": name}) for name in EQ_OUTPUT_EQ if name != "none"]
+    suite += [(f"crossfeed-{name}", {"CROSSFEED_ENABLED": "true", "CROSSFEED_PRESET": name})
+              for name in CROSSFEED_PRESETS]
+    suite += [(f"dither-{bits}", {"OUTPUT_BITS": bits}) for bits in ("24", "16")]
+    suite += [(f"room-{name}", {"EFFECTS_TYPE": name}) for name in ROOMS]
+    suite += [(f"resample-96k-{name}", {"OUTPUT_DEVICE": "bluealsa", "RESAMPLE_QUALITY": name})
+              for name in RESAMPLE_QUALITY]
+    heavy = {"MUSIC_TYPE": "jazz", "NOISE_FIR_TYPE": "strong", "HARMONIC_FIR_TYPE": "dynamic",
+             "EQ_OUTPUT_TYPE": "Tube-Warmth", "EFFECTS_TYPE": "Wembley-Studium",
+             "CROSSFEED_ENABLED": "true", "CROSSFEED_PRESET": "default"}
+    suite.append(("full-192k", heavy))
+    suite.append(("full-96k", dict(heavy, OUTPUT_DEVICE="bluealsa")))
+    return [(name, dict(BASE_SETTINGS, **overrides)) for name, overrides in suite]
+
+
+def synthetic_pcm(seconds=1.0, seed=0):
+    """Band-limited noise at about -12 dBFS as interleaved S32_LE bytes."""
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((int(INPUT_RATE * seconds), CHANNELS)) * 0.25
+    x = np.cumsum(x, axis=0) * 0.05
+    x -= x.mean(axis=0)
+    x /= max(1.0, np.abs(x).max() * 4.0)
+    return to_int32(x).tobytes()
+
+
+def _percentiles(values_ms):
+    v = np.asarray(values_ms)
+    result = {f"p{p}": round(float(np.percentile(v, p)), 4) for p in (50, 90, 99)}
+    result["max"] = round(float(v.max()), 4)
+    return result
+
+
+def bench_chain(name, settings, pcm, seconds, fir_base, block=None, fir_cache=None, ir_cache=None):
+    """Run one chain for ``seconds`` of audio and return its result dict."""
+    device = settings.get("OUTPUT_DEVICE", "hw:0")
+    out_rate = output_rate_for(device)
+    block = block or default_block_size(device, INPUT_RATE)
+    t0 = time.perf_counter()
+    chain = build_chain(settings, fir_base, INPUT_RATE, out_rate, CHANNELS, block_size=block, fir_cache=fir_cache,
+                        ir_cache=ir_cache, output_bits=int(settings.get("OUTPUT_BITS", 32)))
+    build_ms = (time.perf_counter() - t0) * 1000.0
+
+    frame_bytes = CHANNELS * 4
+    pcm_frames = len(pcm) // frame_bytes
+    total_blocks = WARMUP_BLOCKS + int(seconds * INPUT_RATE) // block
+    stage_cpu = [0.0] * len(chain.stages)
+    convert_cpu = 0.0
+    block_ms = []
+    out_frames = 0
+    pos = 0
+    wall = cpu = 0.0
+    for n in range(total_blocks):
+        if pos + block > pcm_frames:
+            pos = 0
+        raw = np.frombuffer(pcm, dtype="<i4", count=block * CHANNELS, offset=pos * frame_bytes)
+        pos += block
+        w0, c0 = time.perf_counter(), time.thread_time()
+        x = raw.reshape(block, CHANNELS) / 2147483648.0
+        c1 = time.thread_time()
+        for i, stage in enumerate(chain.stages):
+            s0 = time.thread_time()
+            x = stage.process(x)
+            if n >= WARMUP_BLOCKS:
+                stage_cpu[i] += time.thread_time() - s0
+            if not len(x):
+                break
+        # int32 への変換は最後の GainDitherStage に含まれる
+        w3, c3 = time.perf_counter(), time.thread_time()
+        if n >= WARMUP_BLOCKS:
+            convert_cpu += c1 - c0
+            block_ms.append((w3 - w0) * 1000.0)
+            wall += w3 - w0
+            cpu += c3 - c0
+            out_frames += len(x)
+
+    audio_s = (total_blocks - WARMUP_BLOCKS) * block / float(INPUT_RATE)
+    deadline_ms = block * 1000.0 / INPUT_RATE
+    stages = [{"stage": s.name, "cpu_s": round(t, 6), "share": round(t / cpu, 4) if cpu else 0.0}
+              for s, t in zip(chain.stages, stage_cpu)]
+    stages.append({"stage": "convert", "cpu_s": round(convert_cpu, 6),
+                   "share": round(convert_cpu / cpu, 4) if cpu else 0.0})
+    return {
+        "name": name,
+        "settings": settings,
+        "chain": chain.describe(),
+        "block_frames": block,
+        "out_rate": out_rate,
+        "audio_seconds": round(audio_s, 3),
+        "out_frames": out_frames,
+        "build_ms": round(build_ms, 2),
+        "wall_s": round(wall, 6),
+        "cpu_s": round(cpu, 6),
+        "realtime_x": round(audio_s / wall, 2) if wall else None,
+        "stages": stages,
+        "block_ms": _percentiles(block_ms),
+        "deadline_ms": round(deadline_ms, 4),
+        "deadline_misses": int(sum(t > deadline_ms for t in block_ms)),
+        # Linux の ru_maxrss は KiB、プロセス全体のピーク (ここまでのチェインを含む)
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sox_engine effect chains offline")
+    parser.add_argument("--seconds", type=float, default=10.0, help="audio seconds per chain")
+    parser.add_argument("--block", type=int, default=None, help="frames per block (default: per device class)")
+    parser.add_argument("--only", action="append", default=[], help="glob on chain names (repeatable)")
+    parser.add_argument("--script", help="also benchmark the settings of this run_sox_fifo.sh")
+    parser.add_argument("--settings", default=SETTINGS_PATH, help="with --script: the GUI settings file over it")
+    parser.add_argument("--firs", default=BASE_DIR + "/", help="FIR_BASE_PATH (directory with the .txt banks)")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the merged FIR / room IR caches")
+    parser.add_argument("-o", "--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    suite = default_suite()
+    if args.script:
+        script_settings = load_engine_settings(args.script, args.settings)
+        suite.append(("script", dict(BASE_SETTINGS, **{k: v for k, v in script_settings.items()
+                                                         if k in BASE_SETTINGS})))
+    if args.only:
+        suite = [(n, s) for n, s in suite if any(fnmatch.fnmatch(n, pat) for pat in args.only)]
+    fir_base = os.path.join(args.firs, "")
+    fir_cache = None if args.no_cache else FirCache()
+    ir_cache = None if args.no_cache else IrCache()
+    pcm = synthetic_pcm()
+
+    results = []
+    for name, settings in suite:
+        result = bench_chain(name, settings, pcm, args.seconds, fir_base, args.block, fir_cache, ir_cache)
+        print(f"{name:28s} {result['realtime_x']:>9}x  p99 {result['block_ms']['p99']:.3f} ms"
+              f" / {result['deadline_ms']:.2f} ms  {result['chain']}", file=sys.stderr)
+        results.append(result)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": platform.node(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "input": {"format": "S32_LE", "rate": INPUT_RATE, "channels": CHANNELS},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""Per-device ALSA buffer auto-tuning (run_sox_fifo.sh BUFFER_AUTOTUNE=1).
+
+Instead of the two hardcoded aplay buffer settings (BlueALSA / everything
+else), each output device starts on a low-latency buffer and walks a ladder
+of power-of-two sizes:
+
+* an underrun steps the buffer up one rung and marks the old size as failed;
+* STEP_DOWN_AFTER_S seconds of playback without an underrun step it down one
+  rung, unless that rung has already failed on this device.
+
+So every device settles on the smallest size that has not underrun.  The
+learned size is stored per device in ``~/.sox_gui_config.json`` under
+``"device_buffers"`` (sox_gui.py leaves that key alone when it saves) and is
+reused at the next start.  Devices are keyed by what they are, not by card
+index: ``usb:<vendor>:<product>`` for USB audio, ``card:<id>[,<dev>]`` for
+other ALSA cards, ``bluealsa`` for Bluetooth, plus the output rate.
+
+The engine applies a step up immediately (the underrun has already broken
+the stream) and a step down only when MPD closes the FIFO.  In the aplay
+pipeline, sox_supervisor.py rewrites aplay's buffer options before each
+(re)start.
+
+    python3 sox_buftune.py get PLAY_DEVICE RATE    # prints "BUFFER_FRAMES PERIOD_FRAMES"
+    python3 sox_buftune.py list
+    python3 sox_buftune.py forget PLAY_DEVICE RATE # re-learn from the start size
+
+Standard library only: run_sox_fifo.sh and sox_gui.py import/run this without numpy/scipy.
+"""
+import glob
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger("sox_engine")
+
+CONFIG_FILE = os.path.expanduser("~/.sox_gui_config.json")
+CONFIG_KEY = "device_buffers"
+# デバイスごとの出力語長の手動設定 (sox_output.py bits)
+BITS_CONFIG_KEY = "device_bits"
+# sox_gui.py の save_config がディスク上の値を優先して残すキー
+ENGINE_CONFIG_KEYS = (CONFIG_KEY, BITS_CONFIG_KEY)
+
+LADDER = (2048, 4096, 8192, 16384, 32768, 65536, 131072)
+PERIODS_PER_BUFFER = 8
+STEP_DOWN_AFTER_S = 600.0
+PROC_ASOUND = "/proc/asound"
+
+_HW_RE = re.compile(r"hw:(?:CARD=)?([^,\s]+)(?:,(?:DEV=)?(\d+))?")
+
+
+def _read_proc(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _card_dir(card):
+    """/proc/asound/cardN for a card index or id (``1`` / ``DAC``)."""
+    if card.isdigit():
+        return os.path.join(PROC_ASOUND, f"card{card}")
+    for path in glob.glob(os.path.join(PROC_ASOUND, "card[0-9]*")):
+        if _read_proc(os.path.join(path, "id")) == card:
+            return path
+    return None
+
+
+def card_path(play_device):
+    """/proc/asound/cardN of a ``hw:``/``plughw:`` PCM name, or None."""
+    m = _HW_RE.search(play_device)
+    return _card_dir(m.group(1)) if m else None
+
+
+def device_id(play_device):
+    """Stable identity of an ALSA PCM name across reboots and USB re-plugs."""
+    if "bluealsa" in play_device.lower():
+        return "bluealsa"
+    m = _HW_RE.search(play_device)
+    if not m:
+        return play_device
+    card, dev = m.group(1), m.group(2)
+    suffix = f",{dev}" if dev and dev != "0" else ""
+    path = _card_dir(card)
+    if path:
+        usbid = _read_proc(os.path.join(path, "usbid"))
+        if usbid:
+            return f"usb:{usbid}{suffix}"
+        card_id = _read_proc(os.path.join(path, "id"))
+        if card_id:
+            return f"card:{card_id}{suffix}"
+    return f"card:{card}{suffix}"
+
+
+def device_key(play_device, rate):
+    return f"{device_id(play_device)}@{int(rate)}"
+
+
+def start_frames(play_device):
+    """First rung for a device that has not been tuned yet (BlueALSA has more jitter)."""
+    return 16384 if "bluealsa" in play_device.lower() else 8192
+
+
+def load_entries(config_path=CONFIG_FILE, section=CONFIG_KEY):
+    try:
+        with open(config_path) as f:
+            return json.load(f).get(section, {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def save_entry(key, entry, config_path=CONFIG_FILE, section=CONFIG_KEY):
+    """Read-modify-write ``config[section][key]`` atomically (the GUI owns the other keys)."""
+    try:
+        with open(config_path) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        config = {}
+    entries = config.setdefault(section, {})
+    if entry is None:
+        entries.pop(key, None)
+    else:
+        entries[key] = entry
+    dirpath = os.path.dirname(config_path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=dirpath)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(config, f, indent=4)
+        os.replace(tmp_path, config_path)
+    except OSError as e:
+        logger.warning("Could not save %s to %s: %s", section, config_path, e)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+class BufferTuner:
+    """Buffer size search for one device/rate; see the module docstring."""
+
+    def __init__(self, play_device, rate, min_frames=0, config_path=CONFIG_FILE):
+        self.key = device_key(play_device, rate)
+        self.rate = rate
+        self.config_path = config_path
+        # エンジンのブロック長より小さいバッファは試さない
+        self.ladder = [n for n in LADDER if n >= min_frames] or [LADDER[-1]]
+        entry = load_entries(config_path).get(self.key, {})
+        self.failed_frames = int(entry.get("failed_frames", 0))
+        self.buffer_frames = self._rung(int(entry.get("buffer_frames", start_frames(play_device))))
+        self.stable_s = 0.0
+        logger.info("Buffer auto-tune %s: %d frames (%s)", self.key, self.buffer_frames,
+                    "learned" if entry else "initial")
+
+    def _rung(self, frames):
+        for n in self.ladder:
+            if n >= frames:
+                return n
+        return self.ladder[-1]
+
+    @property
+    def period_frames(self):
+        return self.buffer_frames // PERIODS_PER_BUFFER
+
+    def latency_us(self):
+        return int(self.buffer_frames * 1_000_000 / self.rate)
+
+    def played(self, seconds):
+        self.stable_s += seconds
+
+    def on_xrun(self):
+        """An underrun at the current size; returns True if the buffer grew."""
+        self.failed_frames = max(self.failed_frames, self.buffer_frames)
+        self.stable_s = 0.0
+        bigger = [n for n in self.ladder if n > self.buffer_frames]
+        if not bigger:
+            self._save()
+            return False
+        return self._step(bigger[0], "underrun")
+
+    def maybe_step_down(self):
+        """After STEP_DOWN_AFTER_S clean seconds, try the next smaller rung; True if it changed."""
+        if self.stable_s < STEP_DOWN_AFTER_S:
+            return False
+        self.stable_s = 0.0
+        smaller = [n for n in self.ladder if self.failed_frames < n < self.buffer_frames]
+        if not smaller:
+            return False
+        return self._step(smaller[-1], f"stable for {STEP_DOWN_AFTER_S:.0f} s")
+
+    def _step(self, frames, why):
+        logger.info("Buffer auto-tune %s: %d -> %d frames (%s)", self.key, self.buffer_frames, frames, why)
+        self.buffer_frames = frames
+        self._save()
+        return True
+
+    def _save(self):
+        save_entry(self.key, {
+            "buffer_frames": self.buffer_frames,
+            "period_frames": self.period_frames,
+            "failed_frames": self.failed_frames,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, self.config_path)
+
+
+_BUFFER_OPT_RE = re.compile(r"--(?:buffer|period)-(?:size|time)=\d+")
+
+
+def with_buffer_args(command, buffer_frames, period_frames):
+    """Replace aplay's buffer/period options in a pipeline command line."""
+    stripped = _BUFFER_OPT_RE.sub("", command)
+    args = f"--buffer-size={buffer_frames} --period-size={period_frames}"
+    return re.sub(r"(\baplay\b)", r"\1 " + args, stripped, count=1)
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if args[:1] == ["get"] and len(args) == 3:
+        tuner = BufferTuner(args[1], int(args[2]))
+        print(tuner.buffer_frames, tuner.period_frames)
+        return 0
+    if args[:1] == ["forget"] and len(args) == 3:
+        save_entry(device_key(args[1], int(args[2])), None)
+        return 0
+    if args == ["list"]:
+        for key, entry in sorted(load_entries().items()):
+            print(f"{key:32s} buffer {entry.get('buffer_frames')} period {entry.get('period_frames')}"
+                  f" (failed <= {entry.get('failed_frames')}, {entry.get('updated')})")
+        return 0
+    print("usage: sox_buftune.py get|forget PLAY_DEVICE RATE | list", file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
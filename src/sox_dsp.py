@@ -0,0 +1,798 @@
+"""DSP stages for sox_engine.py (in-process replacement for the sox effect chain).
+
+Every stage works on float64 blocks shaped (frames, channels) scaled to +/-1.0
+(the final ``GainDitherStage`` returns int32) and keeps its own filter state
+between calls, so a stream can be processed block by block.  ``reset()``
+clears that state (e.g. after a track change).
+"""
+import logging
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal
+
+from sox_eq import eq_output_eq, music_type_eq
+from sox_fir import (HARMONIC_FIR_FILES, NOISE_FIR_FILES, NonUniformConvolver, PartitionedConvolver,
+                     fir_compensation_db, load_fir)
+from sox_ircache import build_ir, is_room
+from sox_rooms import sox_effect
+
+logger = logging.getLogger("sox_engine")
+
+# EQ を FIR カーネルに畳み込む際、インパルス応答をこのレベル (ピーク比) で打ち切る
+EQ_FOLD_TAIL_DB = -170.0
+# bs2b クロスフィード (cutoff Hz, feed dB)
+CROSSFEED_PRESETS = {
+    "default": (700, 4.5),
+    "cmoy": (650, 6.0),
+    "jmeier": (650, 9.5),
+}
+# リサンプラーの品質 (通過帯域幅, 阻止域減衰 dB)。run_sox_fifo.sh の RESAMPLE_QUALITY の case と揃える
+# fast ~ rate -l / medium ~ rate -h / very-high ~ rate -v -s -M -b 95
+RESAMPLE_QUALITY = {
+    "fast": (0.80, 100.0),
+    "medium": (0.95, 125.0),
+    "very-high": (0.95, 170.0),
+}
+DEFAULT_RESAMPLE_QUALITY = "very-high"
+# ResampleStage: up (down 入力あたりの出力数) がこれを超えるときだけ窓をコピーして 1 回の BLAS 行列積にする
+RESAMPLE_COPY_MIN_UP = 8
+# firs/ の係数が設計されたサンプルレート
+FIR_RATE = 192000
+
+
+def db_to_linear(db):
+    return 10.0 ** (db / 20.0)
+
+
+class Stage:
+    """Base class: ``process`` takes and returns a (frames, channels) block."""
+
+    name = "stage"
+
+    def process(self, x):
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+    def flush(self):
+        """End of stream: output for input held back in a partial block, or None if nothing is held."""
+        return None
+
+
+class GainStage(Stage):
+    name = "gain"
+
+    def __init__(self, db):
+        self.db = float(db)
+        self.scale = db_to_linear(self.db)
+
+    def process(self, x):
+        x *= self.scale
+        return x
+
+
+class FirStage(Stage):
+    """Streaming FIR (equivalent of SoX ``fir``) on the partitioned FFT convolver."""
+
+    name = "fir"
+
+    def __init__(self, taps, block_size=2048, channels=2):
+        self.convolver = PartitionedConvolver(taps, block_size, channels)
+
+    def reset(self):
+        self.convolver.reset()
+
+    def process(self, x):
+        return self.convolver.process(x)
+
+    def flush(self):
+        return self.convolver.flush()
+
+
+class ReverbStage(FirStage):
+    """EFFECTS_TYPE room: convolution with a stereo room IR (sox_ircache).
+
+    Multi-second IRs run on the non-uniform partitioned convolver, so the
+    stage adds no latency beyond the block and its cost grows with the log
+    of the IR length rather than linearly.
+    """
+
+    name = "reverb"
+
+    def __init__(self, ir, block_size=2048, channels=2):
+        self.convolver = NonUniformConvolver(ir, block_size, channels)
+
+
+def _parse_freq(text):
+    text = text.lower()
+    if text.endswith("k"):
+        return float(text[:-1]) * 1000.0
+    return float(text)
+
+
+def _parse_width(text, default_unit):
+    """Return (value, unit) for a SoX width like ``0.9q``, ``0.5s``, ``1o``, ``100h``."""
+    unit = default_unit
+    if text and text[-1] in "qsoh":
+        unit = text[-1]
+        text = text[:-1]
+    return float(text), unit
+
+
+def _width_to_q(freq, value, unit):
+    if unit == "q":
+        return value
+    if unit == "o":
+        return math.sqrt(2.0 ** value) / (2.0 ** value - 1.0)
+    if unit == "h":
+        return freq / value
+    raise ValueError(f"unsupported width unit: {unit}")
+
+
+def biquad_sos(kind, rate, freq, gain_db, width, unit):
+    """RBJ cookbook biquad as one normalised SOS row (same formulas as SoX)."""
+    w0 = 2.0 * math.pi * freq / rate
+    cos_w0 = math.cos(w0)
+    a = 10.0 ** (gain_db / 40.0)
+    if kind in ("lowshelf", "highshelf") and unit == "s":
+        alpha = math.sin(w0) / 2.0 * math.sqrt((a + 1.0 / a) * (1.0 / width - 1.0) + 2.0)
+    else:
+        alpha = math.sin(w0) / (2.0 * _width_to_q(freq, width, unit))
+
+    if kind == "peaking":
+        b = (1.0 + alpha * a, -2.0 * cos_w0, 1.0 - alpha * a)
+        den = (1.0 + alpha / a, -2.0 * cos_w0, 1.0 - alpha / a)
+    elif kind == "lowshelf":
+        sq = 2.0 * math.sqrt(a) * alpha
+        b = (a * ((a + 1) - (a - 1) * cos_w0 + sq),
+             2 * a * ((a - 1) - (a + 1) * cos_w0),
+             a * ((a + 1) - (a - 1) * cos_w0 - sq))
+        den = ((a + 1) + (a - 1) * cos_w0 + sq,
+               -2 * ((a - 1) + (a + 1) * cos_w0),
+               (a + 1) + (a - 1) * cos_w0 - sq)
+    elif kind == "highshelf":
+        sq = 2.0 * math.sqrt(a) * alpha
+        b = (a * ((a + 1) + (a - 1) * cos_w0 + sq),
+             -2 * a * ((a - 1) + (a + 1) * cos_w0),
+             a * ((a + 1) + (a - 1) * cos_w0 - sq))
+        den = ((a + 1) - (a - 1) * cos_w0 + sq,
+               2 * ((a - 1) - (a + 1) * cos_w0),
+               (a + 1) - (a - 1) * cos_w0 - sq)
+    elif kind == "lowpass":
+        b = ((1.0 - cos_w0) / 2.0, 1.0 - cos_w0, (1.0 - cos_w0) / 2.0)
+        den = (1.0 + alpha, -2.0 * cos_w0, 1.0 - alpha)
+    elif kind == "highpass":
+        b = ((1.0 + cos_w0) / 2.0, -(1.0 + cos_w0), (1.0 + cos_w0) / 2.0)
+        den = (1.0 + alpha, -2.0 * cos_w0, 1.0 - alpha)
+    else:
+        raise ValueError(f"unknown biquad type: {kind}")
+    a0 = den[0]
+    return np.array([b[0] / a0, b[1] / a0, b[2] / a0, 1.0, den[1] / a0, den[2] / a0])
+
+
+class BiquadStage(Stage):
+    """Cascade of second-order sections with state carried across blocks."""
+
+    name = "eq"
+
+    def __init__(self, sos, channels=2):
+        self.sos = np.atleast_2d(np.asarray(sos, dtype=np.float64))
+        self.channels = channels
+        self.reset()
+
+    def reset(self):
+        self._zi = np.zeros((self.sos.shape[0], 2, self.channels))
+
+    def process(self, x):
+        y, self._zi = signal.sosfilt(self.sos, x, axis=0, zi=self._zi)
+        return y
+
+
+def compile_eq(stages, channels=2):
+    """Merge each run of gain/biquad stages into one cascaded SOS stage.
+
+    A preset like ``gain -5 equalizer ... equalizer ...`` becomes a single
+    (sections, 6) matrix filtered in one ``sosfilt`` pass per block; the
+    gain is folded into the numerator of the first section.  Gain-only runs
+    stay a GainStage, nonlinear stages (overdrive, compand) keep their place.
+    """
+    out = []
+    run = []
+
+    def flush():
+        if not run:
+            return
+        db = sum(s.db for s in run if isinstance(s, GainStage))
+        sections = [s.sos for s in run if isinstance(s, BiquadStage)]
+        if sections:
+            sos = np.vstack(sections)
+            sos[0, :3] *= db_to_linear(db)
+            out.append(BiquadStage(sos, channels))
+        elif db:
+            out.append(GainStage(db))
+        run.clear()
+
+    for stage in stages:
+        if isinstance(stage, (GainStage, BiquadStage)):
+            run.append(stage)
+        else:
+            flush()
+            out.append(stage)
+    flush()
+    return out
+
+
+def _section_ir_length(row):
+    """Frames until a section's impulse response decays below EQ_FOLD_TAIL_DB."""
+    radius = max(abs(np.roots(row[3:])))
+    if radius >= 1.0:
+        return None
+    return int(math.ceil(EQ_FOLD_TAIL_DB / (20.0 * math.log10(radius)))) + 3
+
+
+def fold_eq_into_fir(taps, sos, block_size):
+    """Fold the sections of ``sos`` whose impulse response fits in the FIR's spare taps.
+
+    The last FFT partition of a kernel is usually only partly used; EQ
+    sections that decay within that slack can be convolved into the kernel
+    for free (same partition count, one sosfilt section less).  Returns
+    ``(taps, remaining_sos)``; ``remaining_sos`` is None when everything folded.
+    """
+    capacity = -(-len(taps) // block_size) * block_size
+    lengths = [(_section_ir_length(row), i) for i, row in enumerate(sos)]
+    folded = []
+    total = len(taps)
+    for n, i in sorted((n, i) for n, i in lengths if n is not None):
+        if total + n - 1 > capacity:
+            break
+        folded.append(i)
+        total += n - 1
+    if not folded:
+        return taps, sos
+    for i in folded:
+        impulse = np.zeros(lengths[i][0])
+        impulse[0] = 1.0
+        taps = np.convolve(taps, signal.sosfilt(sos[i], impulse))
+    rest = np.delete(sos, folded, axis=0)
+    return taps, (rest if len(rest) else None)
+
+
+class OverdriveStage(Stage):
+    """SoX ``overdrive gain colour``: cubic soft clip plus the same DC blocker."""
+
+    name = "overdrive"
+
+    def __init__(self, gain_db=20.0, colour=20.0, channels=2):
+        self.gain = db_to_linear(gain_db)
+        self.colour = colour / 200.0
+        self.channels = channels
+        self.reset()
+
+    def reset(self):
+        self._zi = np.zeros((1, self.channels))
+
+    def process(self, x):
+        d = x * self.gain + self.colour
+        d = np.where(d < -1.0, -2.0 / 3.0, np.where(d > 1.0, 2.0 / 3.0, d - d * d * d / 3.0))
+        # last_out = d - last_in + 0.995 * last_out
+        out, self._zi = signal.lfilter([1.0, -1.0], [1.0, -0.995], d, axis=0, zi=self._zi)
+        return x * 0.5 + out * 0.75
+
+
+class CompandStage(Stage):
+    """SoX ``compand attack,decay in,out,...`` with one envelope shared by all channels.
+
+    The envelope follower is recursive, so it runs on short sub-blocks (peak
+    per sub-block) and the resulting gain curve is interpolated per sample.
+    """
+
+    name = "compand"
+    SUB_BLOCK = 64
+
+    def __init__(self, rate, attack, decay, points):
+        sub = self.SUB_BLOCK
+        self.attack = 1.0 - math.exp(-sub / (rate * attack)) if attack > 0 else 1.0
+        self.decay = 1.0 - math.exp(-sub / (rate * decay)) if decay > 0 else 1.0
+        pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        # 最初/最後の点より外側は傾き 1 (ゲイン一定) で延長する
+        self._in_db = np.concatenate(([pts[0, 0] - 200.0], pts[:, 0], [pts[-1, 0] + 200.0]))
+        self._out_db = np.concatenate(([pts[0, 1] - 200.0], pts[:, 1], [pts[-1, 1] + 200.0]))
+        self.reset()
+
+    def reset(self):
+        self._volume = 0.0
+        self._last_gain = 1.0
+
+    def _gain_for(self, volume):
+        v_db = 20.0 * np.log10(np.maximum(volume, 1e-10))
+        return db_to_linear(np.interp(v_db, self._in_db, self._out_db) - v_db)
+
+    def process(self, x):
+        n = len(x)
+        if n == 0:
+            return x
+        sub = self.SUB_BLOCK
+        count = -(-n // sub)
+        peak = np.abs(x).max(axis=1)
+        pad = np.zeros(count * sub)
+        pad[:n] = peak
+        peaks = pad.reshape(count, sub).max(axis=1)
+        volumes = np.empty(count)
+        v = self._volume
+        for i, p in enumerate(peaks):
+            v += (p - v) * (self.attack if p > v else self.decay)
+            volumes[i] = v
+        self._volume = v
+        gains = self._gain_for(volumes)
+        # サブブロック境界間でゲインを線形補間 (ジッパーノイズ防止)
+        knots = np.concatenate(([self._last_gain], gains))
+        pos = np.arange(1, n + 1) / sub
+        g = np.interp(pos, np.arange(count + 1), knots)
+        self._last_gain = gains[-1]
+        return x * g[:, None]
+
+
+class ResampleStage(Stage):
+    """Streaming rational resampler (polyphase FIR with the filter state kept across blocks).
+
+    The default kernel approximates SoX ``rate -v -s -M -b 95``: linear
+    phase, 95% bandwidth and a very deep stopband starting at the lower
+    Nyquist.  The cheaper RESAMPLE_QUALITY tiers narrow the bandwidth and/or
+    the stopband depth, which shortens the kernel (fewer taps per output
+    sample).
+
+    The kernel is split into ``up`` phases of ``ceil(taps / up)`` taps.  Only
+    the last ``phase_taps - 1`` input frames are kept between blocks, and
+    each block computes just its own outputs in one matrix product: every
+    ``down`` input frames (plus the ``phase_taps - 1`` after them) times a
+    matrix holding each output phase's taps at its offset in that window.
+    ``flush`` feeds zeros to emit the whole filter tail, so the output is the
+    same as one ``upfirdn`` over the whole stream.
+    """
+
+    name = "resample"
+
+    def __init__(self, in_rate, out_rate, channels=2, bandwidth=0.95, attenuation_db=170.0):
+        g = math.gcd(int(in_rate), int(out_rate))
+        self.up = int(out_rate) // g
+        self.down = int(in_rate) // g
+        self.channels = channels
+        nyq = 0.5 * min(in_rate, out_rate)
+        fs = float(in_rate) * self.up
+        width = (1.0 - bandwidth) * nyq / (0.5 * fs)
+        numtaps, beta = signal.kaiserord(attenuation_db, width)
+        numtaps |= 1
+        cutoff = 0.5 * (1.0 + bandwidth) * nyq
+        self.taps = signal.firwin(numtaps, cutoff, window=("kaiser", beta), fs=fs) * self.up
+        # ポリフェーズ分解: 位相 p の係数 taps[p::up] を逆順に並べた行 (入力の窓との内積で 1 出力)
+        self.phase_taps = -(-numtaps // self.up)
+        padded = np.zeros(self.phase_taps * self.up)
+        padded[:numtaps] = self.taps
+        phases = padded.reshape(self.phase_taps, self.up).T[:, ::-1]
+        # down フレームごとの出力 r (0..up-1) は位相 (r*down)%up を入力の (r*down)//up フレーム目から掛ける。
+        # 全位相をその位置にずらして並べた (down-1+phase_taps, up) 行列にして 1 回の行列積で求める
+        self._span = self.down - 1 + self.phase_taps
+        self._matrix = np.zeros((self._span, self.up))
+        for r in range(self.up):
+            offset = r * self.down // self.up
+            self._matrix[offset:offset + self.phase_taps, r] = phases[r * self.down % self.up]
+        self._columns = np.ascontiguousarray(self._matrix.T)
+        self.reset()
+
+    def reset(self):
+        self._hist = np.zeros((self.phase_taps - 1, self.channels))
+        self._pending = np.zeros((0, self.channels))
+        self._fed = False
+
+    def process(self, x):
+        keep = self.phase_taps - 1
+        buf = np.concatenate((self._hist, self._pending, x))
+        self._fed = self._fed or len(x) > 0
+        # 入力は down フレーム単位で消費する (down 入力 -> up 出力)
+        usable = ((len(buf) - keep) // self.down) * self.down
+        if usable <= 0:
+            self._pending = buf[keep:]
+            return np.zeros((0, self.channels))
+        groups = usable // self.down
+        end = keep + usable
+        # windows[g] = buf[g*down:g*down + span] (コピーなしのビュー, (groups, channels, span))
+        windows = sliding_window_view(buf[:end], self._span, axis=0)[::self.down]
+        if self.up > RESAMPLE_COPY_MIN_UP:
+            # 出力の列が多いときは窓を連続した行にコピーして BLAS の行列積に渡す
+            y = (windows.reshape(-1, self._span) @ self._matrix).reshape(groups, self.channels, self.up)
+        else:
+            # 列が少ないと窓のコピー (入力の span/down 倍) が積和より高くつくので、ビューのまま列ごとに掛ける
+            y = np.stack([windows @ column for column in self._columns], axis=-1)
+        y = y.transpose(0, 2, 1).reshape(groups * self.up, self.channels)
+        self._hist = buf[end - keep:end]
+        self._pending = buf[end:]
+        return y
+
+    def flush(self):
+        if not self._fed:
+            return None
+        # upfirdn の出力の末尾 (フィルタの遅延ぶん) まで出す: 端数 n フレームのあとに 0 を通す
+        # (これまでの出力は down フレーム単位で消費した入力のぶんちょうど)
+        n = len(self._pending)
+        tail = max(0, -(-((n - 1) * self.up + len(self.taps)) // self.down))
+        y = self.process(np.zeros((-(-tail // self.up) * self.down - n, self.channels)))
+        self._fed = False
+        return y[:tail]
+
+
+class CrossfeedStage(Stage):
+    """bs2b crossfeed: one-pole lowpass on the opposite channel, high-boost on the direct one."""
+
+    name = "crossfeed"
+
+    def __init__(self, rate, cutoff=700, feed_db=4.5):
+        gb_lo = feed_db * -5.0 / 6.0 - 3.0
+        gb_hi = feed_db / 6.0 - 3.0
+        g_lo = db_to_linear(gb_lo)
+        g_hi = 1.0 - db_to_linear(gb_hi)
+        fc_hi = cutoff * 2.0 ** ((gb_lo - 20.0 * math.log10(g_hi)) / 12.0)
+        x = math.exp(-2.0 * math.pi * cutoff / rate)
+        self._lo = ([g_lo * (1.0 - x)], [1.0, -x])
+        x = math.exp(-2.0 * math.pi * fc_hi / rate)
+        self._hi = ([1.0 - g_hi * (1.0 - x), -x], [1.0, -x])
+        self.gain = 1.0 / (1.0 - g_hi + g_lo)
+        self.reset()
+
+    def reset(self):
+        self._zi_lo = np.zeros((1, 2))
+        self._zi_hi = np.zeros((1, 2))
+
+    def process(self, x):
+        lo, self._zi_lo = signal.lfilter(*self._lo, x, axis=0, zi=self._zi_lo)
+        hi, self._zi_hi = signal.lfilter(*self._hi, x, axis=0, zi=self._zi_hi)
+        # 両チャンネル同時: 直接音の high-boost + 反対チャンネルの lowpass
+        hi += lo[:, ::-1]
+        hi *= self.gain
+        return hi
+
+
+class GainDitherStage(Stage):
+    """Final gain + dither + conversion to int32 in one pass (SoX ``gain N dither -s``).
+
+    ``bits`` is the word length the DAC actually keeps; the samples are
+    quantized to it and written left-justified into S32_LE, so a 24-bit
+    DAC gets 24-bit dither instead of 32-bit rounding it throws away.  Below
+    32 bits the quantizer runs in a second-order error-feedback loop with
+    TPDF dither (+-1 LSB, drawn fresh for every block): each error
+    (dither included) is fed back so the output error is (1 - z^-1)^2
+    times it, rising 12 dB/octave, which at 96/192 kHz moves most of the
+    noise above the audio band.  The loop state is carried across blocks.
+
+    The recursion needs no per-sample loop: with this integer noise
+    transfer function the output's double running sum is the dithered,
+    rounded double running sum of the input, so
+    ``y = m + diff2(rint(cumsum2(f) + dither))`` where ``m`` is the input
+    rounded and ``f`` the remainder.
+    Only ``f`` is summed (and the sums rebased after every block by what
+    was already emitted), which keeps them small enough to stay exact.
+    Everything runs in place on the float block and preallocated buffers,
+    with one cast into a reused int32 buffer.
+    """
+
+    name = "dither"
+    out_dtype = np.int32
+
+    def __init__(self, gain_db=0.0, bits=32, channels=2, seed=0):
+        self.db = float(gain_db)
+        self.bits = int(bits)
+        self.channels = channels
+        # int32 のフルスケールへの変換も同じ乗算に含める
+        self.scale = 2147483648.0 * db_to_linear(self.db)
+        self.step = 2.0 ** (32 - self.bits)
+        self._rng = np.random.default_rng(seed) if self.bits < 32 else None
+        self._out = np.zeros((0, channels), dtype=np.int32)
+        self._noise = np.zeros((0, channels))
+        self._rounded = np.zeros((0, channels))
+        self.reset()
+
+    def reset(self):
+        # 誤差帰還ループの状態: f の 1 重 / 2 重の累積和 (出力済みの整数ぶんを差し引いた値)
+        self._sum1 = np.zeros(self.channels)
+        self._sum2 = np.zeros(self.channels)
+
+    def _quantize(self, x):
+        """``x`` (LSB units) -> integers through the error-feedback loop, in place."""
+        n = len(x)
+        if len(self._noise) < n:
+            self._noise = np.zeros((n, self.channels))
+            self._rounded = np.zeros((n, self.channels))
+        noise, m = self._noise[:n], self._rounded[:n]
+        # 整数部 m はそのまま出力に通し、残り f だけを 2 重に積分する
+        np.rint(x, out=m)
+        x -= m
+        np.cumsum(x, axis=0, out=x)
+        x += self._sum1
+        sum1 = x[-1].copy()
+        np.cumsum(x, axis=0, out=x)
+        x += self._sum2
+        sum2 = x[-1].copy()
+        # TPDF ディザー (一様乱数 2 つの差) は丸める直前に加え、量子化誤差ごと整形させる
+        self._rng.random(out=noise)
+        x += noise
+        self._rng.random(out=noise)
+        x -= noise
+        np.rint(x, out=noise)
+        # 次のブロックのために出力済みの整数 (最後の値と傾き) を差し引いておく
+        last = noise[-1].copy()
+        slope = last - noise[-2] if n > 1 else last
+        self._sum1 = sum1 - slope
+        self._sum2 = sum2 - last
+        # y = m + 2 階差分 (直前ブロックの丸め値は差し引き後 0)
+        np.add(m, noise, out=x)
+        x[1:] -= noise[:-1]
+        x[1:] -= noise[:-1]
+        x[2:] += noise[:-2]
+
+    def process(self, x):
+        if self._rng is not None:
+            # LSB 単位で誤差帰還つきで丸め、int32 のスケールに戻す
+            x *= self.scale / self.step
+            if len(x):
+                self._quantize(x)
+            x *= self.step
+        else:
+            x *= self.scale
+            np.rint(x, out=x)
+        np.clip(x, -2147483648.0, 2147483648.0 - self.step, out=x)
+        if len(self._out) < len(x):
+            self._out = np.zeros((len(x), self.channels), dtype=np.int32)
+        out = self._out[:len(x)]
+        np.copyto(out, x, casting="unsafe")
+        return out
+
+
+def parse_sox_effects(text, rate, channels=2):
+    """Translate a SoX effect string (as used in run_sox_fifo.sh) into stages.
+
+    Supported: gain, equalizer, bass, treble, lowpass, highpass (two-pole),
+    overdrive, compand.
+    Unknown effects are skipped with a warning.
+    """
+    tokens = text.split()
+    stages = []
+    i = 0
+
+    def is_number(tok):
+        try:
+            _parse_freq(tok.rstrip("qsoh"))
+            return True
+        except ValueError:
+            return False
+
+    while i < len(tokens):
+        name = tokens[i]
+        i += 1
+        args = []
+        while i < len(tokens) and (is_number(tokens[i]) or "," in tokens[i]):
+            args.append(tokens[i])
+            i += 1
+        if name == "gain":
+            stages.append(GainStage(float(args[0]) if args else 0.0))
+        elif name == "equalizer":
+            freq = _parse_freq(args[0])
+            width, unit = _parse_width(args[1], "h")
+            if freq >= 0.5 * rate:
+                logger.warning("equalizer %s Hz is above Nyquist at %d Hz; skipped", args[0], rate)
+                continue
+            sos = biquad_sos("peaking", rate, freq, float(args[2]), width, unit)
+            stages.append(BiquadStage(sos, channels))
+        elif name in ("bass", "treble"):
+            gain_db = float(args[0])
+            freq = _parse_freq(args[1]) if len(args) > 1 else (100.0 if name == "bass" else 3000.0)
+            width, unit = _parse_width(args[2], "s") if len(args) > 2 else (0.5, "s")
+            kind = "lowshelf" if name == "bass" else "highshelf"
+            stages.append(BiquadStage(biquad_sos(kind, rate, freq, gain_db, width, unit), channels))
+        elif name in ("lowpass", "highpass"):
+            freq = _parse_freq(args[0])
+            width, unit = _parse_width(args[1], "q") if len(args) > 1 else (math.sqrt(0.5), "q")
+            if freq >= 0.5 * rate:
+                logger.warning("%s %s Hz is above Nyquist at %d Hz; skipped", name, args[0], rate)
+                continue
+            stages.append(BiquadStage(biquad_sos(name, rate, freq, 0.0, width, unit), channels))
+        elif name == "overdrive":
+            gain_db = float(args[0]) if args else 20.0
+            colour = float(args[1]) if len(args) > 1 else 20.0
+            stages.append(OverdriveStage(gain_db, colour, channels))
+        elif name == "compand":
+            attack, decay = (float(v) for v in args[0].split(",")[:2])
+            points = [float(v) for v in args[1].split(",")]
+            stages.append(CompandStage(rate, attack, decay, points))
+        else:
+            logger.warning("Unsupported sox effect in engine, skipped: %s %s", name, " ".join(args))
+    return stages
+
+
+class EffectChain:
+    """Ordered list of stages; mirrors the EFFECT_CHAIN order of run_sox_fifo.sh."""
+
+    # 出力が入力から何ブロック遅れるか (sox_pipeline.StagedChain と共通のインターフェース)
+    latency_blocks = 0
+
+    def __init__(self, stages, in_rate, out_rate):
+        self.stages = stages
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+
+    def process(self, x):
+        for stage in self.stages:
+            x = stage.process(x)
+            if not len(x):
+                break
+        return x
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def flush(self):
+        """End of stream: push the frames held in partial blocks (FIR, resampler) through the rest of the chain.
+
+        Returns a list of output blocks, like ``StagedChain.flush``.
+        """
+        x = None
+        for stage in self.stages:
+            if x is not None and len(x):
+                x = stage.process(x)
+            tail = stage.flush()
+            if tail is not None and len(tail):
+                x = tail if x is None or not len(x) else np.concatenate((x, tail))
+        return [x] if x is not None and len(x) else []
+
+    def close(self):
+        pass
+
+    def describe(self):
+        return " -> ".join(s.name for s in self.stages)
+
+
+def fir_at_rate(taps, rate, fir_rate=FIR_RATE):
+    """Re-sample a FIR designed at ``fir_rate`` so it has the same response at ``rate``.
+
+    The impulse response is resampled and scaled by ``fir_rate / rate`` so the
+    DC gain is kept; content above the new Nyquist is dropped.
+    """
+    if int(rate) == int(fir_rate):
+        return taps
+    g = math.gcd(int(rate), int(fir_rate))
+    up, down = int(rate) // g, int(fir_rate) // g
+    return signal.resample_poly(np.asarray(taps, dtype=np.float64), up, down) * (fir_rate / float(rate))
+
+
+def _fir_then_eq(taps, eq_stages, block_size, channels):
+    """FirStage for ``taps`` followed by ``eq_stages``, with the leading gain/EQ folded in where free."""
+    eq_stages = list(eq_stages)
+    if eq_stages and isinstance(eq_stages[0], GainStage):
+        taps = taps * eq_stages.pop(0).scale
+    if eq_stages and isinstance(eq_stages[0], BiquadStage):
+        taps, rest = fold_eq_into_fir(taps, eq_stages[0].sos, block_size)
+        if rest is None:
+            eq_stages.pop(0)
+        else:
+            eq_stages[0] = BiquadStage(rest, channels)
+    return [FirStage(taps, block_size, channels)] + eq_stages
+
+
+def build_chain(settings, fir_base_path, in_rate, out_rate, channels=2, block_size=2048,
+                fir_cache=None, ir_cache=None, output_bits=32):
+    """Build the chain from script-style settings (MUSIC_TYPE, NOISE_FIR_TYPE, ...).
+
+    Order: noise FIR -> input EQ -> harmonic FIR -> output EQ -> room
+    (EFFECTS_TYPE) -> resample -> crossfeed -> gain + dither; the chain
+    returns int32 samples quantized to ``output_bits`` (``GainDitherStage``).
+    The resampler (RESAMPLE_QUALITY tier) is left out when the input rate
+    already equals the output rate.  For other
+    input rates than FIR_RATE the FIR kernels are resampled (``fir_at_rate``),
+    so a track is converted to the device rate in one pass.
+
+    ``block_size`` is the FIR partition size; feeding blocks of exactly that
+    many frames keeps the FIR stages from adding buffering latency.  Each EQ
+    preset is compiled into one SOS cascade (``compile_eq``), and EQ sections
+    that fit in a FIR's last partition are folded into its kernel.
+
+    With a ``fir_cache`` (sox_fircache.FirCache) and a linear input EQ (all
+    music types), both FIRs run as one pre-merged kernel: the input EQ is
+    LTI, so it commutes with the harmonic FIR and moves behind the kernel,
+    where it merges with the output EQ into a single cascade.
+
+    EFFECTS_TYPE rooms are convolved with their IR (``ReverbStage``), built
+    on first use by ``ir_cache`` (sox_ircache.IrCache) or, without one,
+    directly; ``vinyl`` is plain EQ and joins the output EQ cascade.
+    """
+    noise_type = settings.get("NOISE_FIR_TYPE", "off")
+    harmonic_type = settings.get("HARMONIC_FIR_TYPE", "off")
+    noise = NOISE_FIR_FILES.get(noise_type)
+    harmonic = HARMONIC_FIR_FILES.get(harmonic_type)
+    input_eq = compile_eq(parse_sox_effects(music_type_eq(settings.get("MUSIC_TYPE", "none")), in_rate, channels),
+                          channels)
+    effects_type = settings.get("EFFECTS_TYPE", "none")
+    output_eq = parse_sox_effects(eq_output_eq(settings.get("EQ_OUTPUT_TYPE", "none")), in_rate, channels)
+    if not is_room(effects_type):
+        output_eq += parse_sox_effects(sox_effect(effects_type), in_rate, channels)
+    output_eq = compile_eq(output_eq, channels)
+
+    try:
+        gain = float(settings.get("GAIN") or 0)
+    except ValueError:
+        gain = 0.0
+    total_gain = gain + fir_compensation_db(bool(noise), bool(harmonic))
+
+    def is_linear(eq):
+        return all(isinstance(s, (GainStage, BiquadStage)) for s in eq)
+
+    merged = None
+    if fir_cache is not None and noise and harmonic and is_linear(input_eq):
+        merged = fir_cache.get(fir_base_path, noise_type, harmonic_type)
+
+    if merged is not None:
+        taps, meta = merged
+        taps = fir_at_rate(taps, in_rate)
+        target_db = sum(s.db for s in input_eq if isinstance(s, GainStage))
+        # 出力 EQ が線形 (biquad/gain のみ) なら最終ゲインもカーネルに畳み込める
+        if is_linear(output_eq):
+            target_db += total_gain
+            total_gain = 0
+        taps = taps * db_to_linear(target_db - meta["folded_gain_db"])
+        post_eq = compile_eq([s for s in input_eq if isinstance(s, BiquadStage)] + output_eq, channels)
+        stages = _fir_then_eq(taps, post_eq, block_size, channels)
+    else:
+        stages = []
+        if noise:
+            stages.extend(_fir_then_eq(fir_at_rate(load_fir(fir_base_path + noise), in_rate), input_eq, block_size, channels))
+        else:
+            stages.extend(input_eq)
+        if harmonic:
+            stages.extend(_fir_then_eq(fir_at_rate(load_fir(fir_base_path + harmonic), in_rate), output_eq, block_size, channels))
+        else:
+            stages.extend(output_eq)
+
+    if is_room(effects_type):
+        ir_dir = fir_base_path + "ir"
+        ir = ir_cache.get(effects_type, in_rate, ir_dir) if ir_cache is not None else build_ir(effects_type, in_rate, ir_dir)
+        stages.append(ReverbStage(ir, block_size, channels))
+
+    if in_rate != out_rate:
+        quality = settings.get("RESAMPLE_QUALITY") or DEFAULT_RESAMPLE_QUALITY
+        bandwidth, attenuation_db = RESAMPLE_QUALITY.get(quality, RESAMPLE_QUALITY[DEFAULT_RESAMPLE_QUALITY])
+        stages.append(ResampleStage(in_rate, out_rate, channels, bandwidth, attenuation_db))
+
+    crossfeed = crossfeed_stage(settings, out_rate, channels)
+    if crossfeed is not None:
+        stages.append(crossfeed)
+
+    # 最終ゲインは線形なのでクロスフィードの後ろに回し、ディザー・int32 変換と 1 パスで行う
+    stages.append(GainDitherStage(total_gain, output_bits, channels))
+    return EffectChain(stages, in_rate, out_rate)
+
+
+def crossfeed_stage(settings, rate, channels=2):
+    """The CROSSFEED_PRESET stage, or None when crossfeed is off or not stereo."""
+    if settings.get("CROSSFEED_ENABLED") != "true" or channels != 2:
+        return None
+    preset = settings.get("CROSSFEED_PRESET", "default")
+    if preset == "off":
+        return None
+    cutoff, feed = CROSSFEED_PRESETS.get(preset, CROSSFEED_PRESETS["default"])
+    return CrossfeedStage(rate, cutoff, feed)
+
+
+def build_crossfeed_chain(settings, rate, channels=2, output_bits=32):
+    """Crossfeed-only chain for the aplay pipeline (``sox ... | sox_engine.py --chain crossfeed``).
+
+    sox has already done everything up to the gain at the device rate, so the
+    engine only applies bs2b and writes to ALSA itself, in place of the
+    former ``ecasound -el:bs2b | aplay`` pair.
+    """
+    stages = []
+    crossfeed = crossfeed_stage(settings, rate, channels)
+    if crossfeed is not None:
+        stages.append(crossfeed)
+    stages.append(GainDitherStage(0.0, output_bits, channels))
+    return EffectChain(stages, rate, rate)
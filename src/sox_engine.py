@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+"""In-process DSP engine: /tmp/mpd.fifo -> effect chain -> ALSA, in one process.
+
+Replaces the ``sox | aplay`` pipeline built by run_sox_fifo.sh
+(OUTPUT_METHOD="engine").  The effect settings are the GUI's saved
+settings file (sox_settings.py, ``--settings``) over the ``KEY="value"``
+defaults of run_sox_fifo.sh (``load_engine_settings``).
+
+While running, the engine watches the control file (CTL_PATH, /tmp/sox.ctl).
+sox_gui.py writes the new settings there as JSON on Apply; the engine builds
+the new chain off the audio thread and cross-fades to it over FADE_MS at a
+block boundary, so Apply needs no process restart.
+
+Hosted by sox_supervisor.py (TRACK_CHANGE_RESTART=1) the engine also stays
+up across MPD stop / pause / track changes: ``request_reset`` makes the
+audio thread discard the queued output and reset the filter state in place
+at the next block, instead of the pipeline being killed and respawned.
+
+With ``--pipeline staged`` the chain runs on per-stage worker threads
+(sox_pipeline.StagedChain), optionally pinned to CPUs with ``--cpu-map``.
+
+The FIFO format is fixed (``--input-format``, mpd.conf's fifo ``format``)
+or, with ``auto`` under sox_supervisor.py, follows MPD's ``audio`` status
+whenever a new stream starts in the FIFO: the chain is rebuilt for the
+track's native rate so it is resampled once, straight to the device rate
+(``request_input_format``).  MPD keeps the FIFO open across tracks, so the
+format never changes mid-stream (a gapless change between formats keeps
+the old one).
+
+Playback health (xruns, ALSA buffer fill, block time against the block
+deadline, FIFO backlog) is published on ``--metrics-socket`` and optionally
+as a Prometheus text file (``--metrics-prom``); see sox_metrics.py.
+
+The FIFO is read by sox_fifo.FifoReader: ``os.readv`` into a ring of
+preallocated blocks, decoded in place, with the pipe buffer raised to
+``/proc/sys/fs/pipe-max-size`` (``--pipe-size``), so the read path
+allocates nothing per block.
+
+Output goes through sox_output.open_output: ALSA in mmap access mode where
+the device supports it (``--no-mmap`` forces ``snd_pcm_writei``), or a
+paced ``null`` / ``file:PATH`` sink for runs without hardware.
+
+With ``--autotune`` the ALSA buffer size is learned per device
+(sox_buftune.BufferTuner) instead of using the fixed per-class latency.
+
+``--chain crossfeed --fifo -`` is the crossfeed sink of the aplay pipeline:
+it reads sox's output on stdin at the device rate, applies only the bs2b
+stage and plays to ALSA, and exits when sox does.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+import numpy as np
+
+from sox_buftune import BufferTuner
+from sox_dsp import build_chain, build_crossfeed_chain
+from sox_fifo import FifoReader
+from sox_fir import default_block_size
+from sox_fircache import FirCache
+from sox_ircache import IrCache
+from sox_metrics import DEFAULT_SOCKET, MetricsServer, PlaybackMetrics, fifo_backlog
+from sox_output import device_output_bits, open_output, resolve_play_device
+from sox_pipeline import StagedChain, parse_cpu_map, pin_current_thread
+from sox_settings import SETTINGS_PATH, SettingsStore
+
+logger = logging.getLogger("sox_engine")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCRIPT = os.path.join(BASE_DIR, "run_sox_fifo.sh")
+DEFAULT_FIFO = "/tmp/mpd.fifo"
+DEFAULT_CTL = "/tmp/sox.ctl"
+DEFAULT_FADE_MS = 150
+
+# MPD FIFO の既定の入力形式 (run_sox_fifo.sh の FIFO_FORMAT: S32_LE / 192kHz / 2ch)
+INPUT_RATE = 192000
+CHANNELS = 2
+# MPD のサンプル形式 (audio_format の bits) -> (numpy dtype, フルスケール)。24 は S24_P32 (32bit 容器)
+SAMPLE_FORMATS = {
+    "16": ("<i2", 32768.0),
+    "24": ("<i4", 8388608.0),
+    "32": ("<i4", 2147483648.0),
+    "f": ("<f4", 1.0),
+}
+
+SETTING_KEYS = (
+    "MUSIC_TYPE", "EFFECTS_TYPE", "EQ_OUTPUT_TYPE", "GAIN", "NOISE_FIR_TYPE",
+    "HARMONIC_FIR_TYPE", "OUTPUT_METHOD", "OUTPUT_DEVICE", "CROSSFEED_ENABLED",
+    "CROSSFEED_PRESET", "FIR_BASE_PATH", "RESAMPLE_QUALITY",
+)
+_ASSIGN_RE = re.compile(r'^([A-Z_]+)="((?:[^"\\]|\\.)*)"')
+
+
+def load_script_settings(path):
+    """Read the GUI-managed ``KEY="value"`` assignments from run_sox_fifo.sh."""
+    settings = {}
+    with open(path, "r") as f:
+        for line in f:
+            m = _ASSIGN_RE.match(line.strip())
+            if m and m.group(1) in SETTING_KEYS and m.group(1) not in settings:
+                settings[m.group(1)] = re.sub(r'\\(.)', r'\1', m.group(2))
+    return settings
+
+
+def load_engine_settings(script=DEFAULT_SCRIPT, settings_path=SETTINGS_PATH):
+    """run_sox_fifo.sh's defaults (FIR_BASE_PATH etc.) overlaid with the GUI's saved settings."""
+    settings = load_script_settings(script) if script and os.path.exists(script) else {}
+    try:
+        saved = SettingsStore(settings_path).load() if settings_path else None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring settings file %s: %s", settings_path, e)
+        saved = None
+    if saved is not None:
+        settings.update(saved.to_script())
+    return settings
+
+
+def parse_audio_format(text):
+    """MPD ``audio`` status / mpd.conf ``format`` (``"44100:24:2"``) -> ``(rate, bits)``.
+
+    None for anything the engine cannot read from the FIFO (DSD, other channel counts, ``*``).
+    """
+    parts = (text or "").split(":")
+    if len(parts) != 3 or not parts[0].isdigit() or parts[1] not in SAMPLE_FORMATS or parts[2] != str(CHANNELS):
+        return None
+    return int(parts[0]), parts[1]
+
+
+def output_rate_for(device):
+    """BlueALSA は 96kHz (LDAC)、それ以外は 192kHz (run_sox_fifo.sh と同じ)."""
+    return 96000 if "bluealsa" in device.lower() else 192000
+
+
+def fade_curve(pos, length, n):
+    """Raised-cosine ramp 0 -> 1 (old + new stay at unity sum for correlated signals)."""
+    r = np.minimum((pos + np.arange(n)) / float(length), 1.0)
+    return 0.5 - 0.5 * np.cos(np.pi * r)
+
+
+def to_int32(x):
+    return np.clip(np.rint(x * 2147483648.0), -2147483648.0, 2147483647.0).astype("<i4")
+
+
+class Engine:
+    """Blocking read -> process -> write loop over the MPD FIFO."""
+
+    def __init__(self, settings, fifo_path, device, block_frames=None, ctl_path=None,
+                 pipeline="single", cpu_map=None, autotune=False, input_format=(INPUT_RATE, "32"),
+                 chain="full", output_bits="auto", pipe_size="max", mmap=True):
+        self.settings = settings
+        self.chain_kind = chain
+        # "auto": run_sox_fifo.sh と同じ規則で OUTPUT_DEVICE から PCM 名を決める
+        if device == "auto":
+            device = resolve_play_device(settings.get("OUTPUT_DEVICE", ""))
+        # DAC が実際に使う語長 (これに合わせてディザーする)
+        self.output_bits = device_output_bits(device, output_bits)
+        self.fifo_path = fifo_path
+        self.pipe_size = pipe_size
+        self.device = device
+        self.mmap = mmap
+        self.ctl_path = ctl_path
+        self.pipeline = pipeline
+        self.cpu_map = cpu_map or {}
+        # FIFO の現在のレート / サンプル形式 (新しいストリームの先頭で request_input_format の値に切り替わる)
+        self.in_rate, self.in_bits = input_format
+        # 処理ブロック = FIR パーティション長 (レイテンシと CPU 負荷のトレードオフ)
+        self.block_frames = block_frames or default_block_size(device, INPUT_RATE)
+        self.out_rate = output_rate_for(device)
+        self.fir_cache = FirCache()
+        self.ir_cache = IrCache()
+        self.metrics = PlaybackMetrics("engine", device, self.out_rate, self.block_frames, self.in_rate)
+        self.chain = self._build(settings)
+        self.metrics.chain = self.chain.describe()
+        # ALSA バッファは最低でも出力 2 ブロック分
+        out_block = self.block_frames * self.out_rate // self.in_rate
+        self.tuner = BufferTuner(device, self.out_rate, min_frames=2 * out_block) if autotune else None
+        # 新チェインの立ち上げ用に直近の入力ブロックを保持 (staged は出力が latency_blocks 遅れる)
+        # (毎ブロックの確保を避けるため、固定長のスロットにコピーする)
+        self._history = np.zeros((self.chain.latency_blocks, self.block_frames, CHANNELS))
+        self._history_frames = []
+        self._history_next = 0
+        self._reader = FifoReader(self.block_frames, CHANNELS)
+        # ホットスワップ用: 制御ファイルの mtime / 構築済みの次のチェイン / フェード状態
+        self._ctl_mtime = self._ctl_stat()
+        self._loading = False
+        self._pending = None
+        self._next_chain = None
+        self._fade_pos = 0
+        self._fade_len = 0
+        # 曲切り替え/停止時のリセット要求 (supervisor スレッドから設定される)
+        self._reset_request = threading.Event()
+        self._format_request = None
+        # 終了要求 (stop) と、空の FIFO を待っている読み込みを起こすためのイベント (リセット/終了要求で立つ)
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        # FIFO_FORMAT=auto: MPD の現在の ``audio`` を返す関数 (sox_supervisor が設定する)。None なら形式は固定
+        self.format_probe = None
+        # FIFO に古い形式のデータが残っていない (開き直した / リセット後に空だった) ストリームの先頭
+        self._stream_start = True
+
+    def _build(self, settings):
+        if self.chain_kind == "crossfeed":
+            chain = build_crossfeed_chain(settings, self.out_rate, CHANNELS, self.output_bits)
+        else:
+            fir_base = settings.get("FIR_BASE_PATH") or BASE_DIR + "/"
+            chain = build_chain(settings, fir_base, self.in_rate, self.out_rate, CHANNELS,
+                                block_size=self.block_frames, fir_cache=self.fir_cache, ir_cache=self.ir_cache,
+                                output_bits=self.output_bits)
+        if self.pipeline == "staged":
+            chain = StagedChain(chain, self.block_frames, self.cpu_map)
+        logger.info("Effect chain: %s (block %d frames, %d-bit output)", chain.describe(), self.block_frames,
+                    self.output_bits)
+        return chain
+
+    # --- 制御チャネル (CTL_PATH) ---
+    def _ctl_stat(self):
+        if not self.ctl_path:
+            return None
+        try:
+            return os.stat(self.ctl_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def poll_control(self):
+        """Called once per block: one stat(), the rest happens on a helper thread."""
+        mtime = self._ctl_stat()
+        if mtime is None or mtime == self._ctl_mtime or self._loading:
+            return
+        self._ctl_mtime = mtime
+        self._loading = True
+        threading.Thread(target=self._load_control, daemon=True).start()
+
+    def _load_control(self):
+        try:
+            with open(self.ctl_path, "r") as f:
+                text = f.read()
+            if not text.strip():
+                return
+            data = json.loads(text)
+            if not isinstance(data, dict):
+                raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+            settings = dict(self.settings)
+            settings.update({k: str(v) for k, v in data.items() if k in SETTING_KEYS})
+            if settings.get("OUTPUT_DEVICE") != self.settings.get("OUTPUT_DEVICE"):
+                logger.warning("OUTPUT_DEVICE change needs a service restart; keeping %s", self.device)
+                settings["OUTPUT_DEVICE"] = self.settings.get("OUTPUT_DEVICE")
+            try:
+                fade_ms = max(0, int(data.get("FADE_MS", DEFAULT_FADE_MS)))
+            except (TypeError, ValueError):
+                fade_ms = DEFAULT_FADE_MS
+            in_rate = self.in_rate
+            try:
+                chain = self._build(settings)
+            except Exception:
+                # 設定値の組み合わせで構築に失敗しても今のチェインで鳴らし続ける (制御スレッドも止めない)
+                changed = {k: v for k, v in settings.items() if v != self.settings.get(k)}
+                logger.exception("Could not build a chain from %s (changed: %s); keeping the current one",
+                                 self.ctl_path, changed)
+                return
+            self.settings = settings
+            self._pending = (chain, max(1, fade_ms * self.out_rate // 1000), in_rate)
+            logger.info("New settings from %s; cross-fading over %d ms", self.ctl_path, fade_ms)
+        except (OSError, ValueError) as e:
+            # 書き込み途中の読み込み等: 次の mtime 変化で再試行される
+            logger.warning("Could not apply control file %s: %s", self.ctl_path, e)
+        finally:
+            self._loading = False
+
+    def process(self, x):
+        """Run one block through the chain, cross-fading to a pending chain if any."""
+        if self._next_chain is None and self._pending is not None:
+            self._next_chain, self._fade_len, in_rate = self._pending
+            self._pending = None
+            if in_rate != self.in_rate:
+                # 構築中に入力レートが変わった: 捨てて次のブロックで読み直す
+                self._next_chain.close()
+                self._next_chain = None
+                self._ctl_mtime = None
+                return self.chain.process(x)
+            self._fade_pos = 0
+            # 新チェインに直近の入力を流して遅延を旧チェインと揃える (出力は捨てる)
+            for slot, frames in self._history_frames:
+                self._next_chain.process(self._history[slot, :frames].copy())
+        if len(self._history):
+            self._remember(x)
+        if self._next_chain is None:
+            return self.chain.process(x)
+        old = self.chain.process(x.copy())
+        new = self._next_chain.process(x)
+        n = min(len(old), len(new))
+        g = fade_curve(self._fade_pos, self._fade_len, n)[:, None]
+        # チェインの出力は int32 (フェード中の 1 区間だけ丸め直す)
+        y = new.copy()
+        y[:n] = np.rint(old[:n] * (1.0 - g) + new[:n] * g)
+        self._fade_pos += n
+        if self._fade_pos >= self._fade_len:
+            self._finish_fade()
+        return y
+
+    def _remember(self, x):
+        slot = self._history_next
+        self._history[slot, :len(x)] = x
+        if len(self._history_frames) == len(self._history):
+            del self._history_frames[0]
+        self._history_frames.append((slot, len(x)))
+        self._history_next = (slot + 1) % len(self._history)
+
+    def _finish_fade(self):
+        if self._next_chain is not None:
+            old, self.chain = self.chain, self._next_chain
+            self._next_chain = None
+            old.close()
+            self.metrics.chain = self.chain.describe()
+            logger.info("Switched to new effect chain")
+
+    def reset(self):
+        self._finish_fade()
+        self.chain.reset()
+        self._history_frames.clear()
+
+    def flush(self):
+        """End of stream: blocks still inside a staged chain, then the partial blocks held by FIR / resampler."""
+        self._finish_fade()
+        return self.chain.flush()
+
+    def request_reset(self):
+        """Thread-safe: discard queued audio and reset the filters at the next block.
+
+        Stale FIFO data needs no flush here; MPD's fifo output drains the
+        FIFO itself when it cancels playback.
+        """
+        self._reset_request.set()
+        self._wakeup.set()
+
+    def stop(self):
+        """Thread-safe: stop reading, play out what is queued (flush + drain) and return from ``run``."""
+        self._stop.set()
+        self._wakeup.set()
+        if self.fifo_path != "-":
+            # MPD が FIFO を開くのを待っている open() は、こちらで書き込み側を開いて閉じれば EOF で戻る
+            try:
+                os.close(os.open(self.fifo_path, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+
+    def request_input_format(self, audio):
+        """Thread-safe: MPD now plays ``audio`` (``"44100:24:2"``); the engine switches at the next stream start.
+
+        Bytes already in the FIFO are still in the old format, so the switch
+        waits until none can be left: the FIFO was reopened, or it was found
+        empty after a reset (MPD drains it when it cancels playback).
+        Returns False (and changes nothing) for formats the engine cannot read.
+        """
+        input_format = parse_audio_format(audio)
+        if input_format is None:
+            return False
+        if input_format != (self.in_rate, self.in_bits) and input_format != self._format_request \
+                and not self._stream_start:
+            logger.info("MPD switched to %s mid-stream; keeping %d:%s until the FIFO is reopened or drained",
+                        audio, self.in_rate, self.in_bits)
+        self._format_request = input_format
+        return True
+
+    def _start_stream(self):
+        """First bytes of a new stream are waiting: switch to MPD's current format before reading them."""
+        self._stream_start = False
+        try:
+            audio = self.format_probe()
+        except Exception as e:
+            # 問い合わせに失敗したら直近のイベントで受け取った形式を使う
+            logger.warning("Could not query MPD's audio format: %s", e)
+            audio = None
+        if audio and not self.request_input_format(audio):
+            logger.warning("MPD audio format %s is not readable from the FIFO; keeping the current one", audio)
+        if self._format_request is not None:
+            self._apply_input_format()
+
+    def _apply_input_format(self):
+        (rate, bits), self._format_request = self._format_request, None
+        if (rate, bits) == (self.in_rate, self.in_bits):
+            return
+        logger.info("Input format %d:%s -> %d:%s", self.in_rate, self.in_bits, rate, bits)
+        self.in_bits = bits
+        if rate == self.in_rate:
+            return
+        # レートが変わる場合は FIR/EQ/リサンプラーを新しいレートで作り直す (クロスフェードはしない)
+        self._finish_fade()
+        old, self.in_rate = self.chain, rate
+        self.chain = self._build(self.settings)
+        old.close()
+        self._history_frames.clear()
+        self.metrics.chain = self.chain.describe()
+        self.metrics.deadline_s = self.block_frames / float(rate)
+
+    def _apply_reset(self, output):
+        self._reset_request.clear()
+        if not self._stop.is_set():
+            self._wakeup.clear()
+        output.drop()
+        self.reset()
+        self.metrics.resets += 1
+        logger.info("Engine reset: output dropped, filter state cleared")
+
+    def _open_output(self, old=None):
+        if old is not None:
+            old.close()
+        latency_us = self.tuner.latency_us() if self.tuner is not None else None
+        output = open_output(self.device, self.out_rate, CHANNELS, latency_us=latency_us, mmap=self.mmap)
+        self.metrics.buffer_size = output.buffer_size
+        return output
+
+    def run(self):
+        # FIFO 読み込みと ALSA 書き込みはこのスレッド ("io")
+        pin_current_thread(self.cpu_map.get("io"), "engine I/O")
+        output = self._open_output()
+        metrics = self.metrics
+        xruns_seen = 0
+        try:
+            while not self._stop.is_set():
+                metrics.state = "waiting"
+                # MPD が FIFO を開くまでここでブロックする
+                fd = self._reader.open(self.fifo_path, self.pipe_size)
+                self._stream_start = True
+                try:
+                    logger.info("FIFO opened: %s", self.fifo_path)
+                    metrics.state = "playing"
+                    while True:
+                        follow = self.format_probe is not None
+                        pcm = None
+                        if follow and self._stream_start:
+                            # 新しいストリームは最初のデータが届いてから MPD の形式に合わせて読み始める
+                            if self._reader.wait(fd, self._wakeup):
+                                self._start_stream()
+                        if not follow or not self._stream_start:
+                            dtype, full_scale = SAMPLE_FORMATS[self.in_bits]
+                            pcm = self._reader.read(fd, dtype, self._wakeup)
+                        if pcm is None:
+                            # FIFO が空のままリセット/終了を要求された: 読みかけのブロックは捨てる
+                            if self._stop.is_set():
+                                break
+                            self._wakeup.clear()
+                            if self._reset_request.is_set():
+                                # FIFO が空なら次に届くデータを新しいストリームとして扱う
+                                self._apply_reset(output)
+                                self._stream_start = fifo_backlog(fd) == 0
+                            continue
+                        frames = len(pcm)
+                        metrics.fifo_backlog = fifo_backlog(fd)
+                        if self._reset_request.is_set():
+                            self._apply_reset(output)
+                        if frames:
+                            # 締め切りと比べるのは変換 + 処理の時間 (ALSA への書き込み待ちは含めない)
+                            t0 = time.perf_counter()
+                            y = self.process(self._reader.to_float(pcm, full_scale))
+                            out = y if len(y) else None
+                            metrics.record_block(time.perf_counter() - t0)
+                            if out is not None:
+                                output.write(out)
+                            metrics.buffer_fill = output.delay()
+                            if self.tuner is not None:
+                                self.tuner.played(frames / float(self.in_rate))
+                            if output.xruns != xruns_seen:
+                                metrics.xruns += output.xruns - xruns_seen
+                                xruns_seen = output.xruns
+                                # 途切れはもう起きているので、その場で大きいバッファに開き直す
+                                if self.tuner is not None and self.tuner.on_xrun():
+                                    output, xruns_seen = self._open_output(output), 0
+                        if frames < self.block_frames or self._stop.is_set():
+                            break
+                        self.poll_control()
+                finally:
+                    os.close(fd)
+                metrics.state = "draining"
+                # 書き込み側 (MPD) が閉じた / 終了要求: 停止/フォーマット変更
+                if self._reset_request.is_set() and not self._stop.is_set():
+                    logger.info("FIFO writer closed after stop; dropping output")
+                    self._apply_reset(output)
+                else:
+                    logger.info("%s; draining output and resetting filters",
+                                "Stopping" if self._stop.is_set() else "FIFO writer closed")
+                    for y in self.flush():
+                        if len(y):
+                            output.write(y)
+                    output.drain()
+                    self.reset()
+                metrics.buffer_fill = 0
+                # 小さいバッファを試すのは曲の境目 (FIFO が閉じたとき) だけ
+                if self.tuner is not None and self.tuner.maybe_step_down():
+                    output, xruns_seen = self._open_output(output), 0
+                if self.fifo_path == "-":
+                    # stdin (パイプの前段の sox) は開き直せない
+                    break
+        finally:
+            metrics.state = "stopped"
+            output.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--script", default=DEFAULT_SCRIPT, help="run_sox_fifo.sh to read settings from")
+    parser.add_argument("--settings", default=SETTINGS_PATH, help="GUI settings file (sox_settings.py; '' = script only)")
+    parser.add_argument("--fifo", default=DEFAULT_FIFO, help="MPD FIFO ('-' = stdin, exit at EOF)")
+    parser.add_argument("--ctl", default=DEFAULT_CTL, help="control file for live settings updates")
+    parser.add_argument("--device", default="auto",
+                        help="ALSA PCM (PLAY_DEVICE), 'null' / 'file:PATH' for a paced sink without hardware, "
+                             "'auto' = from OUTPUT_DEVICE")
+    parser.add_argument("--no-mmap", action="store_true", help="write with snd_pcm_writei instead of mmap access")
+    parser.add_argument("--block", default="auto",
+                        help="frames per processing block / FIR partition ('auto' = per device class)")
+    parser.add_argument("--pipeline", choices=("single", "staged"), default="single",
+                        help="run all stages on one thread, or each stage group on its own worker thread")
+    parser.add_argument("--cpu-map", default="", help="per stage group CPUs, e.g. 'io:2 fir:3 eq:2 resample:3 post:2'")
+    parser.add_argument("--input-format", default="192000:32:2",
+                        help="FIFO format RATE:BITS:2 (mpd.conf fifo format); 'auto' follows MPD under sox_supervisor.py")
+    parser.add_argument("--autotune", action="store_true",
+                        help="learn the smallest stable ALSA buffer per device (BUFFER_AUTOTUNE=1)")
+    parser.add_argument("--output-bits", choices=("auto", "16", "24", "32"), default="auto",
+                        help="word length to dither to (OUTPUT_BITS; 'auto' = per device, see sox_output.py)")
+    parser.add_argument("--chain", choices=("full", "crossfeed"), default="full",
+                        help="full effect chain, or only the bs2b crossfeed (aplay pipeline, input at the device rate)")
+    parser.add_argument("--pipe-size", default="max",
+                        help="FIFO pipe buffer in bytes ('max' = /proc/sys/fs/pipe-max-size, '0' = kernel default)")
+    parser.add_argument("--metrics-socket", default=DEFAULT_SOCKET, help="Unix socket serving JSON metrics ('' = off)")
+    parser.add_argument("--metrics-prom", default="", help="also write Prometheus text metrics to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    settings = load_engine_settings(args.script, args.settings)
+    logger.info("Settings from %s / %s: %s", args.settings, args.script, settings)
+    block = None if args.block == "auto" else int(args.block)
+    if args.input_format == "auto":
+        logger.warning("--input-format auto needs sox_supervisor.py (TRACK_CHANGE_RESTART=1); assuming %d:32:2",
+                       INPUT_RATE)
+        input_format = (INPUT_RATE, "32")
+    else:
+        input_format = parse_audio_format(args.input_format)
+        if input_format is None:
+            parser.error(f"unsupported --input-format {args.input_format!r} (RATE:16|24|32|f:2)")
+    engine = Engine(settings, args.fifo, args.device, block, ctl_path=args.ctl,
+                    pipeline=args.pipeline, cpu_map=parse_cpu_map(args.cpu_map), autotune=args.autotune,
+                    input_format=input_format, chain=args.chain, output_bits=args.output_bits,
+                    pipe_size=None if args.pipe_size == "0" else args.pipe_size, mmap=not args.no_mmap)
+    server = MetricsServer(engine.metrics, args.metrics_socket, args.metrics_prom or None).start()
+
+    def on_sigterm(*_):
+        # SIGTERM (systemctl stop / stop_sox_pipeline): キューの音を drain してから ALSA を閉じる。
+        # FIFO の open() 待ち (再開される) のときは鳴らすものもないので finally を通してそのまま抜ける
+        engine.stop()
+        if engine.metrics.state == "waiting":
+            sys.exit(0)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""EQ preset table shared by run_sox_fifo.sh, sox_gui.py and the DSP engine.
+
+Each preset is a SoX effect string.  run_sox_fifo.sh gets EQ_INPUT /
+EQ_OUTPUT from the CLI below, sox_gui.py builds its Music Type / EQ Output
+lists from the keys, and sox_dsp.py compiles the strings into one cascaded
+SOS filter per preset.  Unknown names map to no EQ.
+
+    python3 sox_eq.py MUSIC_TYPE EQ_OUTPUT_TYPE   # prints EQ_INPUT, EQ_OUTPUT lines
+
+Standard library only: the GUI imports this without numpy/scipy.
+"""
+import sys
+
+# --- 音楽タイプ別の入力イコライザー (ゲイン設定を含む) ---
+MUSIC_TYPE_EQ = {
+    "jazz": "gain -5 equalizer 80 0.9q +2.5 equalizer 300 1.0q +1.0 equalizer 1500 1.1q +0.5 equalizer 3000 1.0q +1.0 equalizer 7000 0.8q +0.7",
+    "classical": "gain -5 equalizer 60 0.7q +1.0 equalizer 400 0.9q -0.5 equalizer 1800 1.0q +0.3 equalizer 4000 1.1q +0.7 equalizer 8000 0.8q +1.0",
+    "electronic": "gain -5 equalizer 40 0.8q +3.0 equalizer 120 1.0q +2.0 equalizer 800 1.1q -0.5 equalizer 2500 1.0q +1.0 equalizer 8000 0.9q +1.5",
+    "vocal": "gain -5 equalizer 70 1.0q -0.8 equalizer 250 1.5q +1.0 equalizer 2500 1.2q +2.0 equalizer 5000 0.8q +1.0 equalizer 12000 0.7q +0.5",
+    "none": "gain -3",
+}
+
+# --- 再生デバイス別の出力イコライザー ---
+EQ_OUTPUT_EQ = {
+    "studio-monitors": "equalizer 80 0.8q +3 equalizer 2500 1.0q -0.8 equalizer 20000 1.0q +3",
+    "JBL-Speakers": "equalizer 70 0.7q +3 equalizer 1200 1.0q -2 equalizer 13000 0.8q +5",
+    "planar-magnetic": "equalizer 30 0.7q 1 equalizer 180 0.9q -1 equalizer 15000 0.8q +1.0",
+    "bt-earphones": "equalizer 60 1.0q +1 equalizer 3000 1.0q -0.5 equalizer 18000 1.0q 3",
+    # Tube-Warmth: 真空管のような温かみと艶 (overdrive で倍音を付加し、低域にわずかな厚み)
+    "Tube-Warmth": "overdrive 1.5 5 bass +1.5 100 equalizer 50 1.8q +2 equalizer 200 1.1q +1 equalizer 17000 1.0q +2",
+    # Crystal-Clarity: 15kHz 以上の Air 感を強調し、微細な信号をコンパンドで引き上げる
+    "Crystal-Clarity": "treble +2 15k 0.5q compand 0.1,0.3 -60,-60,-30,-15,-5,-5",
+    # Monitor-Sim: 150Hz 付近の膨らみを抑え、3kHz 付近をわずかに強調して明瞭度を上げる
+    "Monitor-Sim": "equalizer 150 1.0q -2 equalizer 3000 0.8q +1",
+    "none": "",
+}
+
+
+def music_type_eq(name):
+    return MUSIC_TYPE_EQ.get(name, "")
+
+
+def eq_output_eq(name):
+    return EQ_OUTPUT_EQ.get(name, "")
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if len(args) != 2:
+        print("usage: sox_eq.py MUSIC_TYPE EQ_OUTPUT_TYPE", file=sys.stderr)
+        return 2
+    print(music_type_eq(args[0]))
+    print(eq_output_eq(args[1]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
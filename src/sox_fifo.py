@@ -0,0 +1,139 @@
+"""Allocation-free ingest of the MPD FIFO (or the stdin pipe) for sox_engine.py.
+
+``FifoReader`` owns a small ring of preallocated block slots.  Each slot is
+one ``bytearray`` with NumPy views of it in every FIFO sample format
+(int16 / int32 / float32, ``np.frombuffer``, no copy) and a float64 block
+the samples are scaled into with ``out=``.  ``os.readv`` fills the slot
+straight from the pipe, so reading and decoding a block allocates no
+block-sized objects; the chain gets a view of the slot, which stays valid
+until the ring wraps (``slots - 1`` further reads).
+
+The pipe buffer is raised with ``F_SETPIPE_SZ`` on open (``set_pipe_size``),
+up to ``/proc/sys/fs/pipe-max-size`` by default: the default 64 KiB holds
+only ~40 ms of S32_LE / 192 kHz / stereo, so a scheduling hiccup of the
+engine blocks MPD's FIFO output.
+"""
+import errno
+import fcntl
+import logging
+import os
+import select
+
+import numpy as np
+
+logger = logging.getLogger("sox_engine")
+
+PIPE_MAX_SIZE_PATH = "/proc/sys/fs/pipe-max-size"
+# fcntl.F_SETPIPE_SZ は Python 3.10 以降 (Linux の値は 1031 / 1032)
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+F_GETPIPE_SZ = getattr(fcntl, "F_GETPIPE_SZ", 1032)
+MIN_PIPE_SIZE = 65536
+# read(cancel=...) が空のパイプを待ちながら cancel を確かめる間隔 (秒)
+CANCEL_POLL_S = 0.05
+# 読み込み元の形式 (sox_engine.SAMPLE_FORMATS の dtype)
+SAMPLE_DTYPES = ("<i2", "<i4", "<f4")
+
+
+def pipe_max_size(path=PIPE_MAX_SIZE_PATH):
+    """The largest pipe buffer an unprivileged process may set (bytes); None if unknown."""
+    try:
+        with open(path, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def set_pipe_size(fd, size="max"):
+    """Raise the pipe buffer of ``fd`` to ``size`` bytes (``"max"`` = pipe-max-size).
+
+    Falls back to halving the request when the kernel refuses it (EPERM once
+    the user's pipe-user-pages-soft budget is used up).  Returns the
+    resulting size, or None when ``fd`` is not a pipe.
+    """
+    if size == "max":
+        size = pipe_max_size() or MIN_PIPE_SIZE
+    size = int(size)
+    try:
+        current = fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except OSError:
+        # 通常ファイル等 (テスト用の入力): パイプではない
+        return None
+    while size > current:
+        try:
+            return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EBUSY, errno.ENOMEM):
+                raise
+            size //= 2
+    return current
+
+
+class FifoReader:
+    """Ring of preallocated block slots filled by ``os.readv`` from a pipe."""
+
+    def __init__(self, block_frames, channels, slots=2):
+        self.block_frames = block_frames
+        self.channels = channels
+        size = block_frames * channels * max(np.dtype(d).itemsize for d in SAMPLE_DTYPES)
+        self._raw = [bytearray(size) for _ in range(slots)]
+        self._mv = [memoryview(buf) for buf in self._raw]
+        # 各スロットのバイト列を各サンプル形式で見た配列 (コピーなし)
+        self._pcm = {dtype: [np.frombuffer(buf, dtype=dtype).reshape(-1, channels) for buf in self._raw]
+                     for dtype in SAMPLE_DTYPES}
+        self._float = np.zeros((slots, block_frames, channels))
+        self._slot = slots - 1
+
+    def open(self, path, pipe_size="max"):
+        """Open ``path`` (``"-"`` = stdin) for reading and raise its pipe buffer; returns the fd."""
+        if path == "-":
+            fd = os.dup(0)
+        else:
+            # MPD が書き込み側を開くまでここでブロックする
+            fd = os.open(path, os.O_RDONLY)
+        if pipe_size:
+            try:
+                size = set_pipe_size(fd, pipe_size)
+            except OSError as e:
+                logger.warning("Could not raise the pipe buffer of %s: %s", path, e)
+            else:
+                if size is not None:
+                    logger.info("Pipe buffer of %s: %d KiB", path, size // 1024)
+        return fd
+
+    def wait(self, fd, cancel):
+        """Block until ``fd`` is readable (data or EOF); False if ``cancel`` (an Event) is set first."""
+        while not cancel.is_set():
+            if select.select([fd], [], [], CANCEL_POLL_S)[0]:
+                return True
+        return False
+
+    def read(self, fd, dtype="<i4", cancel=None):
+        """Fill the next slot with up to one block; returns its PCM as a ``(frames, channels)`` view.
+
+        Short only at EOF (the writer closed); a trailing partial frame is dropped.
+        With ``cancel`` (an Event), the pipe running empty mid-block is waited
+        out with select() instead of a blocking read, and None is returned
+        (the frames read so far dropped) once ``cancel`` is set.
+        """
+        self._slot = (self._slot + 1) % len(self._raw)
+        itemsize = np.dtype(dtype).itemsize
+        frame_bytes = self.channels * itemsize
+        want = self.block_frames * frame_bytes
+        mv = self._mv[self._slot]
+        got = 0
+        while got < want:
+            if cancel is not None and not select.select([fd], [], [], 0)[0] and not self.wait(fd, cancel):
+                return None
+            n = os.readv(fd, (mv[got:want],))
+            if not n:
+                break
+            got += n
+        if got % frame_bytes:
+            logger.warning("Dropping %d bytes of a partial frame at EOF", got % frame_bytes)
+        return self._pcm[dtype][self._slot][:got // frame_bytes]
+
+    def to_float(self, pcm, full_scale):
+        """Scale a view returned by ``read`` into the slot's float64 block (a view, valid until the ring wraps)."""
+        out = self._float[self._slot, :len(pcm)]
+        np.multiply(pcm, 1.0 / full_scale, out=out)
+        return out
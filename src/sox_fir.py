@@ -0,0 +1,403 @@
+"""FIR coefficient loading and FFT convolution for the firs/ banks.
+
+The noise FIRs have up to 2047 taps and the harmonic FIRs 777, so direct
+convolution at 192 kHz is far too expensive.  ``PartitionedConvolver`` is a
+uniformly partitioned overlap-save (UPOLS) convolver: the kernel is cut into
+partitions of ``block_size`` taps whose spectra are computed once, and every
+input block costs one forward FFT, one complex multiply-accumulate per
+partition and one inverse FFT.  Latency equals ``block_size`` frames.
+``NonUniformConvolver`` chains UPOLS segments of growing partition size for
+kernels of several seconds (the EFFECTS_TYPE room impulse responses).
+
+The text banks can be converted to a compact binary format (``.bin`` next
+to the ``.txt``) that is memory-mapped instead of parsed, so every engine
+start skips thousands of float parses and concurrent engine processes share
+one page-cache copy of the coefficients:
+
+    python3 sox_fir.py convert [--dtype float32|float64] firs/*.txt
+"""
+import argparse
+import mmap
+import os
+import re
+import struct
+import sys
+
+import numpy as np
+
+# --- FIR ファイル (run_sox_fifo.sh の case 文と同じ対応) ---
+NOISE_FIR_FILES = {
+    "light": "noise_fir_light.txt",
+    "medium": "noise_fir_medium.txt",
+    "strong": "noise_fir_strong.txt",
+    "default": "noise_fir_default.txt",
+}
+HARMONIC_FIR_FILES = {
+    "dead": "harmonic_dead.txt",
+    "base": "harmonic_base.txt",
+    "med": "harmonic_med.txt",
+    "high": "harmonic_high.txt",
+    "dynamic": "harmonic_dynamic.txt",
+}
+
+
+def fir_compensation_db(noise_on, harmonic_on):
+    """FIR 適用時の音量補正 (run_sox_fifo.sh の FIR_COMPENSATION と同じ)."""
+    if noise_on and harmonic_on:
+        return 8
+    if noise_on or harmonic_on:
+        return 4
+    return 0
+
+
+def load_fir_text(path):
+    """Load a SoX ``fir`` coefficient file (one float per line, ``#`` comments)."""
+    taps = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            taps.append(float(line))
+    if not taps:
+        raise ValueError(f"FIR file has no coefficients: {path}")
+    return np.asarray(taps, dtype=np.float64)
+
+
+_HEADER_RE = re.compile(r"(scale_factor|comp_db)=([-+0-9.eE]+)")
+
+
+def read_fir_header(path):
+    """Return ``{"scale_factor": .., "comp_db": ..}`` from the ``#`` header lines."""
+    meta = {}
+    with open(path, "r") as f:
+        for line in f:
+            if not line.startswith("#"):
+                break
+            for key, value in _HEADER_RE.findall(line):
+                meta[key] = float(value)
+    return meta
+
+
+# --- バイナリ形式 ---
+# 32 byte header: magic, dtype size (4/8), taps, scale_factor, comp_db (little endian)
+# 係数データはヘッダ直後 (32 byte 境界) から始まる
+FIR_MAGIC = b"SOXFIR1\0"
+_BIN_HEADER = struct.Struct("<8sB3xIdd")
+_BIN_DTYPES = {4: np.dtype("<f4"), 8: np.dtype("<f8")}
+
+
+def save_fir_binary(path, taps, scale_factor=1.0, comp_db=0.0, dtype="float64"):
+    """Write ``taps`` in the binary FIR format (atomically)."""
+    data = np.ascontiguousarray(taps, dtype=np.dtype(dtype).newbyteorder("<"))
+    if data.itemsize not in _BIN_DTYPES:
+        raise ValueError(f"unsupported FIR dtype: {dtype}")
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_BIN_HEADER.pack(FIR_MAGIC, data.itemsize, len(data), scale_factor, comp_db))
+        f.write(data.tobytes())
+    os.replace(tmp, path)
+
+
+def convert_fir_text(txt_path, bin_path=None, dtype="float64"):
+    """Convert a SoX text FIR into the binary format; returns the output path."""
+    if bin_path is None:
+        bin_path = os.path.splitext(txt_path)[0] + ".bin"
+    meta = read_fir_header(txt_path)
+    save_fir_binary(bin_path, load_fir_text(txt_path), meta.get("scale_factor", 1.0),
+                    meta.get("comp_db", 0.0), dtype)
+    return bin_path
+
+
+class FirFile:
+    """Lazily memory-mapped binary FIR.
+
+    Only the header is read on open; ``taps`` maps the file on first access
+    and returns a read-only array backed by the shared page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(_BIN_HEADER.size)
+        if len(header) < _BIN_HEADER.size:
+            raise ValueError(f"truncated FIR file: {path}")
+        magic, itemsize, self.num_taps, self.scale_factor, self.comp_db = _BIN_HEADER.unpack(header)
+        if magic != FIR_MAGIC or itemsize not in _BIN_DTYPES:
+            raise ValueError(f"not a binary FIR file: {path}")
+        self.dtype = _BIN_DTYPES[itemsize]
+        self._taps = None
+
+    @property
+    def taps(self):
+        if self._taps is None:
+            with open(self.path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            expected = _BIN_HEADER.size + self.num_taps * self.dtype.itemsize
+            if len(mm) < expected:
+                mm.close()
+                raise ValueError(f"truncated FIR file: {self.path}")
+            # ndarray が mmap を参照し続けるので、ファイルは配列の寿命の間マップされたまま
+            self._taps = np.frombuffer(mm, dtype=self.dtype, count=self.num_taps, offset=_BIN_HEADER.size)
+        return self._taps
+
+
+def load_fir(path):
+    """Load FIR taps, preferring an up-to-date ``.bin`` twin of a ``.txt`` file."""
+    root, ext = os.path.splitext(path)
+    if ext == ".bin":
+        return FirFile(path).taps
+    bin_path = root + ".bin"
+    try:
+        if os.path.getmtime(bin_path) >= os.path.getmtime(path):
+            return FirFile(bin_path).taps
+    except (OSError, ValueError):
+        pass
+    return load_fir_text(path)
+
+
+def default_block_size(device, rate):
+    """Partition size per device class.
+
+    BlueALSA already buffers ~500 ms, so large blocks (less CPU) are free;
+    USB/HDMI/PCH outputs run with short buffers at 192 kHz and get small ones.
+    """
+    if "bluealsa" in device.lower():
+        return 8192
+    return 2048 if rate >= 176400 else 1024
+
+
+class PartitionedConvolver:
+    """Streaming UPOLS convolution of a (frames, channels) signal with one kernel.
+
+    ``process`` accepts blocks of any length; input is consumed in whole
+    partitions, so when callers feed exactly ``block_size`` frames the output
+    length always equals the input length.
+    """
+
+    def __init__(self, taps, block_size=2048, channels=2):
+        taps = np.asarray(taps, dtype=np.float64)
+        self.block_size = int(block_size)
+        self.channels = channels
+        self.num_taps = len(taps)
+        b = self.block_size
+        self.partitions = -(-len(taps) // b)
+        # taps が (taps, channels) ならチャンネルごとに別のカーネル (ルーム IR の左右)
+        padded = np.zeros((self.partitions * b,) + taps.shape[1:])
+        padded[:len(taps)] = taps
+        # H: (partitions, b + 1[, channels]) 各パーティションのスペクトル (2b 点 rFFT)
+        self._spectra = np.fft.rfft(padded.reshape((self.partitions, b) + taps.shape[1:]), n=2 * b, axis=1)
+        self._subscripts = "pk,pkc->kc" if taps.ndim == 1 else "pkc,pkc->kc"
+        self.reset()
+
+    def reset(self):
+        b = self.block_size
+        self._fdl = np.zeros((self.partitions, b + 1, self.channels), dtype=np.complex128)
+        self._head = 0
+        self._prev = np.zeros((b, self.channels))
+        self._pending = np.zeros((0, self.channels))
+
+    def _process_partition(self, block):
+        b = self.block_size
+        frame = np.concatenate((self._prev, block))
+        self._prev = block.copy()
+        # 周波数領域ディレイライン (リングバッファ) に最新のスペクトルを格納
+        self._head = (self._head - 1) % self.partitions
+        self._fdl[self._head] = np.fft.rfft(frame, axis=0)
+        order = (self._head + np.arange(self.partitions)) % self.partitions
+        acc = np.einsum(self._subscripts, self._spectra, self._fdl[order])
+        return np.fft.irfft(acc, n=2 * b, axis=0)[b:]
+
+    def process(self, x):
+        b = self.block_size
+        if len(self._pending):
+            x = np.concatenate((self._pending, x))
+        full = len(x) // b
+        self._pending = x[full * b:].copy()
+        if full == 1:
+            return self._process_partition(x[:b])
+        out = np.empty((full * b, self.channels))
+        for i in range(full):
+            out[i * b:(i + 1) * b] = self._process_partition(x[i * b:(i + 1) * b])
+        return out
+
+    def flush(self):
+        """End of stream: output for the frames held back in ``_pending`` (zero-padded to a block, trimmed)."""
+        n = len(self._pending)
+        if not n:
+            return self._pending
+        return self.process(np.zeros((self.block_size - n, self.channels)))[:n]
+
+
+class _Segment(PartitionedConvolver):
+    """One partition size of ``NonUniformConvolver``, fed one block at a time.
+
+    Only partition 0 needs the input block that completes a partition; the
+    products of the older partitions are accumulated ahead of time, spread
+    evenly over the blocks in between, so a large partition costs one FFT,
+    one partition product and one inverse FFT in the block where it fires.
+    """
+
+    def __init__(self, taps, size, block_size, channels):
+        super().__init__(taps, size, channels)
+        self.steps = size // block_size
+
+    def reset(self):
+        super().reset()
+        size = self.block_size
+        # 次のスペクトルを書き込む FDL のスロット (パーティション j は (_next + j) % partitions)
+        self._next = 0
+        self._input = np.zeros((size, self.channels))
+        self._fill = 0
+        self._acc = np.zeros((size + 1, self.channels), dtype=np.complex128)
+        self._done = 1
+
+    def _mac(self, stop):
+        n = self.partitions
+        j = self._done
+        while j < stop:
+            i = (self._next + j) % n
+            m = min(stop - j, n - i)
+            self._acc += np.einsum(self._subscripts, self._spectra[j:j + m], self._fdl[i:i + m])
+            j += m
+        self._done = max(self._done, stop)
+
+    def push(self, block):
+        """Add one block; returns ``size`` output frames when a partition completes, else None."""
+        b = len(block)
+        self._input[self._fill:self._fill + b] = block
+        self._fill += b
+        if self._fill < self.block_size:
+            # 古いパーティションの積和を発火までのブロックに均等に割り振る
+            step = self._fill // b
+            self._mac(1 + -(-(self.partitions - 1) * step // self.steps))
+            return None
+        self._mac(self.partitions)
+        size = self.block_size
+        frame = np.concatenate((self._prev, self._input))
+        self._prev[:] = self._input
+        self._fdl[self._next] = np.fft.rfft(frame, axis=0)
+        self._acc += np.einsum(self._subscripts, self._spectra[:1], self._fdl[self._next:self._next + 1])
+        y = np.fft.irfft(self._acc, n=2 * size, axis=0)[size:]
+        self._acc[:] = 0.0
+        self._done = 1
+        self._fill = 0
+        self._next = (self._next - 1) % self.partitions
+        return y
+
+
+class NonUniformConvolver:
+    """Streaming non-uniformly partitioned convolution for kernels of several seconds.
+
+    The kernel is cut into segments whose partition size grows 4x per
+    segment (``block_size``, 4x, 16x, ...) until it reaches
+    ``max_partition`` (rounded down to a multiple of ``block_size``); that
+    last size takes the rest of the kernel, e.g. ``3x2048 + 1x8192 +
+    42x16384`` for 3.6 s at 192 kHz and 2048-frame blocks.  A segment with
+    partition P only produces output once P input frames have arrived, so it
+    must start at kernel offset >= P - block_size; its output is added ahead
+    of time into a ring that is read one block at a time.
+
+    The head segment keeps the latency at one block like the plain UPOLS
+    convolver.  The long tail runs on a few large partitions whose products
+    are spread over the blocks between their FFTs (``_Segment``), so every
+    block costs about the same: a 3.6 s kernel at 192 kHz needs about a
+    seventh of the per-block multiply-accumulate of UPOLS at the same block
+    size.  A larger ``max_partition`` lowers the average cost further but
+    makes the blocks with the big FFTs slower.
+    Input is consumed in whole blocks as in ``PartitionedConvolver``.
+    """
+
+    def __init__(self, taps, block_size=2048, channels=2, max_partition=16384):
+        taps = np.asarray(taps, dtype=np.float64)
+        b = self.block_size = int(block_size)
+        self.channels = channels
+        self.num_taps = len(taps)
+        self.segments = []
+        # パーティション長はブロック長の倍数に限る (_Segment は 1 ブロックずつ入力を受ける)
+        limit = max(b, max_partition // b * b)
+        offset, size = 0, b
+        while offset < len(taps):
+            # 4 倍ずつ伸ばし、上限を超える手前では上限そのものを最後のサイズにする
+            grow = min(size * 4, limit)
+            if grow == size:
+                length = len(taps) - offset
+            else:
+                # 次のサイズのセグメントは (次のパーティション長 - ブロック長) 以降からしか始められない
+                length = max(size, -(-(grow - b - offset) // size) * size)
+            self.segments.append((offset, _Segment(taps[offset:offset + length], size, b, channels)))
+            offset += length
+            size = grow
+        # 出力リング: 最も遅いセグメントの書き込み先 (offset) + 読み出し中の 1 ブロック
+        ring = self.segments[-1][0] + b if self.segments else b
+        self._ring_frames = -(-ring // b) * b
+        self.reset()
+
+    def describe(self):
+        return " + ".join(f"{seg.partitions}x{seg.block_size}" for _, seg in self.segments)
+
+    def reset(self):
+        for _, seg in self.segments:
+            seg.reset()
+        self._ring = np.zeros((self._ring_frames, self.channels))
+        self._pos = 0
+        self._pending = np.zeros((0, self.channels))
+
+    def _ring_add(self, pos, y):
+        start = pos % self._ring_frames
+        n = min(len(y), self._ring_frames - start)
+        self._ring[start:start + n] += y[:n]
+        if n < len(y):
+            self._ring[:len(y) - n] += y[n:]
+
+    def _process_block(self, block):
+        b = self.block_size
+        end = self._pos + b
+        for offset, seg in self.segments:
+            y = seg.push(block)
+            if y is not None:
+                # y は入力 [end - P, end) に対する出力; カーネル上の offset だけ遅れて鳴る
+                self._ring_add(end - len(y) + offset, y)
+        start = self._pos % self._ring_frames
+        out = self._ring[start:start + b].copy()
+        self._ring[start:start + b] = 0.0
+        self._pos = end
+        return out
+
+    def process(self, x):
+        b = self.block_size
+        if len(self._pending):
+            x = np.concatenate((self._pending, x))
+        full = len(x) // b
+        self._pending = x[full * b:].copy()
+        if full == 1:
+            return self._process_block(x[:b])
+        out = np.empty((full * b, self.channels))
+        for i in range(full):
+            out[i * b:(i + 1) * b] = self._process_block(x[i * b:(i + 1) * b])
+        return out
+
+    def flush(self):
+        """End of stream: output for the frames held back in ``_pending`` (zero-padded to a block, trimmed)."""
+        n = len(self._pending)
+        if not n:
+            return self._pending
+        return self.process(np.zeros((self.block_size - n, self.channels)))[:n]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FIR bank tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    conv = sub.add_parser("convert", help="convert SoX text FIRs to the mmap-able binary format")
+    conv.add_argument("files", nargs="+")
+    conv.add_argument("--dtype", choices=("float32", "float64"), default="float64")
+    args = parser.parse_args(argv)
+    if args.command == "convert":
+        for txt in args.files:
+            out = convert_fir_text(txt, dtype=args.dtype)
+            print(f"{txt} -> {out} ({FirFile(out).num_taps} taps, {args.dtype})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
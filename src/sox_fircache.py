@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Pre-merged noise x harmonic FIR kernels, cached by content hash.
+
+run_sox_fifo.sh applies NOISE_FIR_FILTER -> EQ_INPUT -> HARMONIC_FIR_FILTER.
+When EQ_INPUT is only a gain (MUSIC_TYPE=none -> ``gain -3``) the two FIRs
+are linear and back to back, so they can be convolved offline into one
+kernel and the engine runs a single FIR pass instead of two.  The music
+type EQs are linear too, so sox_dsp.build_chain moves them behind the
+merged kernel and only rescales it for their gain.
+
+Each cache entry holds the merged taps with the ``gain -3`` input gain and
+the FIR_COMPENSATION (+4/+8 dB) already folded in; ``folded_gain_db`` in the
+metadata says how much.  The ``scale_factor``/``comp_db`` header values of
+the source files are recorded too.  The taps in firs/*.txt already carry
+their scale_factor (SoX uses them as-is), so it is not applied a second time.
+
+Usage (build step, also run by scripts/install.sh):
+    python3 sox_fircache.py [--firs DIR] [--cache DIR]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+from sox_fir import (HARMONIC_FIR_FILES, NOISE_FIR_FILES, FirFile, fir_compensation_db, load_fir,
+                     read_fir_header, save_fir_binary)
+
+logger = logging.getLogger("sox_engine")
+
+CACHE_DIR = os.path.expanduser("~/.cache/sox_engine/fir")
+CACHE_VERSION = 1
+# MUSIC_TYPE=none の EQ_INPUT ("gain -3")
+MERGE_INPUT_GAIN_DB = -3.0
+# (path, st_mtime_ns, st_size) -> sha256: チェイン構築のたびに数十万タップの .txt を読み直さない
+_digests = {}
+
+
+def _file_digest(path):
+    st = os.stat(path)
+    stamp = (path, st.st_mtime_ns, st.st_size)
+    digest = _digests.get(stamp)
+    if digest is None:
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        _digests[stamp] = digest
+    return digest
+
+
+def cache_key(noise_path, harmonic_path):
+    """Content hash of the source files (either may be None for 'off')."""
+    h = hashlib.sha256(f"v{CACHE_VERSION}".encode())
+    for path in (noise_path, harmonic_path):
+        h.update(b"\0" + (_file_digest(path).encode() if path else b"off"))
+    return h.hexdigest()[:32]
+
+
+def _source_paths(fir_base_path, noise_type, harmonic_type):
+    noise = NOISE_FIR_FILES.get(noise_type)
+    harmonic = HARMONIC_FIR_FILES.get(harmonic_type)
+    return (os.path.join(fir_base_path, noise) if noise else None,
+            os.path.join(fir_base_path, harmonic) if harmonic else None)
+
+
+def build_kernel(noise_path, harmonic_path):
+    """Convolve the two source kernels and fold in input gain + FIR compensation."""
+    parts = [load_fir(p) for p in (noise_path, harmonic_path) if p]
+    taps = parts[0] if len(parts) == 1 else np.convolve(parts[0], parts[1])
+    folded_db = MERGE_INPUT_GAIN_DB + fir_compensation_db(bool(noise_path), bool(harmonic_path))
+    meta = {
+        "version": CACHE_VERSION,
+        "combination": "+".join(os.path.basename(p) if p else "off" for p in (noise_path, harmonic_path)),
+        "taps": len(taps),
+        "folded_gain_db": folded_db,
+        "sources": {},
+    }
+    for path in (noise_path, harmonic_path):
+        if path:
+            meta["sources"][os.path.basename(path)] = read_fir_header(path)
+    return taps * 10.0 ** (folded_db / 20.0), meta
+
+
+class FirCache:
+    """Directory of merged kernels: ``<key>.bin`` (binary FIR format, mmap'd) + ``<key>.json``."""
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def _path(self, key, ext=".bin"):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def load(self, key):
+        try:
+            with open(self._path(key, ".json"), "r") as f:
+                meta = json.load(f)
+            return FirFile(self._path(key)).taps, meta
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, taps, meta):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        save_fir_binary(self._path(key), taps)
+        tmp = self._path(key, ".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._path(key, ".json"))
+
+    def get(self, fir_base_path, noise_type, harmonic_type):
+        """Merged kernel for a combination, building and caching it on a miss.
+
+        Returns ``(taps, meta)`` or None when both FIRs are off.
+        """
+        noise_path, harmonic_path = _source_paths(fir_base_path, noise_type, harmonic_type)
+        if not noise_path and not harmonic_path:
+            return None
+        key = cache_key(noise_path, harmonic_path)
+        entry = self.load(key)
+        if entry is None:
+            logger.info("FIR cache miss (%s x %s); building kernel", noise_type, harmonic_type)
+            taps, meta = build_kernel(noise_path, harmonic_path)
+            try:
+                self.store(key, taps, meta)
+                self.evict_combination(meta["combination"], key)
+            except OSError as e:
+                logger.warning("Could not write FIR cache %s: %s", self.cache_dir, e)
+            entry = (taps, meta)
+        return entry
+
+    def build_all(self, fir_base_path):
+        """Precompute every noise x harmonic combination and evict stale entries."""
+        live = set()
+        for noise_type in list(NOISE_FIR_FILES) + ["off"]:
+            for harmonic_type in list(HARMONIC_FIR_FILES) + ["off"]:
+                noise_path, harmonic_path = _source_paths(fir_base_path, noise_type, harmonic_type)
+                if not noise_path and not harmonic_path:
+                    continue
+                key = cache_key(noise_path, harmonic_path)
+                live.add(key)
+                if self.load(key) is None:
+                    taps, meta = build_kernel(noise_path, harmonic_path)
+                    self.store(key, taps, meta)
+                    logger.info("built %s x %s: %d taps -> %s", noise_type, harmonic_type, len(taps), key)
+        return self.evict(live)
+
+    def evict_combination(self, combination, keep_key):
+        """Drop older entries built for the same source files (their content changed)."""
+        live = set()
+        for name in os.listdir(self.cache_dir):
+            key = name.split(".", 1)[0]
+            if key == keep_key or key in live:
+                live.add(key)
+                continue
+            entry = self.load(key)
+            if entry is None or entry[1].get("combination") != combination:
+                live.add(key)
+        return self.evict(live)
+
+    def evict(self, live):
+        """Remove entries whose source .txt files have changed (key no longer live)."""
+        removed = []
+        if not os.path.isdir(self.cache_dir):
+            return removed
+        for name in os.listdir(self.cache_dir):
+            if name.split(".", 1)[0] not in live:
+                os.remove(os.path.join(self.cache_dir, name))
+                removed.append(name)
+                logger.info("evicted stale FIR cache entry %s", name)
+        return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the merged noise x harmonic FIR cache")
+    parser.add_argument("--firs", default=os.path.dirname(os.path.abspath(__file__)),
+                        help="directory holding noise_fir_*.txt / harmonic_*.txt")
+    parser.add_argument("--cache", default=CACHE_DIR)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    removed = FirCache(args.cache).build_all(args.firs)
+    logger.info("FIR cache ready in %s (%d stale entries removed)", args.cache, len(removed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,17 +5,20 @@ import time
 import threading
 import json
 import os
-from tkinter import PhotoImage
-from PIL import Image, ImageTk # Pillow をインポート
-import io # バイトデータを扱うためにインポート
-import requests # URLから画像を取得するためにインポート
-from mpd import MPDClient, MPDError # python-mpd2 をインポート
+from PIL import ImageTk # Pillow をインポート
 import logging
 from logging.handlers import RotatingFileHandler
-import shutil
 import tempfile
 import re
-import glob
+
+from sox_albumart import ArtFetcher, ArtRenderer, MpdArtSource
+from sox_buftune import ENGINE_CONFIG_KEYS
+from sox_eq import EQ_OUTPUT_EQ, MUSIC_TYPE_EQ
+from sox_metrics import DEFAULT_SOCKET as METRICS_SOCKET, format_health, read_metrics
+from sox_mpd import MpdEvents
+from sox_rooms import room_names
+from sox_settings import (HARMONIC_FIR_TYPES, NOISE_FIR_TYPES, OUTPUT_METHODS, PRESETS_FILE, RESAMPLE_QUALITIES,
+                          Settings, SettingsStore)
 
 
 LOG_FILE = os.path.expanduser("~/.sox_gui.log")
@@ -31,34 +34,38 @@ logger.addHandler(handler)
 
 # --- 定数 ---
 CONFIG_FILE = os.path.expanduser("~/.sox_gui_config.json")
-RUN_SOX_FIFO_SH = "/home/tysbox/bin/run_sox_fifo.sh" # シェルスクリプトのパス
+SETTINGS_FILE = "/home/tysbox/bin/sox_settings.json" # エフェクト設定 (run_sox_fifo.sh とエンジンが起動時に読む)
+CTL_PATH = "/tmp/sox.ctl" # 再生中エンジンへの設定通知 (run_sox_fifo.sh の CTL_PATH)
 DEFAULT_ALBUM_ART_PATH = "/home/tysbox/bin/istockphoto-178572410-612x612.png" # デフォルト画像パス
 ALBUM_ART_SIZE = (250, 250) # 表示するアルバムアートのサイズ
 
 # MPD接続設定
 MPD_HOST = 'localhost'
 MPD_PORT = 6600
-MPD_POLL_INTERVAL = 2 # MPDポーリング間隔（秒）
+HEALTH_POLL_INTERVAL = 1 # Engine Health 表示の更新間隔（秒）
 
 # --- 各種エフェクト、フィルタ、再生方法設定値 ---
-DEFAULT_MUSIC_TYPES = ["jazz", "classical", "electronic", "vocal", "none"]
-DEFAULT_EFFECTS_TYPES = ["Viena-Symphony-Hall", "Suntory-Music-Hall", "NewMorning-JazzClub",
-                         "Wembley-Studium", "AbbeyRoad-Studio", "vinyl", "none"]
-DEFAULT_EQ_OUTPUT_TYPES = ["studio-monitors", "JBL-Speakers", "planar-magnetic", "bt-earphones",
-                           "Tube-Warmth", "Crystal-Clarity", "none"]
-DEFAULT_OUTPUT_METHODS = ["aplay", "soxplay"]
-DEFAULT_NOISE_FIR_TYPES = ["default", "light", "medium", "strong", "off"] # シェルスクリプトのcaseに合わせる
-DEFAULT_HARMONIC_FIR_TYPES = ["dynamic", "dead", "base", "med", "high", "off"] # シェルスクリプトのcaseに合わせる
-
-# Presets external file (effects/eq lists + optional named presets)
-PRESETS_FILE = os.path.expanduser("/home/tysbox/bin/presets.json")
+# Music Type / EQ Output の一覧は sox_eq.py のプリセット表 (エンジン・シェルスクリプトと共有) から作る
+DEFAULT_MUSIC_TYPES = list(MUSIC_TYPE_EQ)
+DEFAULT_EFFECTS_TYPES = room_names() # sox_rooms.py の部屋の表 (エンジン・シェルスクリプトと共有)
+DEFAULT_EQ_OUTPUT_TYPES = list(EQ_OUTPUT_EQ)
+# 選択肢は sox_settings.py の設定スキーマ (シェルスクリプトの case と揃えてある) から作る
+DEFAULT_OUTPUT_METHODS = list(OUTPUT_METHODS)
+DEFAULT_NOISE_FIR_TYPES = list(NOISE_FIR_TYPES)
+DEFAULT_HARMONIC_FIR_TYPES = list(HARMONIC_FIR_TYPES)
+DEFAULT_RESAMPLE_QUALITIES = list(RESAMPLE_QUALITIES)
+# リサンプラー品質ごとの CPU 負荷の計測 (sox_bench.py --only 'resample-*') の結果
+RESAMPLE_COST_FILE = os.path.expanduser("~/.cache/sox_engine/resample_cost.json")
+SOX_BENCH_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sox_bench.py")
+
+# Presets external file (effects/eq lists + optional named presets): PRESETS_FILE は sox_settings.py
 
 def load_presets():
     """Load global presets/effects/eq lists from PRESETS_FILE and return a dict with keys 'effects','eq_outputs','presets'.
     If file missing or invalid, create a default structure and return it."""
     defaults = {
-        "effects": ["Viena-Symphony-Hall","Suntory-Music-Hall","NewMorning-JazzClub","Wembley-Studium","AbbeyRoad-Studio","vinyl","none"],
-        "eq_outputs": ["studio-monitors","JBL-Speakers","planar-magnetic","bt-earphones","Tube-Warmth","Crystal-Clarity","Monitor-Sim","none"],
+        "effects": DEFAULT_EFFECTS_TYPES.copy(),
+        "eq_outputs": DEFAULT_EQ_OUTPUT_TYPES.copy(),
         "presets": {}
     }
     try:
@@ -98,6 +105,7 @@ def load_config():
     config.setdefault("output_device", "BlueALSA") # 新しい設定: 出力デバイス (デフォルト BlueALSA)
     config.setdefault("crossfeed_enabled", "false")
     config.setdefault("crossfeed_preset", "off")
+    config.setdefault("resample_quality", "very-high")
     config.setdefault("presets", {})
 
     # 古いプリセット形式からの移行（もし必要なら）
@@ -111,7 +119,17 @@ def save_config(config):
     """Save config atomically to avoid corruption from partial writes.
     Creates a temp file on the same filesystem and replaces the real file.
     Falls back to direct write on failure but logs the exception.
+    Keys written by the engine (ENGINE_CONFIG_KEYS, e.g. learned buffer sizes) are taken from disk.
     """
+    # エンジン/supervisor が書き込むキーはディスク上の値を優先 (GUI 起動時の古い値で上書きしない)
+    try:
+        with open(CONFIG_FILE, "r") as f:
+            on_disk = json.load(f)
+        for key in ENGINE_CONFIG_KEYS:
+            if key in on_disk:
+                config[key] = on_disk[key]
+    except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+        pass
     dirpath = os.path.dirname(CONFIG_FILE) or '.'
     fd, tmp_path = tempfile.mkstemp(dir=dirpath)
     try:
@@ -139,25 +157,16 @@ def save_config(config):
 
 
 def validate_settings(config):
-    """設定の妥当性を簡易チェックして、無効なキーをリストで返す。"""
+    """設定を検証して (Settings, 無効な項目のリスト) を返す (無効なら Settings は None)。
+
+    値の型と選択肢は sox_settings.Settings が検査する。ここではプリセット名と
+    ライブ切替のクロスフェード長 (fade_ms、Settings には含まれない) だけを見る。
+    """
     errors = []
     # music_type はデフォルトまたはカスタムプリセットに含まれること
     mt = config.get("music_type", "")
     if mt not in DEFAULT_MUSIC_TYPES and mt not in config.get("music_types", []):
         errors.append("music_type")
-    if config.get("effects_type") not in DEFAULT_EFFECTS_TYPES:
-        errors.append("effects_type")
-    if config.get("eq_output_type") not in DEFAULT_EQ_OUTPUT_TYPES:
-        errors.append("eq_output_type")
-    if config.get("output_method") not in DEFAULT_OUTPUT_METHODS:
-        errors.append("output_method")
-    gain = str(config.get("gain", ""))
-    if not re.match(r'^-?\d+(?:\.\d+)?$', gain):
-        errors.append("gain")
-    if config.get("noise_fir_type") not in DEFAULT_NOISE_FIR_TYPES:
-        errors.append("noise_fir_type")
-    if config.get("harmonic_fir_type") not in DEFAULT_HARMONIC_FIR_TYPES:
-        errors.append("harmonic_fir_type")
     # fade_ms は 0-5000 の整数
     try:
         fm = int(config.get("fade_ms", "0"))
@@ -165,7 +174,12 @@ def validate_settings(config):
             errors.append("fade_ms")
     except Exception:
         errors.append("fade_ms")
-    return errors
+    try:
+        settings = Settings.from_config(config)
+    except ValueError as e:
+        settings = None
+        errors.append(str(e))
+    return (None if errors else settings), errors
 
 
 # --- サービス再起動 ---
@@ -284,111 +298,45 @@ def restart_service():
         logger.exception("Could not schedule interactive restart; advise user to run sudo systemctl restart run_sox_fifo.service")
         logger.info("ターミナルで `sudo systemctl restart run_sox_fifo.service` を実行してください。")
 
-# --- シェルスクリプト書き換え ---
-def update_shell_script(config):
-    """設定をシェルスクリプトに反映する（バックアップ作成、検証、原子書き換え）。"""
-    if not os.path.isfile(RUN_SOX_FIFO_SH):
-        messagebox.showerror("エラー", f"{RUN_SOX_FIFO_SH} が存在しません。")
-        return False
+# --- 設定の保存とエンジンへの通知 ---
+settings_store = SettingsStore(SETTINGS_FILE)
 
-    # 値の妥当性チェック
-    errs = validate_settings(config)
-    if errs:
-        messagebox.showerror("設定エラー", "無効な設定: " + ", ".join(errs))
-        return False
+def send_engine_settings(settings, fade_ms):
+    """Push settings to the running sox_engine.py through CTL_PATH (live switch, no restart).
 
-    timestamp = time.strftime('%Y%m%dT%H%M%S')
-    bak_path = f"{RUN_SOX_FIFO_SH}.bak.{timestamp}"
+    The file is rewritten in place with a single write: run_sox_fifo.sh creates
+    it (mode 666) as the service user, so it cannot be replaced via rename in /tmp.
+    """
+    msg = settings.to_script()
+    # クロスフェード長は設定ではなく今回の切り替え方の指定なので、通知にだけ載せる
+    msg["FADE_MS"] = int(fade_ms)
+    msg["SEQ"] = time.time()
     try:
-        shutil.copy2(RUN_SOX_FIFO_SH, bak_path)
-        logger.info("バックアップを作成しました: %s", bak_path)
-
-        # バックアップ先ディレクトリ
-        backup_dir = "/home/tysbox/bin/backups"
-        os.makedirs(backup_dir, exist_ok=True)
-
-        # バックアップディレクトリに移動
-        bak_path = os.path.join(backup_dir, os.path.basename(bak_path))
-        shutil.move(f"{RUN_SOX_FIFO_SH}.bak.{timestamp}", bak_path)
-        logger.info("バックアップを移動しました: %s", bak_path)
-
-        # バックアップディレクトリ内のバックアップファイル数を制限
-        backup_files = sorted(glob.glob(os.path.join(backup_dir, f"{os.path.basename(RUN_SOX_FIFO_SH)}.bak.*")))
-        max_backups = 10
-        if len(backup_files) > max_backups:
-            for old_backup in backup_files[:-max_backups]:
-                os.remove(old_backup)
-                logger.info("古いバックアップを削除しました: %s", old_backup)
-
-        with open(RUN_SOX_FIFO_SH, 'r') as f:
-            lines = f.readlines()
-
-        new_lines = []
-        settings_to_update = {
-            "MUSIC_TYPE": config["music_type"],
-            "EFFECTS_TYPE": config["effects_type"],
-            "EQ_OUTPUT_TYPE": config["eq_output_type"],
-            "GAIN": config["gain"],
-            "NOISE_FIR_TYPE": config["noise_fir_type"],
-            "HARMONIC_FIR_TYPE": config["harmonic_fir_type"],
-            "OUTPUT_METHOD": config["output_method"],
-            "FADE_MS": config.get("fade_ms", "150"),
-            "OUTPUT_DEVICE": config.get("output_device", "BlueALSA"),
-            "CROSSFEED_ENABLED": config.get("crossfeed_enabled", "false"),
-            "CROSSFEED_PRESET": config.get("crossfeed_preset", "off")
-        }
-
-        for line in lines:
-            updated = False
-            for key, value in settings_to_update.items():
-                if line.strip().startswith(f'{key}='):
-                    # 値を安全にエスケープ（改行とダブルクォート、バックスラッシュを除去/エスケープ）
-                    safe_val = str(value).replace('\n', '').replace('"', '\\"').replace('\\', '\\\\')
-                    new_lines.append(f'{key}="{safe_val}"\n')
-                    updated = True
-                    break
-            if updated:
-                continue
-            new_lines.append(line)
-
-        # 原子的に書き込む
-        dirpath = os.path.dirname(RUN_SOX_FIFO_SH) or '.'
-        fd, tmp_path = tempfile.mkstemp(dir=dirpath)
-        try:
-            with os.fdopen(fd, 'w') as tf:
-                tf.writelines(new_lines)
-            shutil.copymode(RUN_SOX_FIFO_SH, tmp_path)
-
-            # 書き込み後に bash の構文チェックを行う
-            subprocess.run(['/bin/bash', '-n', tmp_path], check=True, capture_output=True, text=True)
+        with open(CTL_PATH, "w") as f:
+            f.write(json.dumps(msg))
+        logger.info("Sent live settings to engine via %s", CTL_PATH)
+        return True
+    except OSError as e:
+        logger.warning("Could not write control file %s: %s", CTL_PATH, e)
+        return False
 
-            # 問題なければ差し替え
-            os.replace(tmp_path, RUN_SOX_FIFO_SH)
-            logger.info("%s を更新しました。バックアップ: %s", RUN_SOX_FIFO_SH, bak_path)
-            return True
-        finally:
-            if os.path.exists(tmp_path):
-                try:
-                    os.remove(tmp_path)
-                except Exception:
-                    pass
 
-    except subprocess.CalledProcessError as e:
-        # 構文チェック失敗: バックアップから復元
-        try:
-            shutil.copy2(bak_path, RUN_SOX_FIFO_SH)
-        except Exception:
-            pass
-        logger.error("スクリプトの構文チェックに失敗しました: %s", e.stderr)
-        messagebox.showerror("エラー", f"スクリプトの構文チェックに失敗しました。変更を元に戻しました。\n{e.stderr}")
-        return False
-    except Exception as e:
-        logger.exception("シェルスクリプト更新中にエラー: %s", e)
-        messagebox.showerror("エラー", f"{RUN_SOX_FIFO_SH} の更新に失敗しました: {e}")
+def save_engine_settings(settings):
+    """検証済みの Settings を SETTINGS_FILE に新しい版として保存する (シェルスクリプトは書き換えない)。"""
+    try:
+        version = settings_store.save(settings)
+    except OSError as e:
+        logger.exception("設定ファイルの保存に失敗しました: %s", e)
+        messagebox.showerror("エラー", f"{SETTINGS_FILE} の保存に失敗しました: {e}")
         return False
+    logger.info("%s を保存しました (version %d)", SETTINGS_FILE, version)
+    return True
 
 # --- 設定適用 ---
 def apply_settings():
+    # 再生中のエンジンへライブ反映できるかの判定用 (出力方法/デバイスの変更は再起動が必要)
+    running_method = config.get("output_method")
+    running_device = config.get("output_device")
     selected_music_type = music_listbox.get(tk.ACTIVE) if music_listbox.curselection() else config["music_type"]
 
     # プリセット適用 or 個別設定取得
@@ -422,6 +370,8 @@ def apply_settings():
             config["crossfeed_preset"] = preset.get("crossfeed_preset", ui_values["crossfeed_preset"])
             config["output_method"] = ui_values["output_method"]
             config["fade_ms"] = ui_values["fade_ms"]
+        # リサンプラー品質は出力側の設定なのでプリセットに関係なく UI の値
+        config["resample_quality"] = resample_quality_var.get()
     else:
         config["music_type"] = selected_music_type
         config["effects_type"] = effects_var.get()
@@ -433,6 +383,7 @@ def apply_settings():
         config["fade_ms"] = fade_ms_var.get()
         config["crossfeed_enabled"] = crossfeed_enabled_var.get()
         config["crossfeed_preset"] = crossfeed_preset_var.get()
+        config["resample_quality"] = resample_quality_var.get()
 
     # Note: output_device is managed via presets and edit dialog; no main-device combobox by default.
 
@@ -443,17 +394,22 @@ def apply_settings():
     print("適用される設定:")
     print(json.dumps(config, indent=2))
 
-    # 設定の妥当性を簡易チェックする
-    errs = validate_settings(config)
+    # 設定の妥当性をチェックする
+    settings, errs = validate_settings(config)
     if errs:
         messagebox.showerror("設定エラー", "無効な設定: " + ", ".join(errs))
         return
 
-    if update_shell_script(config):
+    if save_engine_settings(settings):
         save_config(config)
+        live = (config["output_method"] == "engine" and running_method == "engine"
+                and config.get("output_device") == running_device)
+        if live and send_engine_settings(settings, config["fade_ms"]):
+            messagebox.showinfo("設定適用", "設定を再生中のエンジンに反映しました (再起動なし)。")
+            return
         # サービス再起動を別スレッドで実行
         threading.Thread(target=restart_service, daemon=True).start()
-        messagebox.showinfo("設定適用", "設定をシェルスクリプトに反映し、サービス再起動を開始しました。")
+        messagebox.showinfo("設定適用", "設定を保存し、サービス再起動を開始しました。")
 
 # --- GUI表示をconfigに基づいて更新 ---
 def update_gui_from_config():
@@ -482,6 +438,7 @@ def update_gui_from_config():
         fade_ms_var.set(config.get("fade_ms", "150"))
         crossfeed_enabled_var.set(config.get("crossfeed_enabled", "false"))
         crossfeed_preset_var.set(config.get("crossfeed_preset", "off"))
+        resample_quality_var.set(config.get("resample_quality", "very-high"))
     except NameError:
         pass
 
@@ -697,237 +654,74 @@ def display_settings():
     settings_text += f"Output EQ: {config['eq_output_type']}\n"
     settings_text += f"Effects: {config['effects_type']}\n"
     settings_text += f"Gain: {config['gain']} dB | "
-    settings_text += f"Output: {config['output_method']}\n"
+    settings_text += f"Output: {config['output_method']} | "
+    settings_text += f"Resampler: {config.get('resample_quality', 'very-high')}\n"
     settings_text += f"Crossfeed: {config.get('crossfeed_enabled','false')} ({config.get('crossfeed_preset','off')})"
     settings_label.config(text=settings_text)
 
 # --- アルバムアート関連 ---
-def extract_main_artist(artist_field):
-    """
-    複数アーティストが混在するartistフィールドから、検索に適したメインアーティスト名を抽出
-    例:
-      'CHICK COREA; Christian McBride, CHICK COREA' → 'CHICK COREA'
-    """
-    if not artist_field:
-        return ""
-
-    # セミコロンで区切られていたら、最初のアーティストを使う
-    if ";" in artist_field:
-        return artist_field.split(";")[0].strip()
-
-    # カンマでも同様に分割
-    if "," in artist_field:
-        return artist_field.split(",")[0].strip()
-
-    return artist_field.strip()
-
-def fetch_album_art_from_itunes(artist, album):
-    try:
-        logger.debug("iTunes lookup: %s - %s", artist, album)
-        query = f"{artist} {album}".replace(" ", "+")
-        url = f"https://itunes.apple.com/search?term={query}&entity=album&limit=1"
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        results = response.json().get("results")
-        if results:
-            art_url = results[0].get("artworkUrl100")
-            if art_url:
-                art_url = art_url.replace("100x100", "600x600")
-                return fetch_art_from_url(art_url)
-        logger.debug("iTunes: no artwork for %s - %s", artist, album)
-    except Exception as e:
-        logger.debug("iTunes lookup error: %s", e)
-    return None
-
-
-def fetch_album_art_from_musicbrainz(artist, album):
-    try:
-        logger.debug("MusicBrainz lookup: %s - %s", artist, album)
-        headers = {"User-Agent": "sox-gui/1.0 (tysbox@example.com)"}
-        query = f'"{album}" AND artist:"{artist}"'
-        url = f"https://musicbrainz.org/ws/2/release/?query={query}&fmt=json&limit=1"
-        response = requests.get(url, headers=headers, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        releases = data.get("releases", [])
-        if not releases:
-            logger.debug("MusicBrainz: no releases for %s - %s", artist, album)
-            return None
-
-        mbid = releases[0].get("id")
-        logger.debug("MusicBrainz release id: %s", mbid)
-
-        art_url = f"https://coverartarchive.org/release/{mbid}/front-500.jpg"
-        return fetch_art_from_url(art_url)
-
-    except Exception as e:
-        logger.debug("MusicBrainz/CoverArt error: %s", e)
-        return None
-
-def fetch_album_art(mpd_client):
-    try:
-        status = mpd_client.status()
-        song_id = status.get('songid')
-        if not song_id:
-            return None
-        current_song = mpd_client.currentsong()
-        if not current_song:
-            return None
-
-        logger.info(f"現在の曲情報: {current_song}")
-
-        # 1. albumart タグ（最優先）
-        if 'albumart' in current_song:
-            art_uri = current_song['albumart']
-            if art_uri.startswith('http'):
-                return fetch_art_from_url(art_uri)
-            elif os.path.exists(art_uri):
-                return load_art_from_path(art_uri)
-
-        # 2. アーティストとアルバムの取得＋整形
-        artist_raw = current_song.get("artist")
-        album = current_song.get("album")
-        if not artist_raw or not album:
-            return None
-
-        # 🔧 複数アーティスト・作曲家混在時の対策
-        artist = extract_main_artist(artist_raw)
-
-        # 3. iTunes API を優先的に使う
-        art = fetch_album_art_from_itunes(artist, album)
-        if art:
-            return art
-
-        # 4. iTunesで見つからない → MusicBrainzを使う
-        art = fetch_album_art_from_musicbrainz(artist, album)
-        if art:
-            return art
-
-        # 見つからなかった場合
-        logger.warning(f"アルバムアートが見つかりませんでした: {artist} - {album}")
-        return None
-
-    except MPDError as e:
-        logger.error(f"MPDステータス取得エラー: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"アルバムアート取得中に予期せぬエラー: {e}", exc_info=True)
-        return None
-
-def fetch_art_from_url(url):
-    try:
-        logger.debug("Fetching album art URL: %s", url)
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        logger.debug("Fetched album art: status=%s size=%s", response.status_code, len(response.content))
-        return process_image_data(response.content)
-    except requests.exceptions.RequestException as e:
-        logger.debug("fetch_art_from_url request error %s: %s", url, e)
-        return None
-    except Exception as e:
-        logger.exception("fetch_art_from_url processing error: %s", e)
-        return None
-        
-def load_art_from_path(path):
-    try:
-        with open(path, 'rb') as f:
-            image_data = f.read()
-        return process_image_data(image_data)
-    except FileNotFoundError:
-        logger.debug("Local album art file not found: %s", path)
-        return None
-    except Exception as e:
-        logger.debug("load_art_from_path error: %s", e)
-        return None
-
-
-def process_image_data(image_data):
-    try:
-        img = Image.open(io.BytesIO(image_data)).convert('RGBA')
-        w, h = img.size
-        m = min(w, h)
-        img = img.crop(((w-m)//2, (h-m)//2, (w+m)//2, (h+m)//2))
-        tw = album_art_label.winfo_width()
-        th = album_art_label.winfo_height()
-        if tw < 10 or th < 10:
-            size = 2500
-        else:
-            size = min(tw, th)
-        img = img.resize((size, size), Image.Resampling.LANCZOS)
-        logger.info("画像リサイズ成功: %s", img.size)
-        return ImageTk.PhotoImage(img)
-    except Exception as e:
-        logger.exception("画像データ処理エラー: %s", e)
-        return None
-        
-def update_album_art_display(photo_image):
-    if photo_image:
-        album_art_label.config(image=photo_image)
-        album_art_label.image = photo_image # 参照を保持
-    else:
-        # デフォルト画像表示
+# 取得は sox_albumart.ArtFetcher のワーカースレッドとディスクキャッシュ (~/.cache/sox_gui/albumart)、
+# デコードと縮小は ArtRenderer のワーカープールで行い、Tk スレッドでは PhotoImage を作るだけにする
+def album_art_target_size():
+    tw = album_art_label.winfo_width()
+    th = album_art_label.winfo_height()
+    if tw < 10 or th < 10:
+        # まだレイアウトされていない: 既定のサイズで描画し、<Configure> で描き直す
+        return min(ALBUM_ART_SIZE)
+    return min(tw, th)
+
+default_art_data = None
+
+def load_default_art():
+    """Bytes of DEFAULT_ALBUM_ART_PATH, read from disk once."""
+    global default_art_data
+    if default_art_data is None:
         try:
-            default_image = Image.open(DEFAULT_ALBUM_ART_PATH)
-            target_width = album_art_label.winfo_width()
-            target_height = album_art_label.winfo_height()
-            if target_width < 10 or target_height < 10:
-               size = 2500
-            else:
-               size = min(target_width, target_height)
-
-            default_image = default_image.resize((size, size), Image.Resampling.LANCZOS)
-            default_photo = ImageTk.PhotoImage(default_image)
-            album_art_label.config(image=default_photo)
-            album_art_label.image = default_photo
-
-        except Exception as e:
-             logger.warning("Default album art load failed: %s", e)
-             album_art_label.config(image=None)
-             album_art_label.image = None
-
-
-def mpd_poller():
-    global mpd_client, last_song_id
-    while True:
-        try:
-            if mpd_client is None:
-                logger.info("MPD connecting...")
-                mpd_client = MPDClient()
-                mpd_client.connect(MPD_HOST, MPD_PORT, timeout=5)
-                logger.info("MPD connected (v%s)", mpd_client.mpd_version)
-                last_song_id = None
-
-            status = mpd_client.status()
-            current_song_id = status.get('songid')
-            if current_song_id != last_song_id:
-                logger.debug("Detected song change: %s -> %s", last_song_id, current_song_id)
-                new_art = fetch_album_art(mpd_client)
-                root.after(0, update_album_art_display, new_art)
-                last_song_id = current_song_id
-
-            mpd_client.ping()
-
-        except (MPDError, ConnectionError, TimeoutError, OSError) as e:
-            logger.warning("MPD connection error or disconnect: %s", e)
-            if mpd_client:
-                try:
-                    mpd_client.close()
-                    mpd_client.disconnect()
-                except:
-                    pass
-            mpd_client = None
-            last_song_id = None
-            root.after(0, update_album_art_display, None)
-            time.sleep(MPD_POLL_INTERVAL * 2)
-            continue
+            with open(DEFAULT_ALBUM_ART_PATH, 'rb') as f:
+                default_art_data = f.read()
+        except OSError as e:
+            logger.warning("Default album art load failed: %s", e)
+            default_art_data = b""
+    return default_art_data
+
+def render_album_art(image_data):
+    """Any thread: show art bytes (None = default image) once rendered off the Tk thread."""
+    global current_art_data
+    current_art_data = image_data
+    data = image_data or load_default_art()
+    if not data:
+        root.after(0, show_rendered_art, None, art_renderer.latest)
+        return
+    art_renderer.render(data, album_art_size or min(ALBUM_ART_SIZE),
+                        lambda img, token: root.after(0, show_rendered_art, img, token))
 
-        except Exception as e:
-             logger.exception("Unexpected error during MPD polling: %s", e)
-             time.sleep(MPD_POLL_INTERVAL * 2)
-             continue
+def show_rendered_art(img, token):
+    """Tk thread: wrap the rendered image in a PhotoImage (skipped if a newer render is pending)."""
+    if token != art_renderer.latest:
+        return
+    if img is None and current_art_data:
+        # デコードできなかった画像の代わりにデフォルト画像を出す
+        render_album_art(None)
+        return
+    photo_image = ImageTk.PhotoImage(img) if img is not None else ''
+    album_art_label.config(image=photo_image)
+    album_art_label.image = photo_image # 参照を保持
 
 
-        time.sleep(MPD_POLL_INTERVAL)
+def on_mpd_event(event):
+    """MPD event (sox_mpd.MpdEvents thread): look up the album art when the song changes."""
+    global last_song_id
+    if "disconnect" in event.changed:
+        last_song_id = None
+        art_fetcher.request(None)
+        return
+    current_song_id = event.status.get('songid')
+    if current_song_id != last_song_id:
+        logger.debug("Detected song change: %s -> %s", last_song_id, current_song_id)
+        logger.info(f"現在の曲情報: {event.song}")
+        # 取得はワーカースレッドで行い、MPD のイベント処理は止めない
+        art_fetcher.request(event.song or None, album_art_size)
+        last_song_id = current_song_id
 
 # --- スクロール可能フレームクラス ---
 class ScrollableFrame(ttk.Frame):
@@ -1157,6 +951,56 @@ method_lf.pack(fill=tk.X, pady=(0, 10))
 for method in DEFAULT_OUTPUT_METHODS:
     ttk.Radiobutton(method_lf, text=method, variable=output_method_var, value=method).pack(side=tk.LEFT, padx=5)
 
+# Resampler Quality (入力と出力のレートが同じ場合はリサンプルしないため負荷なし)
+resample_quality_var = tk.StringVar(value=config.get("resample_quality", "very-high"))
+resample_lf = ttk.LabelFrame(gain_output_tab, text="Resampler Quality", padding=6)
+resample_lf.pack(fill=tk.X, pady=(0, 10))
+resample_buttons = {}
+for quality in DEFAULT_RESAMPLE_QUALITIES:
+    rb = ttk.Radiobutton(resample_lf, text=quality, variable=resample_quality_var, value=quality)
+    rb.pack(side=tk.LEFT, padx=5)
+    resample_buttons[quality] = rb
+
+def load_resample_costs():
+    """``{quality: percent of one CPU core}`` from the last measurement (192k -> 96k)."""
+    try:
+        with open(RESAMPLE_COST_FILE, "r") as f:
+            report = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    costs = {}
+    for result in report.get("results", []):
+        quality = result.get("settings", {}).get("RESAMPLE_QUALITY")
+        audio_s = result.get("audio_seconds") or 0
+        cpu = sum(s["cpu_s"] for s in result.get("stages", []) if s.get("stage") == "resample")
+        if quality and audio_s:
+            costs[quality] = 100.0 * cpu / audio_s
+    return costs
+
+def show_resample_costs():
+    costs = load_resample_costs()
+    for quality, rb in resample_buttons.items():
+        rb.config(text=f"{quality} ({costs[quality]:.1f}% CPU)" if quality in costs else quality)
+
+def measure_resample_costs():
+    """Run sox_bench.py for the resampler tiers in the background, then refresh the labels."""
+    def worker():
+        try:
+            os.makedirs(os.path.dirname(RESAMPLE_COST_FILE), exist_ok=True)
+            subprocess.run(["python3", SOX_BENCH_PY, "--only", "resample-*", "--seconds", "5",
+                            "-o", RESAMPLE_COST_FILE], check=True, capture_output=True, timeout=300)
+            logger.info("Measured resampler costs: %s", load_resample_costs())
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning("Resampler cost measurement failed: %s", e)
+        root.after(0, show_resample_costs)
+        root.after(0, lambda: measure_btn.config(state=tk.NORMAL, text="Measure CPU"))
+    measure_btn.config(state=tk.DISABLED, text="Measuring...")
+    threading.Thread(target=worker, daemon=True).start()
+
+measure_btn = ttk.Button(resample_lf, text="Measure CPU", command=measure_resample_costs)
+measure_btn.pack(side=tk.RIGHT, padx=5)
+show_resample_costs()
+
 # Output Device Section
 device_lf = ttk.LabelFrame(gain_output_tab, text="Output Device", padding=10)
 device_lf.pack(fill=tk.X)
@@ -1249,8 +1093,29 @@ album_art_lf.pack(fill=tk.BOTH, expand=True)
 # アルバムアート表示用ラベル (初期は空かデフォルト画像)
 album_art_label = ttk.Label(album_art_lf, anchor=tk.CENTER)
 album_art_label.pack(fill=tk.BOTH, expand=True, anchor=tk.CENTER)
+
+# アルバムアートの表示サイズ (ワーカースレッドからは Tk を触らずにこの値を使う)
+album_art_size = None
+current_art_data = None
+art_resize_job = None
+art_renderer = ArtRenderer()
+
+def on_album_art_resize(event):
+    """Re-render the current art at the new size (decoded image is cached: only the rescale is redone)."""
+    global album_art_size, art_resize_job
+    size = album_art_target_size()
+    if size == album_art_size:
+        return
+    album_art_size = size
+    # ドラッグ中の連続した <Configure> はまとめて 1 回だけ描き直す
+    if art_resize_job is not None:
+        root.after_cancel(art_resize_job)
+    art_resize_job = root.after(100, lambda: render_album_art(current_art_data))
+
+album_art_label.bind("<Configure>", on_album_art_resize)
 # 初期デフォルト画像読み込み
-update_album_art_display(None)
+render_album_art(None)
+art_fetcher = ArtFetcher(render_album_art, mpd=MpdArtSource(MPD_HOST, MPD_PORT))
 
 # 現在の設定表示エリア (別ペインに配置して垂直リサイズを復旧)
 settings_lf = ttk.LabelFrame(settings_view_frame, text="Current Settings", padding="10")
@@ -1258,6 +1123,13 @@ settings_lf.pack(fill=tk.BOTH, expand=True)
 settings_label = ttk.Label(settings_lf, text="", font=status_font, justify=tk.LEFT, anchor=tk.NW)
 settings_label.pack(fill=tk.BOTH, expand=True)
 
+# 再生状態 (xrun・バッファ充填率・ブロック処理時間・FIFO 滞留量) の表示
+health_lf = ttk.LabelFrame(settings_view_frame, text="Engine Health", padding="10")
+health_lf.pack(fill=tk.X, expand=False, pady=(5, 0))
+health_label = tk.Label(health_lf, text=format_health(None), font=status_font, justify=tk.LEFT, anchor=tk.NW)
+health_label.pack(fill=tk.X, expand=True)
+health_default_fg = health_label.cget("foreground")
+
 # 起動時の位置と比率を復元
 root.geometry(config.get("window_geometry", "2000x1500"))
 
@@ -1285,8 +1157,7 @@ root.after(500, restore_panes)
 update_gui_from_config() # GUIの初期状態を設定ファイルに合わせる
 display_settings()      # 下部の設定表示を更新
 
-# MPDポーリング用変数
-mpd_client = None
+# MPD イベント (idle) で最後に見た曲
 last_song_id = None
 
 def on_closing():
@@ -1312,7 +1183,7 @@ def on_closing():
 root.protocol("WM_DELETE_WINDOW", on_closing)
 
 def update_output_device(device_id):
-    """Apply the selected output device: update shell script, save to config and trigger service restart.
+    """Apply the selected output device: save the settings file and config, then trigger a service restart.
 
     device_id can be 'bluealsa', 'hw:0', or 'hw:X'.
     """
@@ -1320,8 +1191,13 @@ def update_output_device(device_id):
         # normalize
         did = str(device_id)
         config["output_device"] = did
-        # Update shell script so the service picks it up
-        update_shell_script(config)
+        settings, errs = validate_settings(config)
+        if errs:
+            messagebox.showerror("設定エラー", "無効な設定: " + ", ".join(errs))
+            return
+        # Save the settings file so the service picks it up
+        if not save_engine_settings(settings):
+            return
         save_config(config)
         # Restart service to pick up new device
         threading.Thread(target=restart_service, daemon=True).start()
@@ -1330,9 +1206,34 @@ def update_output_device(device_id):
         logger.exception("出力デバイス適用に失敗しました: %s", e)
         messagebox.showerror("エラー", f"出力デバイスの適用に失敗しました: {e}")
 
+last_health_xruns = None
+
+def update_health_display(snap):
+    """Show a metrics snapshot; red while xruns increase or p99 block time exceeds the deadline."""
+    global last_health_xruns
+    warn = False
+    if snap is not None:
+        block_p99 = snap.get("block_ms", {}).get("p99")
+        deadline = snap.get("deadline_ms")
+        warn = (last_health_xruns is not None and snap.get("xruns", 0) > last_health_xruns) or \
+               (block_p99 is not None and deadline and block_p99 > deadline)
+        last_health_xruns = snap.get("xruns", 0)
+    health_label.config(text=format_health(snap), foreground="red" if warn else health_default_fg)
+
+def health_poller():
+    """Poll the engine/supervisor metrics socket (sox_metrics.py) off the Tk thread."""
+    while True:
+        snap = read_metrics(METRICS_SOCKET)
+        root.after(0, update_health_display, snap)
+        time.sleep(HEALTH_POLL_INTERVAL)
+
 # GUIループ (直接実行時のみ開始する)
 if __name__ == "__main__":
-    mpd_thread = threading.Thread(target=mpd_poller, daemon=True)
-    mpd_thread.start()
+    # ポーリングせず MPD の idle で曲の変化を受け取る (接続が切れたらバックオフして再接続)
+    mpd_events = MpdEvents(MPD_HOST, MPD_PORT, subsystems=("player",))
+    mpd_events.subscribe(on_mpd_event)
+    mpd_events.start()
+    health_thread = threading.Thread(target=health_poller, daemon=True)
+    health_thread.start()
 
     root.mainloop()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Room impulse responses for the EFFECTS_TYPE reverb, built on first use and cached.
+
+An IR is only built when a chain with that room is built (so the engine
+never loads IRs it does not play), at the rate the reverb runs at:
+
+* a measured IR, ``<FIR_BASE_PATH>/ir/<room>.wav`` (mono or stereo, any
+  rate; resampled to the chain rate), if present;
+* otherwise one synthesized from the sox_rooms.ROOMS parameters: the direct
+  sound, the early reflections after the predelay, and a decorrelated
+  stereo tail of exponentially decaying noise with separate decay times
+  below 500 Hz / 500 Hz-4 kHz / above 4 kHz.  The random generator is
+  seeded by the room name, so the IR is the same on every build.
+
+Both are normalized to unit energy per channel, so switching rooms keeps
+the loudness.  Results are stored as ``<room>@<rate>-<key>.npy`` in
+``~/.cache/sox_engine/ir`` (memory-mapped on load); the key hashes the room
+parameters or the WAV content, and older entries of the same room and rate
+are removed when a new one is stored.
+
+    python3 sox_ircache.py [--rate 192000 ...] [--ir-dir DIR]   # prebuild every room
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+
+import numpy as np
+from scipy import signal
+from scipy.io import wavfile
+
+from sox_rooms import ROOMS
+
+logger = logging.getLogger("sox_engine")
+
+CACHE_DIR = os.path.expanduser("~/.cache/sox_engine/ir")
+CACHE_VERSION = 1
+MAX_IR_SECONDS = 4.0
+# 残響の帯域分割 (Hz)
+LOW_SPLIT = 500.0
+HIGH_SPLIT = 4000.0
+
+
+def is_room(name):
+    """True for the EFFECTS_TYPE values that are convolved (not ``vinyl`` / ``none``)."""
+    return "rt60" in ROOMS.get(name, {})
+
+
+def _decay(t, rt60):
+    # RT60: 振幅が -60 dB (1/1000) になるまでの時間
+    return np.exp(-math.log(1000.0) * t / rt60)
+
+
+def synthesize_ir(name, rate):
+    """Stereo IR ``(frames, 2)`` for a room of sox_rooms.ROOMS."""
+    room = ROOMS[name]
+    rt60 = room["rt60"]
+    predelay = room["predelay_ms"] / 1000.0
+    frames = int(min(MAX_IR_SECONDS, predelay + rt60 * max(1.0, room["low"])) * rate)
+    rng = np.random.default_rng(int(hashlib.sha256(name.encode()).hexdigest()[:8], 16))
+    t = np.arange(frames) / float(rate)
+    tau = np.maximum(t - predelay, 0.0)
+    # 拡散音の立ち上がり (先行反射の後に密度が上がる)
+    onset = np.where(t >= predelay, 1.0 - np.exp(-tau / (0.01 + 0.02 * rt60)), 0.0)
+
+    noise = rng.standard_normal((frames, 2))
+    # width: 左右の残響の無相関度
+    corr = 1.0 - room["width"]
+    noise[:, 1] = corr * noise[:, 0] + math.sqrt(1.0 - corr * corr) * noise[:, 1]
+    lo = signal.butter(4, LOW_SPLIT, "lowpass", fs=rate, output="sos")
+    mid = signal.butter(2, (LOW_SPLIT, HIGH_SPLIT), "bandpass", fs=rate, output="sos")
+    hi = signal.butter(4, HIGH_SPLIT, "highpass", fs=rate, output="sos")
+    tail = np.zeros((frames, 2))
+    for sos, scale in ((lo, room["low"]), (mid, 1.0), (hi, room["high"])):
+        tail += signal.sosfilt(sos, noise, axis=0) * (_decay(tau, rt60 * scale) * onset)[:, None]
+    tail /= np.sqrt(np.sum(tail * tail, axis=0))
+
+    ir = tail * 10.0 ** (room["wet_db"] / 20.0)
+    ir[0] += 1.0
+    for k, (delay_ms, gain_db) in enumerate(room["early"]):
+        n = int((predelay + delay_ms / 1000.0) * rate)
+        # 右チャンネルは少しずらして左右の到達時間差を付ける
+        spread = int(room["width"] * 0.0003 * (k + 1) * rate)
+        sign = -1.0 if k % 2 else 1.0
+        for ch, pos in ((0, n), (1, n + spread)):
+            if pos < frames:
+                ir[pos, ch] += sign * 10.0 ** (gain_db / 20.0)
+    return ir / np.sqrt(np.sum(ir * ir, axis=0))
+
+
+def load_ir_file(path, rate):
+    """A measured IR from a WAV file as ``(frames, 2)`` at ``rate``, unit energy per channel."""
+    file_rate, data = wavfile.read(path)
+    if data.dtype.kind in "iu":
+        data = data / float(np.iinfo(data.dtype).max)
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = np.stack((data, data), axis=1)
+    data = data[:, :2] if data.shape[1] >= 2 else np.repeat(data, 2, axis=1)
+    if file_rate != rate:
+        g = math.gcd(int(rate), int(file_rate))
+        data = signal.resample_poly(data, rate // g, file_rate // g, axis=0)
+    data = data[:int(MAX_IR_SECONDS * rate)]
+    return data / np.sqrt(np.sum(data * data, axis=0))
+
+
+def build_ir(name, rate, ir_dir=None):
+    """The measured ``<ir_dir>/<name>.wav`` if there is one, else the synthetic IR."""
+    wav_path = os.path.join(ir_dir, name + ".wav") if ir_dir else None
+    if wav_path and os.path.isfile(wav_path):
+        return load_ir_file(wav_path, rate)
+    return synthesize_ir(name, rate)
+
+
+class IrCache:
+    """Directory of built IRs, ``<room>@<rate>-<key>.npy``."""
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def _key(name, rate, wav_path):
+        h = hashlib.sha256(f"v{CACHE_VERSION}\0{name}\0{rate}".encode())
+        if wav_path:
+            with open(wav_path, "rb") as f:
+                h.update(f.read())
+        else:
+            h.update(json.dumps(ROOMS[name], sort_keys=True).encode())
+        return h.hexdigest()[:16]
+
+    def get(self, name, rate, ir_dir=None):
+        """IR for a room at ``rate``, building and caching it on a miss; None for non-rooms."""
+        if not is_room(name):
+            return None
+        wav_path = os.path.join(ir_dir, name + ".wav") if ir_dir else None
+        if wav_path and not os.path.isfile(wav_path):
+            wav_path = None
+        prefix = f"{name}@{int(rate)}-"
+        path = os.path.join(self.cache_dir, prefix + self._key(name, rate, wav_path) + ".npy")
+        try:
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            pass
+        logger.info("IR cache miss (%s @ %d Hz); %s", name, rate, "loading " + wav_path if wav_path else "synthesizing")
+        ir = build_ir(name, rate, ir_dir)
+        try:
+            self.store(path, ir, prefix)
+        except OSError as e:
+            logger.warning("Could not write IR cache %s: %s", self.cache_dir, e)
+        return ir
+
+    def store(self, path, ir, prefix):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, ir)
+        os.replace(tmp, path)
+        # 同じ部屋・レートの古いエントリ (パラメータや WAV が変わった) を削除
+        for entry in os.listdir(self.cache_dir):
+            if entry.startswith(prefix) and os.path.join(self.cache_dir, entry) != path:
+                os.remove(os.path.join(self.cache_dir, entry))
+                logger.info("evicted stale IR cache entry %s", entry)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prebuild the EFFECTS_TYPE room impulse responses")
+    parser.add_argument("--rate", type=int, action="append", help="chain rate(s) (default: 192000)")
+    parser.add_argument("--ir-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ir"),
+                        help="directory with measured <room>.wav IRs")
+    parser.add_argument("--cache", default=CACHE_DIR)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    cache = IrCache(args.cache)
+    for rate in args.rate or [192000]:
+        for name in ROOMS:
+            ir = cache.get(name, rate, args.ir_dir)
+            if ir is not None:
+                logger.info("%s @ %d Hz: %d frames (%.2f s)", name, rate, len(ir), len(ir) / float(rate))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
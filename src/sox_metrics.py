@@ -0,0 +1,283 @@
+"""Playback health metrics: xruns, ALSA buffer fill, block time vs deadline, FIFO backlog.
+
+The engine's I/O thread updates a ``PlaybackMetrics`` once per block (a few
+attribute stores and one ring-buffer write, no allocation).  A
+``MetricsServer`` thread publishes snapshots two ways:
+
+* a Unix socket (METRICS_SOCKET, /tmp/sox_metrics.sock): every connection
+  gets one JSON snapshot and is closed, e.g.
+  ``python3 sox_metrics.py`` or ``socat - UNIX-CONNECT:/tmp/sox_metrics.sock``;
+  sox_gui.py polls it for its "Engine Health" panel;
+* optionally a Prometheus text file (METRICS_PROM), rewritten atomically
+  every few seconds, for node_exporter's textfile collector.
+
+In pipeline mode (sox | aplay under sox_supervisor.py) only the aplay
+underrun count and the FIFO backlog are known.
+
+Standard library only: the GUI imports this without numpy/scipy.
+"""
+import fcntl
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import termios
+import threading
+import time
+
+logger = logging.getLogger("sox_engine")
+
+DEFAULT_SOCKET = "/tmp/sox_metrics.sock"
+PROM_INTERVAL = 2.0
+BLOCK_WINDOW = 1024
+
+
+def fifo_backlog(fd):
+    """Bytes waiting in a pipe/FIFO (FIONREAD); None if the ioctl is not supported."""
+    try:
+        buf = fcntl.ioctl(fd, termios.FIONREAD, b"\0\0\0\0")
+    except OSError:
+        return None
+    return struct.unpack("i", buf)[0]
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+class PlaybackMetrics:
+    """Counters and gauges of one playback path; written by one thread, read by any."""
+
+    def __init__(self, mode="engine", device=None, rate=None, block_frames=None, in_rate=None):
+        self.mode = mode
+        self.device = device
+        self.rate = rate
+        self.block_frames = block_frames
+        # 1 ブロックの処理時間の締め切り = ブロック長 (入力レート換算)
+        self.deadline_s = block_frames / float(in_rate) if block_frames and in_rate else None
+        self.started = time.time()
+        self.state = "idle"
+        self.chain = ""
+        self.xruns = 0
+        self.blocks = 0
+        self.deadline_misses = 0
+        self.last_block_s = 0.0
+        self.buffer_size = None
+        self.buffer_fill = None
+        self.fifo_backlog = None
+        self.resets = 0
+        # MPD の状態 (sox_supervisor.py が sox_mpd のイベントで更新する)
+        self.mpd_state = None
+        self.mpd_audio = None
+        self._times = [0.0] * BLOCK_WINDOW
+        self._lock = threading.Lock()
+
+    def record_block(self, seconds):
+        with self._lock:
+            self._times[self.blocks % BLOCK_WINDOW] = seconds
+            self.blocks += 1
+        self.last_block_s = seconds
+        if self.deadline_s is not None and seconds > self.deadline_s:
+            self.deadline_misses += 1
+
+    def snapshot(self):
+        with self._lock:
+            n = min(self.blocks, BLOCK_WINDOW)
+            times = sorted(self._times[:n])
+        fill_ratio = None
+        if self.buffer_fill is not None and self.buffer_size:
+            fill_ratio = round(self.buffer_fill / float(self.buffer_size), 4)
+        ms = lambda s: None if s is None else round(s * 1000.0, 4)
+        return {
+            "mode": self.mode,
+            "state": self.state,
+            "device": self.device,
+            "rate": self.rate,
+            "chain": self.chain,
+            "uptime_s": round(time.time() - self.started, 1),
+            "xruns": self.xruns,
+            "resets": self.resets,
+            "blocks": self.blocks,
+            "block_frames": self.block_frames,
+            "deadline_ms": ms(self.deadline_s),
+            "deadline_misses": self.deadline_misses,
+            "block_ms": {"last": ms(self.last_block_s) if self.blocks else None,
+                         "p50": ms(_percentile(times, 50)), "p99": ms(_percentile(times, 99)),
+                         "max": ms(times[-1] if times else None)},
+            "buffer_size_frames": self.buffer_size,
+            "buffer_fill_frames": self.buffer_fill,
+            "buffer_fill_ratio": fill_ratio,
+            "fifo_backlog_bytes": self.fifo_backlog,
+            "mpd_state": self.mpd_state,
+            "mpd_audio": self.mpd_audio,
+        }
+
+
+def prometheus_text(snap):
+    """Prometheus text exposition of a snapshot (``sox_playback_*``)."""
+    labels = f'{{mode="{snap["mode"]}",device="{snap["device"] or ""}"}}'
+    lines = []
+
+    def metric(name, kind, value, help_text, extra=""):
+        if value is None:
+            return
+        lines.append(f"# HELP sox_playback_{name} {help_text}")
+        lines.append(f"# TYPE sox_playback_{name} {kind}")
+        lab = labels if not extra else labels[:-1] + "," + extra + "}"
+        lines.append(f"sox_playback_{name}{lab} {value}")
+
+    metric("up", "gauge", 1 if snap["state"] == "playing" else 0, "1 while audio is flowing")
+    metric("xruns_total", "counter", snap["xruns"], "ALSA underruns")
+    metric("resets_total", "counter", snap["resets"], "in-place resets (stop/pause/track change)")
+    metric("blocks_total", "counter", snap["blocks"], "processed blocks")
+    metric("deadline_misses_total", "counter", snap["deadline_misses"], "blocks processed slower than real time")
+    if snap["deadline_ms"] is not None:
+        metric("block_deadline_seconds", "gauge", snap["deadline_ms"] / 1000.0, "real-time budget per block")
+    block_ms = snap["block_ms"]
+    for q, key in (("0.5", "p50"), ("0.99", "p99"), ("1", "max")):
+        if block_ms[key] is not None:
+            metric("block_seconds", "gauge", block_ms[key] / 1000.0,
+                   f"block processing time over the last {BLOCK_WINDOW} blocks", f'quantile="{q}"')
+    metric("buffer_size_frames", "gauge", snap["buffer_size_frames"], "ALSA buffer size")
+    metric("buffer_fill_frames", "gauge", snap["buffer_fill_frames"], "frames queued in the ALSA buffer")
+    metric("fifo_backlog_bytes", "gauge", snap["fifo_backlog_bytes"], "bytes waiting in the MPD FIFO")
+    # 同じ名前の HELP/TYPE は 1 回だけ
+    seen, out = set(), []
+    for line in lines:
+        if line.startswith("#"):
+            if line in seen:
+                continue
+            seen.add(line)
+        out.append(line)
+    return "\n".join(out) + "\n"
+
+
+class MetricsServer:
+    """Serves ``metrics.snapshot()`` on a Unix socket and/or a Prometheus text file."""
+
+    def __init__(self, metrics, socket_path=DEFAULT_SOCKET, prom_path=None, interval=PROM_INTERVAL):
+        self.metrics = metrics
+        self.socket_path = socket_path
+        self.prom_path = prom_path
+        self.interval = interval
+        self._sock = None
+        self._closed = threading.Event()
+
+    def start(self):
+        if self.socket_path:
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.bind(self.socket_path)
+                sock.listen(4)
+            except OSError as e:
+                sock.close()
+                logger.warning("Metrics socket %s unavailable: %s", self.socket_path, e)
+            else:
+                sock.settimeout(self.interval)
+                self._sock = sock
+        if self._sock is None and not self.prom_path:
+            return self
+        threading.Thread(target=self._serve, name="sox-metrics", daemon=True).start()
+        logger.info("Metrics: socket=%s prom=%s", self._sock and self.socket_path, self.prom_path)
+        return self
+
+    def _serve(self):
+        next_prom = 0.0
+        while not self._closed.is_set():
+            if self.prom_path and time.monotonic() >= next_prom:
+                next_prom = time.monotonic() + self.interval
+                self._write_prom()
+            if self._sock is None:
+                self._closed.wait(self.interval)
+                continue
+            try:
+                conn, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                with conn:
+                    conn.sendall(json.dumps(self.metrics.snapshot()).encode() + b"\n")
+            except OSError:
+                pass
+
+    def _write_prom(self):
+        tmp = self.prom_path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(prometheus_text(self.metrics.snapshot()))
+            os.replace(tmp, self.prom_path)
+        except OSError as e:
+            logger.warning("Could not write %s: %s", self.prom_path, e)
+
+    def close(self):
+        self._closed.set()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+
+def read_metrics(socket_path=DEFAULT_SOCKET, timeout=0.5):
+    """One snapshot from a running engine/supervisor, or None if nothing is listening."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            data = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data.decode())
+    except (OSError, ValueError):
+        return None
+
+
+def format_health(snap):
+    """Multi-line summary of a snapshot (GUI health panel / CLI)."""
+    if snap is None:
+        return "engine not running (no metrics socket)"
+    lines = [f"{snap['mode']} on {snap['device'] or '?'}: {snap['state']}, up {snap['uptime_s']:.0f} s"]
+    lines.append(f"xruns: {snap['xruns']}    resets: {snap['resets']}")
+    if snap.get("mpd_state"):
+        lines.append(f"MPD: {snap['mpd_state']}" + (f" ({snap['mpd_audio']})" if snap.get("mpd_audio") else ""))
+    if snap["buffer_fill_ratio"] is not None:
+        lines.append(f"ALSA buffer: {snap['buffer_fill_ratio'] * 100:5.1f}% "
+                     f"({snap['buffer_fill_frames']}/{snap['buffer_size_frames']} frames)")
+    block_ms = snap["block_ms"]
+    if block_ms["p99"] is not None and snap["deadline_ms"]:
+        lines.append(f"block: p50 {block_ms['p50']:.2f} / p99 {block_ms['p99']:.2f} / max {block_ms['max']:.2f} ms"
+                     f" of {snap['deadline_ms']:.2f} ms ({snap['deadline_misses']} late)")
+    if snap["fifo_backlog_bytes"] is not None:
+        lines.append(f"FIFO backlog: {snap['fifo_backlog_bytes'] / 1024.0:.1f} KiB")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    path = args[0] if args else DEFAULT_SOCKET
+    snap = read_metrics(path)
+    if snap is None:
+        print(f"no metrics at {path}", file=sys.stderr)
+        return 1
+    print(json.dumps(snap, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
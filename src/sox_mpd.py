@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""Shared MPD event client: one ``idle`` connection per process, fanned out to subscribers.
+
+``MpdEvents`` keeps a single connection to MPD parked in ``idle`` on its own
+thread.  When MPD reports a change in one of the watched subsystems
+(player / mixer / options by default) it fetches ``status`` and
+``currentsong`` once and calls every subscriber with an ``MpdEvent``, so
+song, state and audio-format changes arrive as soon as MPD sends them and
+an idle connection costs no traffic at all.  Other threads run commands on
+the same connection with ``command()``: the event thread interrupts the
+idle with ``noidle``, runs the command and goes back to idle.
+
+A lost connection is published as a ``disconnect`` event and retried with
+exponential backoff (RECONNECT_MIN_S .. RECONNECT_MAX_S); the next
+successful connection is published as a ``connect`` event with the fresh
+status.  sox_gui.py (album art), sox_supervisor.py (pipeline / engine
+control) and its metrics all subscribe to it.
+
+The protocol is spoken directly (text lines plus ``binary:`` payloads), so
+this module needs only the standard library.
+
+    python3 sox_mpd.py [--host localhost] [--port 6600]   # print events as they arrive
+"""
+import argparse
+import collections
+import logging
+import os
+import select
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger("sox_mpd")
+
+MPD_HOST = os.environ.get("MPD_HOST", "localhost")
+MPD_PORT = int(os.environ.get("MPD_PORT", "6600"))
+CONNECT_TIMEOUT = 5.0
+# 応答の読み込みのタイムアウト (idle 待ちは select で行うので無関係)
+READ_TIMEOUT = 10.0
+RECONNECT_MIN_S = 0.5
+RECONNECT_MAX_S = 30.0
+SUBSYSTEMS = ("player", "mixer", "options")
+
+MpdEvent = collections.namedtuple("MpdEvent", "changed status song")
+MpdEvent.__doc__ = """``changed``: frozenset of MPD subsystems, or ``{"connect"}`` / ``{"disconnect"}``;
+``status`` / ``song``: MPD ``status`` and ``currentsong`` dicts (empty while disconnected)."""
+
+
+class MpdError(Exception):
+    """An ``ACK`` response from MPD."""
+
+
+def _quote(arg):
+    return '"' + str(arg).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class MpdConnection:
+    """One blocking connection speaking the MPD protocol (``host`` starting with / = Unix socket)."""
+
+    def __init__(self, host=MPD_HOST, port=MPD_PORT, timeout=CONNECT_TIMEOUT):
+        if host.startswith("/"):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(timeout)
+            self._sock.connect(host)
+        else:
+            self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._sock.settimeout(READ_TIMEOUT)
+        self._rfile = self._sock.makefile("rb")
+        hello = self._readline()
+        if not hello.startswith("OK MPD "):
+            self.close()
+            raise ConnectionError(f"not an MPD server: {hello!r}")
+        self.version = hello[len("OK MPD "):]
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def send(self, command, *args):
+        line = " ".join((command,) + tuple(_quote(a) for a in args)) + "\n"
+        self._sock.sendall(line.encode("utf-8"))
+
+    def _readline(self):
+        line = self._rfile.readline()
+        if not line.endswith(b"\n"):
+            raise ConnectionError("connection to MPD lost")
+        return line[:-1].decode("utf-8", errors="replace")
+
+    def read_pairs(self, binary_into=None):
+        """Read one response up to ``OK`` as ``[(key, value), ...]``; raises MpdError on ``ACK``.
+
+        A ``binary: N`` payload is read into ``binary_into`` (a writable
+        memoryview, at least N bytes) and reported as ``("binary", N)``;
+        without a buffer it is returned as bytes.
+        """
+        pairs = []
+        while True:
+            line = self._readline()
+            if line == "OK":
+                return pairs
+            if line.startswith("ACK "):
+                raise MpdError(line[4:])
+            key, _, value = line.partition(": ")
+            if key == "binary":
+                size = int(value)
+                if binary_into is not None:
+                    self._read_exact(binary_into[:size])
+                    value = size
+                else:
+                    value = self._rfile.read(size)
+                    if len(value) != size:
+                        raise ConnectionError("connection to MPD lost in binary data")
+                self._readline()
+            pairs.append((key, value))
+
+    def _read_exact(self, view):
+        got = 0
+        while got < len(view):
+            n = self._rfile.readinto(view[got:])
+            if not n:
+                raise ConnectionError("connection to MPD lost in binary data")
+            got += n
+
+    def command(self, command, *args):
+        self.send(command, *args)
+        return self.read_pairs()
+
+    def close(self):
+        try:
+            self._rfile.close()
+            self._sock.close()
+        except OSError:
+            pass
+
+
+def pairs_to_dict(pairs):
+    """``status`` / ``currentsong`` response as a dict with lower-case keys.
+
+    Repeated tags (several ``Artist:`` lines) are joined with ``"; "``.
+    """
+    result = {}
+    for key, value in pairs:
+        key = key.lower()
+        result[key] = f"{result[key]}; {value}" if key in result else value
+    return result
+
+
+class MpdEvents:
+    """Idle-based MPD client thread publishing ``MpdEvent``s to subscribers."""
+
+    def __init__(self, host=MPD_HOST, port=MPD_PORT, subsystems=SUBSYSTEMS):
+        self.host = host
+        self.port = port
+        self.subsystems = tuple(subsystems)
+        self.status = {}
+        self.song = {}
+        self.connected = False
+        self._subscribers = []
+        self._commands = collections.deque()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        """Call ``callback(event)`` on the client thread for every event; returns ``callback``.
+
+        A subscriber added while connected gets the current state at once (a ``connect`` event).
+        """
+        self._subscribers.append(callback)
+        if self.connected:
+            self._deliver(callback, MpdEvent(frozenset(("connect",)), self.status, self.song))
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mpd-events", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake()
+
+    def command(self, command, *args, timeout=READ_TIMEOUT, binary_into=None):
+        """Run ``command`` on the shared connection from any thread; returns its ``(key, value)`` pairs.
+
+        Raises MpdError for an ``ACK``, ConnectionError while MPD is unreachable.
+        """
+        if not self.connected:
+            raise ConnectionError("not connected to MPD")
+        future = Future()
+        self._commands.append((command, args, binary_into, future))
+        self._wake()
+        return future.result(timeout)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except OSError:
+            pass
+
+    def _deliver(self, callback, event):
+        try:
+            callback(event)
+        except Exception:
+            logger.exception("MPD event subscriber %r failed", callback)
+
+    def _publish(self, changed):
+        event = MpdEvent(frozenset(changed), self.status, self.song)
+        for callback in list(self._subscribers):
+            self._deliver(callback, event)
+
+    def _refresh(self, conn):
+        self.status = pairs_to_dict(conn.command("status"))
+        self.song = pairs_to_dict(conn.command("currentsong")) if self.status.get("songid") else {}
+
+    def _run_commands(self, conn):
+        while self._commands:
+            command, args, binary_into, future = self._commands.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                conn.send(command, *args)
+                future.set_result(conn.read_pairs(binary_into))
+            except MpdError as e:
+                future.set_exception(e)
+            except (OSError, ConnectionError) as e:
+                future.set_exception(e)
+                raise
+
+    def _fail_commands(self, error):
+        while self._commands:
+            future = self._commands.popleft()[3]
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def _session(self, conn):
+        while not self._stop.is_set():
+            self._run_commands(conn)
+            conn.send("idle", *self.subsystems)
+            ready, _, _ = select.select([conn, self._wake_r], [], [])
+            if self._wake_r in ready:
+                try:
+                    os.read(self._wake_r, 4096)
+                except BlockingIOError:
+                    pass
+                # idle の応答がすでに届いていれば noidle は無視される
+                conn.send("noidle")
+            changed = [value for key, value in conn.read_pairs() if key == "changed"]
+            if changed:
+                self._refresh(conn)
+                self._publish(changed)
+
+    def _run(self):
+        delay = RECONNECT_MIN_S
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = MpdConnection(self.host, self.port)
+                self._refresh(conn)
+                self.connected = True
+                delay = RECONNECT_MIN_S
+                logger.info("MPD connected (v%s): songid=%s state=%s", conn.version,
+                            self.status.get("songid"), self.status.get("state"))
+                self._publish(("connect",))
+                self._session(conn)
+            except (OSError, ConnectionError, MpdError, ValueError) as e:
+                logger.warning("MPD connection error: %s; retrying in %.1f s", e, delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+                was_connected, self.connected = self.connected, False
+                self._fail_commands(ConnectionError("connection to MPD lost"))
+                if was_connected:
+                    self.status, self.song = {}, {}
+                    self._publish(("disconnect",))
+            if self._stop.wait(delay):
+                break
+            delay = min(delay * 2, RECONNECT_MAX_S)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print MPD idle events")
+    parser.add_argument("--host", default=MPD_HOST)
+    parser.add_argument("--port", type=int, default=MPD_PORT)
+    parser.add_argument("--subsystem", action="append", help=f"subsystems to watch (default: {' '.join(SUBSYSTEMS)})")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    events = MpdEvents(args.host, args.port, args.subsystem or SUBSYSTEMS)
+    events.subscribe(lambda ev: print(time.strftime("%H:%M:%S"), ",".join(sorted(ev.changed)),
+                                      ev.status.get("state"), ev.status.get("audio"),
+                                      ev.song.get("artist"), "-", ev.song.get("title"), flush=True))
+    events.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        events.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
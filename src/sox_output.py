@@ -0,0 +1,387 @@
+"""ALSA playback for sox_engine.py via libasound (ctypes, no extra Python package).
+
+``AlsaOutput`` opens the PCM in mmap access mode where the device supports
+it (``hw``/``plughw``/``plug`` usually do) and copies each block straight
+into the ring buffer the DAC reads (``snd_pcm_mmap_begin`` / ``commit``),
+falling back to ``snd_pcm_writei`` otherwise.  ``FileOutput`` is the sink
+without hardware for tests and benchmarks: ``null`` discards the samples,
+``file:PATH`` appends them as raw S32_LE, and both are paced like a DAC
+(writes block while the simulated buffer is full, late writes count as
+underruns).  ``open_output`` picks one by device name.
+
+``resolve_play_device`` maps the GUI's OUTPUT_DEVICE to the PCM name, as
+run_sox_fifo.sh did in shell: ``hw:N`` -> ``plughw:N``, ``bluealsa`` ->
+``plug:bluealsa``, ``USB-DAC`` -> ``plughw:`` of the first USB audio card:
+
+    python3 sox_output.py device OUTPUT_DEVICE    # prints PLAY_DEVICE
+
+Also decides the output word length per device (OUTPUT_BITS="auto"): the
+samples are always written as S32_LE, but many DACs keep only 24 (or 16)
+bits, so dithering at 32 bits would only be thrown away.  ``device_output_bits``
+uses, in order, a per-device value set with
+
+    python3 sox_output.py bits PLAY_DEVICE 24     # or 16 / 32; 'auto' forgets it
+    python3 sox_output.py bits PLAY_DEVICE        # prints the word length used
+
+(``"device_bits"`` in ~/.sox_gui_config.json, keyed like sox_buftune), the
+bit depth a USB DAC reports in /proc/asound/cardN/stream0, 24 for BlueALSA
+(no codec carries more), and 32 otherwise.
+"""
+import ctypes
+import ctypes.util
+import errno
+import glob
+import logging
+import os
+import re
+import sys
+import time
+
+from sox_buftune import BITS_CONFIG_KEY, PROC_ASOUND, card_path, device_id, load_entries, save_entry
+
+logger = logging.getLogger("sox_engine")
+
+SND_PCM_STREAM_PLAYBACK = 0
+SND_PCM_ACCESS_MMAP_INTERLEAVED = 0
+SND_PCM_ACCESS_RW_INTERLEAVED = 3
+SND_PCM_FORMAT_S32_LE = 10
+SND_PCM_STATE_PREPARED = 2
+# snd_pcm_wait のタイムアウト (ms)
+WAIT_TIMEOUT_MS = 1000
+
+
+class _ChannelArea(ctypes.Structure):
+    """snd_pcm_channel_area_t: where one channel's samples are in the mmap'd buffer."""
+    _fields_ = [("addr", ctypes.c_void_p), ("first", ctypes.c_uint), ("step", ctypes.c_uint)]
+
+
+class AlsaError(RuntimeError):
+    pass
+
+
+_lib = None
+
+
+def _libasound():
+    global _lib
+    if _lib is None:
+        name = ctypes.util.find_library("asound") or "libasound.so.2"
+        lib = ctypes.CDLL(name)
+        lib.snd_pcm_open.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_char_p, ctypes.c_int, ctypes.c_int]
+        lib.snd_pcm_set_params.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int,
+                                           ctypes.c_uint, ctypes.c_uint, ctypes.c_int, ctypes.c_uint]
+        lib.snd_pcm_writei.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ulong]
+        lib.snd_pcm_writei.restype = ctypes.c_long
+        lib.snd_pcm_recover.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+        lib.snd_pcm_drain.argtypes = [ctypes.c_void_p]
+        lib.snd_pcm_drop.argtypes = [ctypes.c_void_p]
+        lib.snd_pcm_prepare.argtypes = [ctypes.c_void_p]
+        lib.snd_pcm_close.argtypes = [ctypes.c_void_p]
+        lib.snd_pcm_get_params.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulong),
+                                           ctypes.POINTER(ctypes.c_ulong)]
+        lib.snd_pcm_delay.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_long)]
+        lib.snd_pcm_avail_update.argtypes = [ctypes.c_void_p]
+        lib.snd_pcm_avail_update.restype = ctypes.c_long
+        lib.snd_pcm_mmap_begin.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.POINTER(_ChannelArea)),
+                                           ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_ulong)]
+        lib.snd_pcm_mmap_commit.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong]
+        lib.snd_pcm_mmap_commit.restype = ctypes.c_long
+        lib.snd_pcm_state.argtypes = [ctypes.c_void_p]
+        lib.snd_pcm_start.argtypes = [ctypes.c_void_p]
+        lib.snd_pcm_wait.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.snd_strerror.argtypes = [ctypes.c_int]
+        lib.snd_strerror.restype = ctypes.c_char_p
+        _lib = lib
+    return _lib
+
+
+OUTPUT_BITS = (16, 24, 32)
+# stream0 の Format 行 (Bits 行のない古いカーネル用)
+_FORMAT_BITS = {"S16_LE": 16, "S24_3LE": 24, "S24_LE": 24, "S32_LE": 32}
+
+
+def usb_playback_bits(card_dir):
+    """Largest playback word length a USB audio card reports, or None."""
+    try:
+        with open(os.path.join(card_dir, "stream0")) as f:
+            playback = f.read().split("Capture:")[0]
+    except OSError:
+        return None
+    bits = [int(b) for b in re.findall(r"Bits:\s*(\d+)", playback)]
+    if not bits:
+        bits = [_FORMAT_BITS[f] for f in re.findall(r"Format:\s*(\S+)", playback) if f in _FORMAT_BITS]
+    return max(bits) if bits else None
+
+
+def device_output_bits(play_device, setting="auto"):
+    """Word length to dither to for a device: ``setting`` unless "auto", else see the module docstring."""
+    if str(setting) != "auto":
+        return int(setting)
+    configured = load_entries(section=BITS_CONFIG_KEY).get(device_id(play_device))
+    if configured in OUTPUT_BITS:
+        return configured
+    if "bluealsa" in play_device.lower():
+        return 24
+    path = card_path(play_device)
+    detected = usb_playback_bits(path) if path else None
+    return detected if detected in OUTPUT_BITS else 32
+
+
+def usb_card_index(proc_asound=PROC_ASOUND):
+    """Index of the first USB audio card (one with a ``usbid``), or None."""
+    cards = []
+    for path in glob.glob(os.path.join(proc_asound, "card[0-9]*")):
+        if os.path.exists(os.path.join(path, "usbid")):
+            cards.append(int(os.path.basename(path)[4:]))
+    return min(cards) if cards else None
+
+
+def resolve_play_device(output_device):
+    """ALSA PCM name (PLAY_DEVICE) for the GUI's OUTPUT_DEVICE value."""
+    if re.match(r"^hw:\d+(,\d+)?$", output_device):
+        # plughw: で S32_LE/192kHz 以外しか受けないデバイスでも変換させる
+        return "plug" + output_device
+    if output_device in ("PC Speakers", "PC Speakers (hw:0,0)"):
+        return "plughw:0,0"
+    if output_device.startswith("plug:") or output_device == "null" or output_device.startswith("file:"):
+        return output_device
+    if output_device.lower() == "bluealsa":
+        return "plug:bluealsa"
+    if output_device == "USB-DAC":
+        card = usb_card_index()
+        if card is not None:
+            return f"plughw:{card}"
+        logger.warning("No USB DAC found; using plug:default")
+    return "plug:default"
+
+
+def default_latency_us(device, rate):
+    """Same buffer sizes as the aplay command lines in run_sox_fifo.sh."""
+    if "bluealsa" in device.lower():
+        return 500000
+    return int(65536 * 1_000_000 / rate)
+
+
+class AlsaOutput:
+    """Interleaved S32_LE playback on an ALSA PCM (``plughw:1``, ``plug:bluealsa``...)."""
+
+    def __init__(self, device, rate, channels=2, latency_us=None, mmap=True):
+        self.device = device
+        self.rate = rate
+        self.channels = channels
+        self.xruns = 0
+        self.buffer_size = None
+        self.period_size = None
+        self.mmap = False
+        self._lib = _libasound()
+        self._pcm = ctypes.c_void_p()
+        # mmap 書き込み用 (ブロックごとに ctypes オブジェクトを作らない)
+        self._areas = ctypes.POINTER(_ChannelArea)()
+        self._offset = ctypes.c_ulong()
+        self._frames = ctypes.c_ulong()
+        self._check(self._lib.snd_pcm_open(ctypes.byref(self._pcm), device.encode(),
+                                           SND_PCM_STREAM_PLAYBACK, 0), "snd_pcm_open")
+        if latency_us is None:
+            latency_us = default_latency_us(device, rate)
+        accesses = (SND_PCM_ACCESS_MMAP_INTERLEAVED, SND_PCM_ACCESS_RW_INTERLEAVED) if mmap \
+            else (SND_PCM_ACCESS_RW_INTERLEAVED,)
+        err = 0
+        for access in accesses:
+            # soft_resample=1: plug 系デバイスでのフォーマット変換を許可
+            err = self._lib.snd_pcm_set_params(self._pcm, SND_PCM_FORMAT_S32_LE, access,
+                                               channels, rate, 1, latency_us)
+            if err == 0:
+                self.mmap = access == SND_PCM_ACCESS_MMAP_INTERLEAVED
+                break
+        try:
+            self._check(err, "snd_pcm_set_params")
+        except AlsaError:
+            self.close()
+            raise
+        buffer_size, period_size = ctypes.c_ulong(), ctypes.c_ulong()
+        if self._lib.snd_pcm_get_params(self._pcm, ctypes.byref(buffer_size), ctypes.byref(period_size)) == 0:
+            self.buffer_size, self.period_size = buffer_size.value, period_size.value
+        logger.info("ALSA output opened: %s %d Hz %d ch, %s access (latency %d us, buffer %s / period %s frames)",
+                    device, rate, channels, "mmap" if self.mmap else "read/write", latency_us,
+                    self.buffer_size, self.period_size)
+
+    def _check(self, err, what):
+        if err < 0:
+            msg = self._lib.snd_strerror(err).decode(errors="replace")
+            raise AlsaError(f"{what}({self.device}): {msg}")
+        return err
+
+    def _recover(self, err):
+        if err == -errno.EPIPE:
+            self.xruns += 1
+            logger.warning("ALSA underrun on %s (total %d)", self.device, self.xruns)
+        self._check(self._lib.snd_pcm_recover(self._pcm, int(err), 1), "snd_pcm_recover")
+
+    def write(self, frames):
+        """Write an int32 array shaped (frames, channels); blocks until queued."""
+        if not frames.flags.c_contiguous:
+            frames = frames.copy(order="C")
+        if self.mmap:
+            self._write_mmap(frames.ctypes.data, len(frames))
+            return
+        ptr = frames.ctypes.data
+        remaining = len(frames)
+        frame_bytes = 4 * self.channels
+        while remaining > 0:
+            n = self._lib.snd_pcm_writei(self._pcm, ptr, remaining)
+            if n < 0:
+                self._recover(n)
+                continue
+            ptr += n * frame_bytes
+            remaining -= n
+
+    def _write_mmap(self, ptr, remaining):
+        lib, pcm = self._lib, self._pcm
+        frame_bytes = 4 * self.channels
+        while remaining > 0:
+            avail = lib.snd_pcm_avail_update(pcm)
+            if avail < 0:
+                self._recover(avail)
+                continue
+            if avail == 0:
+                # バッファが満杯: 初回は再生を開始 (writei の自動開始と同じ)、以降は 1 周期空くのを待つ
+                if lib.snd_pcm_state(pcm) == SND_PCM_STATE_PREPARED:
+                    self._check(lib.snd_pcm_start(pcm), "snd_pcm_start")
+                else:
+                    err = lib.snd_pcm_wait(pcm, WAIT_TIMEOUT_MS)
+                    if err < 0:
+                        self._recover(err)
+                continue
+            self._frames.value = min(remaining, avail)
+            self._check(lib.snd_pcm_mmap_begin(pcm, ctypes.byref(self._areas), ctypes.byref(self._offset),
+                                               ctypes.byref(self._frames)), "snd_pcm_mmap_begin")
+            # インターリーブなので 1 チャンネル目の領域がフレーム全体を指す
+            area = self._areas[0]
+            n = self._frames.value
+            ctypes.memmove(area.addr + (area.first + self._offset.value * area.step) // 8, ptr, n * frame_bytes)
+            committed = lib.snd_pcm_mmap_commit(pcm, self._offset.value, n)
+            if committed < 0:
+                self._recover(committed)
+                continue
+            ptr += committed * frame_bytes
+            remaining -= committed
+
+    def delay(self):
+        """Frames queued ahead of the DAC (buffer fill); None while the PCM is not running."""
+        frames = ctypes.c_long()
+        if not self._pcm or self._lib.snd_pcm_delay(self._pcm, ctypes.byref(frames)) < 0:
+            return None
+        return frames.value
+
+    def drain(self):
+        """Play out what is queued, then re-arm the PCM for the next write."""
+        if self._pcm:
+            self._lib.snd_pcm_drain(self._pcm)
+            self._lib.snd_pcm_prepare(self._pcm)
+
+    def drop(self):
+        """Discard what is queued, then re-arm the PCM for the next write."""
+        if self._pcm:
+            self._lib.snd_pcm_drop(self._pcm)
+            self._lib.snd_pcm_prepare(self._pcm)
+
+    def close(self):
+        if self._pcm:
+            self._lib.snd_pcm_close(self._pcm)
+            self._pcm = ctypes.c_void_p()
+
+
+class FileOutput:
+    """Device-less sink (``null`` / ``file:PATH``) with the AlsaOutput interface, paced in real time.
+
+    A simulated buffer of ``latency_us`` is drained at ``rate``: playback
+    starts when it is full, writes block while it is full, and a write after
+    it ran dry counts as an underrun.
+    """
+
+    def __init__(self, device, rate, channels=2, latency_us=None):
+        self.device = device
+        self.rate = rate
+        self.channels = channels
+        self.xruns = 0
+        self.mmap = False
+        if latency_us is None:
+            latency_us = default_latency_us(device, rate)
+        self.buffer_size = max(1, int(rate * latency_us / 1_000_000))
+        self.period_size = max(1, self.buffer_size // 4)
+        path = device[len("file:"):] if device.startswith("file:") else None
+        self._file = open(path, "ab") if path else None
+        # 仮想バッファのフレーム数と、その時刻 (None = 再生開始前)
+        self._queued = 0.0
+        self._t = None
+        logger.info("%s output opened: %d Hz %d ch (buffer %d frames, paced)",
+                    path or "null", rate, channels, self.buffer_size)
+
+    def _update(self):
+        if self._t is None:
+            return
+        now = time.monotonic()
+        self._queued -= (now - self._t) * self.rate
+        self._t = now
+        if self._queued < 0:
+            self.xruns += 1
+            logger.warning("Underrun on %s (total %d)", self.device, self.xruns)
+            self._queued = 0.0
+            self._t = None
+
+    def write(self, frames):
+        if self._file is not None:
+            self._file.write(frames if frames.flags.c_contiguous else frames.copy(order="C"))
+        self._update()
+        self._queued += len(frames)
+        if self._t is None and self._queued >= self.buffer_size:
+            self._t = time.monotonic()
+        if self._t is not None and self._queued > self.buffer_size:
+            time.sleep((self._queued - self.buffer_size) / self.rate)
+            self._update()
+
+    def delay(self):
+        self._update()
+        return int(self._queued)
+
+    def drain(self):
+        if self._queued > 0:
+            time.sleep(self._queued / self.rate)
+        self.drop()
+        if self._file is not None:
+            self._file.flush()
+
+    def drop(self):
+        self._queued = 0.0
+        self._t = None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def open_output(device, rate, channels=2, latency_us=None, mmap=True):
+    """FileOutput for ``null`` / ``file:PATH``, AlsaOutput for any other PCM name."""
+    if device == "null" or device.startswith("file:"):
+        return FileOutput(device, rate, channels, latency_us)
+    return AlsaOutput(device, rate, channels, latency_us, mmap=mmap)
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if args[:1] == ["device"] and len(args) == 2:
+        print(resolve_play_device(args[1]))
+        return 0
+    if args[:1] == ["bits"] and len(args) == 2:
+        print(device_output_bits(args[1]))
+        return 0
+    if args[:1] == ["bits"] and len(args) == 3 and args[2] in ("auto",) + tuple(map(str, OUTPUT_BITS)):
+        save_entry(device_id(args[1]), None if args[2] == "auto" else int(args[2]), section=BITS_CONFIG_KEY)
+        return 0
+    print("usage: sox_output.py device OUTPUT_DEVICE | bits PLAY_DEVICE [16|24|32|auto]", file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
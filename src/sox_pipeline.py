@@ -0,0 +1,227 @@
+"""Multicore staged execution of an EffectChain (sox_engine.py, ENGINE_PIPELINE="staged").
+
+The chain is cut into stage groups (each FIR, the EQ/overdrive/compand run,
+the resampler, and gain/crossfeed/dither after it), and every group runs on
+its own worker thread.  Groups are connected by ``BlockRing``: a bounded
+single-producer/single-consumer ring of preallocated (frames, channels)
+slots, so no block-sized arrays are allocated between stages.  FFTs,
+``sosfilt``, the resampler's matrix products and ``lfilter`` release the GIL, so the noise FIR,
+harmonic FIR and resampler work on consecutive blocks in parallel.
+
+``StagedChain.process`` keeps the EffectChain interface but is pipelined:
+it returns the output of the block submitted ``depth`` calls earlier
+(``latency_blocks``).  Each group can be pinned to CPUs with a map like
+``"fir:3 eq:2 resample:3 post:2"`` (see ``parse_cpu_map``).
+"""
+import logging
+import os
+import threading
+
+import numpy as np
+
+from sox_dsp import FirStage, ResampleStage
+
+logger = logging.getLogger("sox_engine")
+
+STAGED_DEPTH = 4
+GROUP_NAMES = ("io", "fir", "eq", "resample", "post")
+
+
+def parse_cpu_map(text):
+    """``"io:2 fir:3 eq:2-3"`` -> ``{"io": {2}, "fir": {3}, "eq": {2, 3}}``."""
+    cpu_map = {}
+    for item in (text or "").replace(";", " ").split():
+        name, _, cpus = item.partition(":")
+        if name not in GROUP_NAMES or not cpus:
+            raise ValueError(f"bad ENGINE_CPU_MAP entry: {item!r} (groups: {', '.join(GROUP_NAMES)})")
+        cpu_set = set()
+        for part in cpus.split(","):
+            lo, _, hi = part.partition("-")
+            cpu_set.update(range(int(lo), int(hi or lo) + 1))
+        cpu_map[name] = cpu_set
+    return cpu_map
+
+
+def pin_current_thread(cpus, what):
+    """Set the CPU affinity of the calling thread (Linux: pid 0 = this thread)."""
+    if not cpus:
+        return
+    try:
+        os.sched_setaffinity(0, cpus)
+        logger.info("%s pinned to CPU %s", what, ",".join(map(str, sorted(cpus))))
+    except OSError as e:
+        logger.warning("Could not pin %s to CPU %s: %s", what, sorted(cpus), e)
+
+
+def split_stages(stages):
+    """Group a chain's stages as ``[(group_name, [stages]), ...]``."""
+    groups = []
+    resampled = False
+    for stage in stages:
+        if isinstance(stage, (FirStage, ResampleStage)):
+            name = "fir" if isinstance(stage, FirStage) else "resample"
+            resampled = resampled or name == "resample"
+            groups.append((name, [stage]))
+            continue
+        name = "post" if resampled else "eq"
+        if groups and groups[-1][0] == name:
+            groups[-1][1].append(stage)
+        else:
+            groups.append((name, [stage]))
+    return groups
+
+
+class BlockRing:
+    """Bounded SPSC ring of preallocated blocks.
+
+    The producer copies into a free slot (``put``); the consumer gets a view
+    of the oldest slot (``get``) and hands it back with ``release`` once it
+    has finished with it.  ``frames < 0`` in a slot is a control marker.
+    """
+
+    def __init__(self, slots, max_frames, channels, dtype=np.float64):
+        self._data = np.zeros((slots, max_frames, channels), dtype=dtype)
+        self._frames = [0] * slots
+        self._free = threading.Semaphore(slots)
+        self._used = threading.Semaphore(0)
+        self._head = 0
+        self._tail = 0
+
+    def put(self, block=None, marker=0):
+        self._free.acquire()
+        i = self._head
+        if block is None:
+            self._frames[i] = marker
+        else:
+            n = len(block)
+            if n > self._data.shape[1]:
+                raise ValueError(f"block of {n} frames exceeds ring slot ({self._data.shape[1]})")
+            self._data[i, :n] = block
+            self._frames[i] = n
+        self._head = (i + 1) % len(self._frames)
+        self._used.release()
+
+    def get(self):
+        """Return ``(frames, view)``; ``view`` is None for a marker."""
+        self._used.acquire()
+        n = self._frames[self._tail]
+        return n, (self._data[self._tail, :n] if n >= 0 else None)
+
+    def release(self):
+        self._tail = (self._tail + 1) % len(self._frames)
+        self._free.release()
+
+
+_STOP = -1
+_BARRIER = -2
+
+
+class StagedChain:
+    """Runs an EffectChain's stage groups on worker threads connected by BlockRings."""
+
+    def __init__(self, chain, block_frames, cpu_map=None, depth=STAGED_DEPTH):
+        self.chain = chain
+        self.in_rate = chain.in_rate
+        self.out_rate = chain.out_rate
+        self.latency_blocks = depth
+        self.groups = split_stages(chain.stages)
+        channels = self._channels(chain)
+        # リサンプル後の最大長 + FIR の端数分の余裕
+        ratio = max(1.0, chain.out_rate / float(chain.in_rate))
+        max_frames = int(2 * block_frames * ratio) + 64
+        self._rings = [BlockRing(depth + 2, max_frames, channels) for _ in range(len(self.groups))]
+        # 最後のグループ (GainDitherStage) の出力は int32
+        out_dtype = getattr(chain.stages[-1], "out_dtype", np.float64) if chain.stages else np.float64
+        self._rings.append(BlockRing(depth + 2, max_frames, channels, out_dtype))
+        self._in_flight = 0
+        self._threads = []
+        cpu_map = cpu_map or {}
+        for i, (name, stages) in enumerate(self.groups):
+            t = threading.Thread(target=self._worker, name=f"sox-{name}",
+                                 args=(stages, self._rings[i], self._rings[i + 1], cpu_map.get(name), name),
+                                 daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    @staticmethod
+    def _channels(chain):
+        for stage in chain.stages:
+            if hasattr(stage, "channels"):
+                return stage.channels
+        return 2
+
+    def _worker(self, stages, inp, out, cpus, name):
+        pin_current_thread(cpus, f"stage '{name}'")
+        while True:
+            n, x = inp.get()
+            if x is None:
+                inp.release()
+                out.put(marker=n)
+                if n == _STOP:
+                    return
+                continue
+            # FIR が端数を保持して空になったブロックは後段のステージを通さずそのまま渡す
+            if len(x):
+                try:
+                    for stage in stages:
+                        x = stage.process(x)
+                        if not len(x):
+                            break
+                except Exception:
+                    # 1 ブロックを捨ててもパイプラインの入出力の対応は保つ
+                    logger.exception("stage '%s' failed; dropping one block", name)
+                    x = x[:0]
+            out.put(x)
+            inp.release()
+
+    def describe(self):
+        return " | ".join(f"{name}[{', '.join(s.name for s in stages)}]" for name, stages in self.groups)
+
+    def _pop(self):
+        n, y = self._rings[-1].get()
+        out = y.copy() if y is not None else None
+        self._rings[-1].release()
+        return n, out
+
+    def process(self, x):
+        """Submit ``x``; returns the output of the block submitted ``latency_blocks`` calls ago."""
+        self._rings[0].put(x)
+        self._in_flight += 1
+        if self._in_flight <= self.latency_blocks:
+            return np.zeros((0, x.shape[1]))
+        self._in_flight -= 1
+        return self._pop()[1]
+
+    def _drain(self):
+        """Collect every block still in flight."""
+        outputs = []
+        while self._in_flight:
+            self._in_flight -= 1
+            outputs.append(self._pop()[1])
+        return outputs
+
+    def _barrier(self):
+        """Wait until all workers are idle (everything submitted has come out); returns the drained blocks."""
+        outputs = self._drain()
+        self._rings[0].put(marker=_BARRIER)
+        while self._pop()[0] != _BARRIER:
+            pass
+        return outputs
+
+    def flush(self):
+        """End of stream: every block still in flight, then the partial blocks held by the stages."""
+        outputs = self._barrier()
+        # ワーカーが止まっている間に端数を通す (EffectChain.flush と同じ)
+        outputs += self.chain.flush()
+        return outputs
+
+    def reset(self):
+        # ワーカーが止まっている間だけステージの状態を触る
+        self._barrier()
+        self.chain.reset()
+
+    def close(self):
+        self._drain()
+        self._rings[0].put(marker=_STOP)
+        for t in self._threads:
+            t.join(timeout=1.0)
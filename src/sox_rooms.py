@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Room (EFFECTS_TYPE) table shared by run_sox_fifo.sh, sox_gui.py and the DSP engine.
+
+Every room has the parameters its impulse response is synthesized from
+(sox_ircache.py) and, for the sox pipelines (OUTPUT_METHOD aplay/soxplay),
+the nearest SoX effect string.  The engine convolves the IR instead
+(sox_dsp.ReverbStage); a measured IR can replace the synthetic one by
+putting ``<room>.wav`` into ``<FIR_BASE_PATH>/ir/``.
+
+Room parameters:
+
+* ``rt60``: reverberation time (s) in the mid band; ``low``/``high`` scale it
+  below 500 Hz / above 4 kHz (air and wall absorption);
+* ``predelay_ms``: direct sound to first reflection;
+* ``early``: ``(delay_ms, gain_db)`` discrete early reflections after the predelay;
+* ``wet_db``: level of the reverberant part relative to the direct sound;
+* ``width``: 0 = identical L/R tails, 1 = fully decorrelated.
+
+``vinyl`` is not a room but a record-player colouration (treble rolloff
+and warmth); it has only the SoX string, which the engine runs as EQ.
+
+    python3 sox_rooms.py EFFECTS_TYPE   # prints the SoX effect string (empty for none/unknown)
+
+Standard library only: the GUI imports this without numpy/scipy.
+"""
+import sys
+
+ROOMS = {
+    # ウィーン楽友協会 大ホール: シューボックス型、中域 RT60 約 2 秒、豊かな低域
+    "Viena-Symphony-Hall": {
+        "rt60": 2.0, "low": 1.2, "high": 0.55, "predelay_ms": 18,
+        "early": ((7, -4), (15, -6), (23, -7), (34, -9), (47, -11)),
+        "wet_db": -13.0, "width": 0.9,
+        "sox": "reverb 60 45 100 90 18 -4",
+    },
+    # サントリーホール: ヴィンヤード型、RT60 約 2.1 秒、初期反射が密
+    "Suntory-Music-Hall": {
+        "rt60": 2.1, "low": 1.1, "high": 0.6, "predelay_ms": 24,
+        "early": ((5, -5), (11, -5), (19, -6), (26, -8), (38, -9), (52, -12)),
+        "wet_db": -14.0, "width": 1.0,
+        "sox": "reverb 65 40 100 100 24 -5",
+    },
+    # New Morning (パリのジャズクラブ): 小さく吸音の多い空間
+    "NewMorning-JazzClub": {
+        "rt60": 0.6, "low": 1.1, "high": 0.5, "predelay_ms": 6,
+        "early": ((3, -6), (8, -8), (13, -11)),
+        "wet_db": -16.0, "width": 0.7,
+        "sox": "reverb 30 60 40 60 6 -8",
+    },
+    # ウェンブリー・スタジアム: 長い残響と遅れて返ってくるスタンドからのエコー
+    "Wembley-Studium": {
+        "rt60": 3.6, "low": 1.0, "high": 0.4, "predelay_ms": 45,
+        "early": ((20, -8), (85, -9), (160, -12), (240, -15)),
+        "wet_db": -11.0, "width": 1.0,
+        "sox": "reverb 90 55 100 100 45 -2",
+    },
+    # Abbey Road Studio Two: ライブな大型スタジオ、RT60 約 1.2 秒
+    "AbbeyRoad-Studio": {
+        "rt60": 1.2, "low": 1.0, "high": 0.7, "predelay_ms": 10,
+        "early": ((4, -5), (9, -7), (17, -9), (26, -12)),
+        "wet_db": -17.0, "width": 0.8,
+        "sox": "reverb 40 35 60 80 10 -7",
+    },
+    # レコード再生の質感: 高域のロールオフと低域の厚み (残響なし)
+    "vinyl": {
+        "sox": "lowpass 15000 bass +1.5 100",
+    },
+}
+
+
+def room_names():
+    """GUI list: every room plus ``none``."""
+    return list(ROOMS) + ["none"]
+
+
+def sox_effect(name):
+    room = ROOMS.get(name)
+    return room["sox"] if room else ""
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if len(args) != 1:
+        print("usage: sox_rooms.py EFFECTS_TYPE", file=sys.stderr)
+        return 2
+    print(sox_effect(args[0]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""Typed effect settings shared by sox_gui.py, run_sox_fifo.sh and the DSP engine.
+
+``Settings`` is the schema of the options the GUI manages (MUSIC_TYPE,
+EFFECTS_TYPE, ..., the block sox_gui.py used to rewrite in
+run_sox_fifo.sh).  Values are coerced and checked once, when the object is
+built; an invalid value raises ValueError naming the field.
+
+``SettingsStore`` keeps them in a small JSON file (SETTINGS_PATH, next to
+run_sox_fifo.sh) written atomically on Apply, so Apply never edits or
+syntax-checks the script.  Every save gets the next version number and is
+appended to ``<file>.history`` (the last HISTORY_MAX versions), from which
+an earlier version can be restored.
+
+run_sox_fifo.sh reads the file with ``eval "$(python3 sox_settings.py shell FILE)"``
+(values are shell-quoted here; without the file the script keeps its own
+defaults).  sox_engine.py and sox_supervisor.py read it through
+``sox_engine.load_engine_settings``.
+
+    python3 sox_settings.py shell [FILE]            # KEY='value' lines for run_sox_fifo.sh
+    python3 sox_settings.py history [FILE]
+    python3 sox_settings.py restore VERSION [FILE]  # save an earlier version as the newest
+
+Standard library only: run_sox_fifo.sh and sox_gui.py import/run this without numpy/scipy.
+"""
+import dataclasses
+import json
+import os
+import re
+import shlex
+import sys
+import tempfile
+import time
+
+from sox_eq import EQ_OUTPUT_EQ
+from sox_rooms import room_names
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SETTINGS_PATH = os.path.join(BASE_DIR, "sox_settings.json")
+# sox_gui.py のプリセットファイル ("effects" の一覧と名前付きプリセット)
+PRESETS_FILE = os.path.expanduser("/home/tysbox/bin/presets.json")
+HISTORY_MAX = 50
+
+# run_sox_fifo.sh の case 文と揃える
+OUTPUT_METHODS = ("aplay", "soxplay", "engine")
+NOISE_FIR_TYPES = ("default", "light", "medium", "strong", "off")
+HARMONIC_FIR_TYPES = ("dynamic", "dead", "base", "med", "high", "off")
+RESAMPLE_QUALITIES = ("very-high", "medium", "fast")
+# Music Type は GUI のカスタムプリセット名も入るので一覧ではなく文字種で検査する
+_NAME_RE = re.compile(r"^[\w .+&()-]+$")
+_DEVICE_RE = re.compile(r"^[\w:.,=-]+$")
+_BOOLS = {"true": True, "1": True, "yes": True, "on": True,
+          "false": False, "0": False, "no": False, "off": False}
+
+
+def effect_names(presets_path=PRESETS_FILE):
+    """Accepted EFFECTS_TYPE values: the sox_rooms rooms plus the custom effects sox_gui.py loads from presets.json."""
+    names = set(room_names())
+    try:
+        with open(presets_path, "r") as f:
+            data = json.load(f)
+        # 一覧 ("effects") と、名前付きプリセットが選ぶエフェクト ("presets": {name: {"effects_type": ...}})
+        custom = list(data.get("effects", []))
+        custom += [preset.get("effects_type") for preset in data.get("presets", {}).values()
+                   if isinstance(preset, dict)]
+    except (OSError, ValueError, AttributeError, TypeError):
+        return names
+    names.update(name for name in custom if isinstance(name, str))
+    return names
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Settings:
+    """GUI-managed effect settings (field = lower-case run_sox_fifo.sh variable)."""
+
+    music_type: str = "none"
+    effects_type: str = "none"
+    eq_output_type: str = "none"
+    gain: int = 0
+    noise_fir_type: str = "off"
+    harmonic_fir_type: str = "off"
+    output_method: str = "aplay"
+    output_device: str = "bluealsa"
+    crossfeed_enabled: bool = False
+    crossfeed_preset: str = "off"
+    resample_quality: str = "very-high"
+
+    def __post_init__(self):
+        checks = (
+            ("music_type", _NAME_RE.match(self.music_type)),
+            ("effects_type", self.effects_type in effect_names()),
+            ("eq_output_type", self.eq_output_type in EQ_OUTPUT_EQ),
+            # run_sox_fifo.sh は GAIN を $(( )) で足すので整数 dB に限る
+            ("gain", isinstance(self.gain, int) and not isinstance(self.gain, bool) and -60 <= self.gain <= 20),
+            ("noise_fir_type", self.noise_fir_type in NOISE_FIR_TYPES),
+            ("harmonic_fir_type", self.harmonic_fir_type in HARMONIC_FIR_TYPES),
+            ("output_method", self.output_method in OUTPUT_METHODS),
+            ("output_device", _DEVICE_RE.match(self.output_device)),
+            ("crossfeed_preset", _NAME_RE.match(self.crossfeed_preset)),
+            ("resample_quality", self.resample_quality in RESAMPLE_QUALITIES),
+        )
+        bad = [name for name, ok in checks if not ok]
+        if bad:
+            raise ValueError("invalid " + ", ".join(f"{name}={getattr(self, name)!r}" for name in bad))
+
+    @classmethod
+    def from_config(cls, config):
+        """Build from a mapping with the field names as keys (sox_gui's config, a saved file).
+
+        Missing keys take the defaults, unknown keys are ignored; strings are
+        coerced (``"-5"`` -> -5, ``"true"`` -> True).  Gain must be a whole
+        number of dB (``"-3.0"`` is accepted, ``"-2.5"`` is not).
+        """
+        values = {}
+        for field in dataclasses.fields(cls):
+            if field.name not in config:
+                continue
+            value = config[field.name]
+            try:
+                if field.type is int:
+                    number = float(value)
+                    if not number.is_integer():
+                        raise ValueError(value)
+                    value = int(number)
+                elif field.type is bool:
+                    value = value if isinstance(value, bool) else _BOOLS[str(value).strip().lower()]
+                else:
+                    value = str(value)
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"invalid {field.name}={value!r}") from None
+            values[field.name] = value
+        return cls(**values)
+
+    def as_dict(self):
+        return dataclasses.asdict(self)
+
+    def to_script(self):
+        """``{"MUSIC_TYPE": "...", ...}``: run_sox_fifo.sh variables as strings (the engine's settings dict)."""
+        script = {}
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            elif isinstance(value, int):
+                value = str(value)
+            script[field.name.upper()] = value
+        return script
+
+
+class SettingsStore:
+    """``Settings`` in a JSON file with a numbered history of every saved version."""
+
+    def __init__(self, path=SETTINGS_PATH, history_max=HISTORY_MAX):
+        self.path = path
+        self.history_path = path + ".history"
+        self.history_max = history_max
+        self.version = None
+        self._history_lines = None
+
+    def load(self):
+        """The saved settings, or None when nothing has been saved yet; ValueError for a broken file."""
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            self.version = 0
+            return None
+        except OSError as e:
+            # 権限エラーなども壊れたファイルと同じく ValueError にして呼び出し側で既定値に戻させる
+            raise ValueError(f"cannot read {self.path}: {e.strerror or e}") from None
+        settings = data.get("settings", {}) if isinstance(data, dict) else None
+        if not isinstance(settings, dict):
+            raise ValueError(f"{self.path}: not a settings file")
+        try:
+            version = int(data.get("version", 0))
+        except (TypeError, ValueError):
+            raise ValueError(f"{self.path}: invalid version {data.get('version')!r}") from None
+        settings = Settings.from_config(settings)
+        self.version = version
+        return settings
+
+    def save(self, settings):
+        """Write ``settings`` as the next version (atomic replace) and log it to the history; returns the version."""
+        if self.version is None:
+            try:
+                self.load()
+            except ValueError:
+                self.version = 0
+        record = {"version": self.version + 1, "saved": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                  "settings": settings.as_dict()}
+        dirpath = os.path.dirname(self.path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=dirpath, prefix=".sox_settings.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(record, f, indent=2)
+                f.write("\n")
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.version = record["version"]
+        self._append_history(record)
+        return self.version
+
+    def _append_history(self, record):
+        with open(self.history_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        if self._history_lines is None:
+            with open(self.history_path, "r") as f:
+                self._history_lines = sum(1 for _ in f)
+        else:
+            self._history_lines += 1
+        # 毎回切り詰めずに、上限の 2 倍を超えたらまとめて古い版を捨てる
+        if self._history_lines > 2 * self.history_max:
+            lines = self._read_history_lines()[-self.history_max:]
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.history_path) or ".", prefix=".sox_settings.")
+            with os.fdopen(fd, "w") as f:
+                f.writelines(lines)
+            os.replace(tmp_path, self.history_path)
+            self._history_lines = len(lines)
+
+    def _read_history_lines(self):
+        try:
+            with open(self.history_path, "r") as f:
+                return f.readlines()
+        except FileNotFoundError:
+            return []
+
+    def history(self):
+        """``[{"version": n, "saved": ..., "settings": {...}}, ...]``, oldest first (the last ``history_max`` or more)."""
+        records = []
+        for line in self._read_history_lines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records
+
+    def restore(self, version):
+        """Save an earlier version again as the newest one; returns the new version number."""
+        for record in reversed(self.history()):
+            if record.get("version") == version:
+                return self.save(Settings.from_config(record.get("settings", {})))
+        raise KeyError(f"version {version} is not in {self.history_path}")
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if args[:1] == ["shell"] and len(args) <= 2:
+        store = SettingsStore(*args[1:2])
+        try:
+            settings = store.load()
+        except ValueError as e:
+            # 壊れた設定ファイル: スクリプトの既定値のまま起動する
+            print(f"sox_settings.py: ignoring {store.path}: {e}", file=sys.stderr)
+            return 1
+        if settings is not None:
+            for key, value in settings.to_script().items():
+                print(f"{key}={shlex.quote(value)}")
+        return 0
+    if args[:1] == ["history"] and len(args) <= 2:
+        for record in SettingsStore(*args[1:2]).history():
+            print(f"{record.get('version'):>4}  {record.get('saved')}  {json.dumps(record.get('settings'))}")
+        return 0
+    if args[:1] == ["restore"] and len(args) in (2, 3) and args[1].isdigit():
+        store = SettingsStore(*args[2:3])
+        try:
+            version = store.restore(int(args[1]))
+        except (KeyError, ValueError) as e:
+            print(f"sox_settings.py: {e}", file=sys.stderr)
+            return 1
+        print(f"restored version {args[1]} as version {version}")
+        return 0
+    print("usage: sox_settings.py shell|history [FILE] | restore VERSION [FILE]", file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
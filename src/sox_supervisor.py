@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""Event-driven supervisor for the run_sox_fifo.sh pipeline (asyncio).
+
+Replaces the MPD monitor subprocess + signal file + ``sleep 0.2`` polling
+loop of run_sox_fifo.sh (TRACK_CHANGE_RESTART=1): MPD ``idle player``
+events (sox_mpd.MpdEvents, which also reconnects with backoff) drive
+stop / flush / start directly in one process, so a track change is handled
+within a few milliseconds of MPD reporting it.  It also takes over
+from mpd_watcher.sh, which restarted MPD and the whole service on every song.
+
+With ``--engine`` (OUTPUT_METHOD="engine") there is no pipeline process: the
+sox_engine.Engine runs on a thread of this process and stays up across every
+MPD state change.  Stop, pause and track changes only ask it to drop its
+queued output and reset the filter state, which takes effect within one
+block; nothing is respawned and the FIRs are not reloaded.
+
+    python3 sox_supervisor.py --command "<pipeline>" [--fifo /tmp/mpd.fifo]
+    python3 sox_supervisor.py --engine [--script run_sox_fifo.sh] [--device ..] [--block ..]
+
+Both modes serve playback metrics on ``--metrics-socket`` (sox_metrics.py).
+In pipeline mode these are the aplay/play underrun count, parsed from the
+pipeline's stderr (which is still forwarded to the journal), and the FIFO
+backlog; the engine reports its own block timing and ALSA buffer fill.
+
+With ``--input-format auto`` (FIFO_FORMAT="auto") the engine follows the
+FIFO's rate and sample format from MPD's ``audio`` status, queried when a
+new stream starts in the FIFO (Engine.request_input_format), so each
+playback is processed at its native rate.
+
+``--autotune`` (BUFFER_AUTOTUNE=1) learns aplay's buffer size per device
+with sox_buftune.BufferTuner: underruns seen on the pipeline's stderr and
+clean playback time feed the tuner, and each (re)start runs aplay with the
+current size.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+from sox_buftune import BufferTuner, with_buffer_args
+from sox_metrics import DEFAULT_SOCKET, MetricsServer, PlaybackMetrics, fifo_backlog
+from sox_mpd import MpdEvents, pairs_to_dict
+from sox_settings import SETTINGS_PATH
+
+logger = logging.getLogger("sox_supervisor")
+
+MPD_HOST = "localhost"
+MPD_PORT = 6600
+STOP_TIMEOUT = 2.0
+# エンジンスレッドの終了待ち: 出力バッファを鳴らし切る (drain) 時間を含む
+ENGINE_STOP_TIMEOUT = 5.0
+MPD_RESTART_THROTTLE = 1.0
+FIFO_SAMPLE_INTERVAL = 1.0
+# エンジンスレッドから MPD の現在の形式を問い合わせるときの待ち時間 (秒)
+FORMAT_PROBE_TIMEOUT = 1.0
+# aplay: "underrun!!! (at least 12.345 ms long)" / play: "alsa: under-run"
+UNDERRUN_RE = re.compile(rb"under-?run", re.IGNORECASE)
+
+
+def flush_fifo(path):
+    """Discard whatever is buffered in the FIFO (non-blocking; same as the old dd call)."""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return 0
+    dropped = 0
+    try:
+        while True:
+            try:
+                chunk = os.read(fd, 65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            dropped += len(chunk)
+    finally:
+        os.close(fd)
+    return dropped
+
+
+def fifo_path_backlog(path):
+    """Bytes buffered in the FIFO at ``path`` without consuming them (None if unavailable)."""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        return fifo_backlog(fd)
+    finally:
+        os.close(fd)
+
+
+class PipelineSupervisor:
+    """Owns the pipeline process group and reacts to MPD player events."""
+
+    def __init__(self, command, fifo_path, restart_mpd=False, host=MPD_HOST, port=MPD_PORT, metrics=None,
+                 tuner=None):
+        self.command = command
+        self.fifo_path = fifo_path
+        self.restart_mpd = restart_mpd
+        self.host = host
+        self.port = port
+        self.proc = None
+        self._lock = asyncio.Lock()
+        self._stopping = False
+        self._last_state = None
+        self._last_songid = None
+        self._last_mpd_restart = 0.0
+        self.metrics = metrics or PlaybackMetrics("pipeline")
+        self.tuner = tuner
+        self._started_at = None
+        self._loop = None
+        self._events = None
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    # --- パイプライン制御 ---
+    async def start(self):
+        command = self.command
+        if self.tuner is not None:
+            self.tuner.maybe_step_down()
+            command = with_buffer_args(command, self.tuner.buffer_frames, self.tuner.period_frames)
+            self.metrics.buffer_size = self.tuner.buffer_frames
+        logger.info("Executing pipeline: %s", command)
+        # 新しいセッションで起動し、sox | aplay などのパイプ全体をプロセスグループ単位で停止できるようにする
+        # stderr は underrun の計数のために中継する
+        self.proc = await asyncio.create_subprocess_shell(command, start_new_session=True,
+                                                          stderr=asyncio.subprocess.PIPE)
+        self._started_at = time.monotonic()
+        logger.info("Pipeline started (PID=%d)", self.proc.pid)
+        self.metrics.state = "playing"
+        asyncio.ensure_future(self._pump_stderr(self.proc))
+        try:
+            # ionice: I/O 優先度を realtime に設定 (失敗しても続行)
+            ion = await asyncio.create_subprocess_exec("ionice", "-c1", "-p", str(self.proc.pid),
+                                                       stderr=asyncio.subprocess.DEVNULL)
+            await ion.wait()
+        except OSError:
+            pass
+        asyncio.ensure_future(self._watch(self.proc))
+
+    async def stop(self):
+        proc, self.proc = self.proc, None
+        if proc is None or proc.returncode is not None:
+            return
+        logger.info("Stopping pipeline (PID=%d)...", proc.pid)
+        self._stopping = True
+        self.metrics.state = "stopped"
+        self._account_playtime()
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            try:
+                await asyncio.wait_for(proc.wait(), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                os.killpg(proc.pid, signal.SIGKILL)
+                await proc.wait()
+        except ProcessLookupError:
+            pass
+        finally:
+            self._stopping = False
+
+    async def restart(self):
+        await self.stop()
+        self.metrics.resets += 1
+        dropped = flush_fifo(self.fifo_path)
+        if dropped:
+            logger.info("Flushed %d bytes from %s", dropped, self.fifo_path)
+        await self.start()
+
+    async def pause(self):
+        """Pipeline mode keeps the processes through a pause (as before)."""
+
+    async def shutdown(self):
+        await self.stop()
+
+    async def _pump_stderr(self, proc):
+        """Forward the pipeline's stderr to ours (the journal) and count underruns."""
+        while True:
+            line = await proc.stderr.readline()
+            if not line:
+                return
+            sys.stderr.buffer.write(line)
+            sys.stderr.buffer.flush()
+            if UNDERRUN_RE.search(line):
+                self.metrics.xruns += 1
+                if self.tuner is not None:
+                    # 大きいバッファは次の (再) 起動から
+                    self._account_playtime()
+                    self.tuner.on_xrun()
+
+    def _account_playtime(self):
+        if self.tuner is not None and self._started_at is not None:
+            now = time.monotonic()
+            if self._last_state == "play":
+                self.tuner.played(now - self._started_at)
+            self._started_at = now
+
+    async def _sample_fifo(self):
+        while True:
+            self.metrics.fifo_backlog = fifo_path_backlog(self.fifo_path)
+            await asyncio.sleep(FIFO_SAMPLE_INTERVAL)
+
+    async def _watch(self, proc):
+        """Restart the pipeline if it dies on its own (not via stop())."""
+        await proc.wait()
+        if self._stopping or proc is not self.proc:
+            return
+        logger.warning("Pipeline exited unexpectedly (rc=%s); restarting", proc.returncode)
+        async with self._lock:
+            if proc is self.proc:
+                self.proc = None
+                flush_fifo(self.fifo_path)
+                await asyncio.sleep(0.1)
+                await self.start()
+
+    # --- MPD イベント処理 ---
+    async def on_player_event(self, status, t_event):
+        state = status.get("state", "stop")
+        songid = status.get("songid", "")
+        async with self._lock:
+            self.on_audio_format(status.get("audio"))
+            if state == "stop":
+                logger.info("MPD stopped; stopping pipeline")
+                await self.stop()
+            elif songid != self._last_songid:
+                if self._last_state == "play" and state == "play":
+                    # 連続再生 (play -> play) は再起動せず gapless を優先
+                    logger.info("Track %s (play -> play); keeping pipeline", songid)
+                    await self._maybe_restart_mpd()
+                else:
+                    logger.info("Track %s (%s -> %s); restarting pipeline", songid, self._last_state, state)
+                    await self.restart()
+            elif state == "pause" and self._last_state == "play":
+                await self.pause()
+            elif not self.running and state == "play":
+                await self.start()
+            self._last_state = state
+            self._last_songid = songid
+        logger.info("Handled player event in %.1f ms", (time.monotonic() - t_event) * 1000.0)
+
+    def on_audio_format(self, audio):
+        """MPD's current ``audio`` status (``"44100:24:2"``); the pipeline's format is fixed."""
+
+    async def _maybe_restart_mpd(self):
+        now = time.monotonic()
+        if not self.restart_mpd or now - self._last_mpd_restart < MPD_RESTART_THROTTLE:
+            return
+        self._last_mpd_restart = now
+        logger.info("Restarting mpd between consecutive tracks")
+        try:
+            proc = await asyncio.create_subprocess_exec("/bin/systemctl", "restart", "mpd")
+            await proc.wait()
+        except OSError as e:
+            logger.error("Failed to restart mpd: %s", e)
+
+    def on_mpd_event(self, event):
+        """MpdEvents thread: hand the event to the event loop (in order, under the lock)."""
+        t_event = time.monotonic()
+        self.metrics.mpd_state = event.status.get("state")
+        self.metrics.mpd_audio = event.status.get("audio")
+        if "connect" in event.changed:
+            self._loop.call_soon_threadsafe(self._on_connect, event.status)
+        elif "player" in event.changed:
+            future = asyncio.run_coroutine_threadsafe(self.on_player_event(event.status, t_event), self._loop)
+            future.add_done_callback(self._log_failure)
+
+    def _on_connect(self, status):
+        if self._last_state is None:
+            self._last_state = status.get("state", "stop")
+            self._last_songid = status.get("songid", "")
+        self.on_audio_format(status.get("audio"))
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("MPD event handling failed", exc_info=future.exception())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        done = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            loop.add_signal_handler(sig, done.set)
+        self._loop = loop
+        await self.start()
+        events = self._events = MpdEvents(self.host, self.port, subsystems=("player",))
+        events.subscribe(self.on_mpd_event)
+        events.start()
+        sampler = asyncio.ensure_future(self._sample_fifo())
+        await done.wait()
+        logger.info("Shutting down...")
+        events.stop()
+        sampler.cancel()
+        async with self._lock:
+            await self.shutdown()
+
+
+class EngineSupervisor(PipelineSupervisor):
+    """Hosts sox_engine.Engine in-process; MPD events reset it in place."""
+
+    def __init__(self, engine, fifo_path, restart_mpd=False, host=MPD_HOST, port=MPD_PORT, follow_format=False):
+        super().__init__(None, fifo_path, restart_mpd, host, port, metrics=engine.metrics)
+        self.engine = engine
+        self.follow_format = follow_format
+        if follow_format:
+            engine.format_probe = self._mpd_audio_format
+        self._thread = None
+        self._loop = None
+        self._closing = False
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    async def start(self):
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        # daemon: shutdown() の待ち時間を過ぎても止まらないときにプロセスの終了を妨げない
+        self._thread = threading.Thread(target=self._run_engine, name="sox-engine", daemon=True)
+        self._thread.start()
+        logger.info("Engine thread started (FIFO %s)", self.fifo_path)
+
+    def _run_engine(self):
+        try:
+            self.engine.run()
+        except Exception:
+            logger.exception("Engine thread died")
+        if not self._closing:
+            self._loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._respawn()))
+
+    async def _respawn(self):
+        await asyncio.sleep(1.0)
+        async with self._lock:
+            if not self._closing:
+                logger.warning("Restarting engine thread")
+                await self.start()
+
+    def on_audio_format(self, audio):
+        # エンジンは受け取った形式を FIFO の次のストリームの先頭まで保留する (gapless の曲間では切り替えない)
+        if not self.follow_format or not audio:
+            return
+        if not self.engine.request_input_format(audio):
+            logger.warning("MPD audio format %s is not readable from the FIFO; keeping the current one", audio)
+
+    def _mpd_audio_format(self):
+        """Engine thread: MPD's ``audio`` status now (None while unknown), when a new stream starts in the FIFO."""
+        if self._events is None or not self._events.connected:
+            return None
+        return pairs_to_dict(self._events.command("status", timeout=FORMAT_PROBE_TIMEOUT)).get("audio")
+
+    async def _sample_fifo(self):
+        """The engine samples the FIFO backlog itself on every block."""
+
+    async def stop(self):
+        self.engine.request_reset()
+
+    async def restart(self):
+        self.engine.request_reset()
+        await self.start()
+
+    async def pause(self):
+        self.engine.request_reset()
+
+    async def shutdown(self):
+        self._closing = True
+        if not self.running:
+            return
+        # FIFO の open/read で待っていても stop() で起こせる。キューの音は drain してから出力を閉じる
+        self.engine.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join, ENGINE_STOP_TIMEOUT)
+        if self._thread.is_alive():
+            logger.warning("Engine thread did not stop within %.1fs; exiting without draining", ENGINE_STOP_TIMEOUT)
+        else:
+            logger.info("Engine thread stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MPD event-driven supervisor for the SoX/engine pipeline")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--command", help="pipeline shell command (SOX_FULL_COMMAND + PLAY_CMD)")
+    mode.add_argument("--engine", action="store_true", help="run sox_engine.py in-process (OUTPUT_METHOD=engine)")
+    parser.add_argument("--fifo", default="/tmp/mpd.fifo")
+    parser.add_argument("--restart-mpd", action="store_true",
+                        help="restart mpd between consecutive tracks (MPD_RESTART_ON_TRACK=1)")
+    parser.add_argument("--host", default=MPD_HOST)
+    parser.add_argument("--port", type=int, default=MPD_PORT)
+    parser.add_argument("--device", default="auto", help="ALSA PCM (PLAY_DEVICE); 'auto' = from the script's OUTPUT_DEVICE (engine) / plug:default")
+    parser.add_argument("--autotune", action="store_true",
+                        help="learn the smallest stable ALSA buffer per device (BUFFER_AUTOTUNE=1)")
+    parser.add_argument("--rate", type=int, default=192000, help="aplay output rate (pipeline mode, with --autotune)")
+    parser.add_argument("--metrics-socket", default=DEFAULT_SOCKET, help="Unix socket serving JSON metrics ('' = off)")
+    parser.add_argument("--metrics-prom", default="", help="also write Prometheus text metrics to this file")
+    engine_opts = parser.add_argument_group("engine options (with --engine)")
+    engine_opts.add_argument("--script", help="run_sox_fifo.sh to read settings from")
+    engine_opts.add_argument("--settings", default=SETTINGS_PATH, help="GUI settings file (sox_settings.py)")
+    engine_opts.add_argument("--ctl", help="control file for live settings updates")
+    engine_opts.add_argument("--block", default="auto", help="frames per processing block ('auto' = per device class)")
+    engine_opts.add_argument("--input-format", default="192000:32:2",
+                             help="FIFO format RATE:BITS:2, or 'auto' to follow MPD's audio status per track")
+    engine_opts.add_argument("--output-bits", choices=("auto", "16", "24", "32"), default="auto",
+                             help="word length to dither to ('auto' = per device)")
+    engine_opts.add_argument("--pipeline", choices=("single", "staged"), default="single")
+    engine_opts.add_argument("--no-mmap", action="store_true", help="write with snd_pcm_writei instead of mmap access")
+    engine_opts.add_argument("--cpu-map", default="", help="per stage group CPUs, e.g. 'io:2 fir:3 eq:2 resample:3 post:2'")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    if args.engine:
+        # numpy/scipy はエンジンモードでのみ必要
+        import sox_engine
+        script = args.script or sox_engine.DEFAULT_SCRIPT
+        settings = sox_engine.load_engine_settings(script, args.settings)
+        logger.info("Settings from %s / %s: %s", args.settings, script, settings)
+        block = None if args.block == "auto" else int(args.block)
+        follow = args.input_format == "auto"
+        input_format = (sox_engine.INPUT_RATE, "32") if follow else sox_engine.parse_audio_format(args.input_format)
+        if input_format is None:
+            parser.error(f"unsupported --input-format {args.input_format!r} (RATE:16|24|32|f:2 or auto)")
+        engine = sox_engine.Engine(settings, args.fifo, args.device, block,
+                                   ctl_path=args.ctl or sox_engine.DEFAULT_CTL, pipeline=args.pipeline,
+                                   cpu_map=sox_engine.parse_cpu_map(args.cpu_map), autotune=args.autotune,
+                                   input_format=input_format, output_bits=args.output_bits, mmap=not args.no_mmap)
+        supervisor = EngineSupervisor(engine, args.fifo, args.restart_mpd, args.host, args.port,
+                                      follow_format=follow)
+    else:
+        device = "plug:default" if args.device == "auto" else args.device
+        tuner = BufferTuner(device, args.rate) if args.autotune else None
+        supervisor = PipelineSupervisor(args.command, args.fifo, args.restart_mpd, args.host, args.port,
+                                        tuner=tuner)
+    server = MetricsServer(supervisor.metrics, args.metrics_socket, args.metrics_prom or None).start()
+    try:
+        asyncio.run(supervisor.run())
+    finally:
+        server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""sox_albumart's remote providers against a local stub of the iTunes / MusicBrainz / Cover Art Archive APIs.
+
+    python3 -m unittest discover -s tests
+"""
+import json
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import sox_albumart  # noqa: E402
+
+ITUNES_ART = b"itunes-art"
+COVERART_ART = b"coverart-art"
+SONG = {"artist": "Chick Corea; Christian McBride", "album": "Trilogy", "file": "http://stream/1"}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        with server.lock:
+            server.hits.append(url.path)
+        behaviour = server.behaviour.get(url.path, {})
+        if behaviour.get("delay"):
+            time.sleep(behaviour["delay"])
+        if url.path == "/itunes/search":
+            art = f"http://127.0.0.1:{server.server_port}/itunes/art/100x100bb.jpg"
+            results = [{"artworkUrl100": art}] if behaviour.get("found") else []
+            self._send(json.dumps({"resultCount": len(results), "results": results}).encode())
+        elif url.path == "/itunes/art/600x600bb.jpg":
+            self._send(ITUNES_ART)
+        elif url.path == "/musicbrainz/":
+            releases = [{"id": "mbid-1"}] if behaviour.get("found") else []
+            self._send(json.dumps({"releases": releases}).encode())
+        elif url.path == "/coverart/mbid-1/front-500.jpg":
+            self._send(COVERART_ART)
+        else:
+            self.send_error(404)
+
+    def _send(self, body):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RemoteProviderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.hits = []
+        self.server.behaviour = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_port}"
+        for name, url in (("ITUNES_SEARCH_URL", base + "/itunes/search"),
+                          ("MUSICBRAINZ_URL", base + "/musicbrainz/"),
+                          ("COVERART_URL", base + "/coverart/{mbid}/front-500.jpg")):
+            patcher = mock.patch.object(sox_albumart, name, url)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cache_dir = tempfile.mkdtemp()
+        self.http = sox_albumart.HttpClient(min_interval={})
+        self.results = queue.Queue()
+        self.fetcher = sox_albumart.ArtFetcher(self.results.put, sox_albumart.ArtCache(self.cache_dir),
+                                               self.http, mpd=mock.Mock())
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.http.close()
+        shutil.rmtree(self.cache_dir)
+
+    def fetch(self, song=SONG):
+        self.fetcher.request(song)
+        return self.results.get(timeout=10)
+
+    def hits(self, prefix):
+        with self.server.lock:
+            return sum(1 for path in self.server.hits if path.startswith(prefix))
+
+    def http_url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def test_first_image_wins(self):
+        self.server.behaviour = {"/itunes/search": {"found": True},
+                                 "/musicbrainz/": {"found": True, "delay": 1.0}}
+        t0 = time.monotonic()
+        self.assertEqual(self.fetch(), ITUNES_ART)
+        self.assertLess(time.monotonic() - t0, 1.0)
+
+    def test_other_provider_answers_when_one_has_nothing(self):
+        self.server.behaviour = {"/musicbrainz/": {"found": True}}
+        self.assertEqual(self.fetch(), COVERART_ART)
+        self.assertEqual(self.hits("/itunes/search"), 1)
+
+    def test_hit_is_cached(self):
+        self.server.behaviour = {"/itunes/search": {"found": True}}
+        self.assertEqual(self.fetch(), ITUNES_ART)
+        self.assertEqual(self.fetch(), ITUNES_ART)
+        self.assertEqual(self.hits("/itunes/search"), 1)
+
+    def test_miss_is_cached_until_ttl(self):
+        self.assertIsNone(self.fetch())
+        self.assertEqual((self.hits("/itunes/search"), self.hits("/musicbrainz/")), (1, 1))
+        # TTL 内: どのサービスにも問い合わせない
+        self.assertIsNone(self.fetch())
+        self.assertEqual((self.hits("/itunes/search"), self.hits("/musicbrainz/")), (1, 1))
+        # TTL 切れ: 問い合わせ直して、見つかれば miss は消える
+        self.fetcher.cache.miss_ttl = 0
+        self.server.behaviour = {"/itunes/search": {"found": True}}
+        self.assertEqual(self.fetch(), ITUNES_ART)
+        self.assertEqual(self.hits("/itunes/search"), 2)
+        self.assertFalse(self.fetcher.cache.is_miss(sox_albumart.art_key(SONG)))
+
+    def test_server_error_is_not_cached_as_miss(self):
+        self.server.behaviour = {"/itunes/search": {"found": True}}
+        with mock.patch.object(sox_albumart, "ITUNES_SEARCH_URL", self.http_url("/missing")):
+            self.assertIsNone(self.fetch())
+        self.assertFalse(self.fetcher.cache.is_miss(sox_albumart.art_key(SONG)))
+        self.assertEqual(self.fetch(), ITUNES_ART)
+
+
+if __name__ == "__main__":
+    unittest.main()